@@ -12,7 +12,6 @@ __version__ = "1.0"
 
 import collections
 import glob
-import iotbx.pdb
 import logging
 import operator
 import os
@@ -31,6 +30,10 @@ from ample.util import printTable
 
 logger = logging.getLogger(__name__)
 
+# The keys of the AMPLE dictionary that are set by ensembling
+AMOPTD_KEYS = ['ensembles', 'ensembles_data', 'ensembles_directory', 'ensemble_options',
+               'truncation_levels', 'truncation_variances', 'truncation_nresidues']
+
 
 def add_argparse_options(parser=None):
     """Function to add the ensemble-specific options
@@ -53,7 +56,7 @@ def add_argparse_options(parser=None):
                         help='Path to directory of pre-clustered models to import')
 
     parser.add_argument('-cluster_method',
-                        help='How to cluster the models for ensembling (spicker|fast_protein_cluster')
+                        help='How to cluster the models for ensembling (spicker|fast_protein_cluster|pyspicker)')
 
     parser.add_argument('-ensembler_timeout', type=int,
                         help='Time in seconds before timing out ensembling')
@@ -91,11 +94,17 @@ def add_argparse_options(parser=None):
     parser.add_argument('-side_chain_treatments', type=str, nargs='+',
                         help='The side chain treatments to use. Default: {0}'.format(SIDE_CHAIN_TREATMENTS))
 
+    parser.add_argument('-stage_cache', metavar='True/False',
+                        help='Reuse the results of ensembling steps from earlier runs with the same inputs [False]')
+
+    parser.add_argument('-stage_cache_dir',
+                        help='Directory of the cache of ensembling results [<run_dir>/AMPLE_stage_cache]')
+
     parser.add_argument('-subcluster_radius_thresholds', type=float, nargs='+',
                         help='The radii to use for subclustering the truncated ensembles')
 
     parser.add_argument('-subcluster_program',
-                        help='Program for subclustering models [maxcluster]')
+                        help='Program for subclustering models (cctbx|gesamt|kabsch|lsqkab|maxcluster) [maxcluster]')
 
     parser.add_argument('-theseus_exe', metavar='Theseus exe (required)',
                         help='Path to theseus executable')
@@ -231,6 +240,7 @@ def ensembler_factory(amoptd):
         ensemble_max_models=amoptd['ensemble_max_models'],
         nproc=amoptd['nproc'],
         work_dir=work_dir,
+        stage_cache_dir=amoptd.get('stage_cache_dir') if amoptd.get('stage_cache') else None,
         # Executables
         fast_protein_cluster_exe=amoptd['fast_protein_cluster_exe'],
         gesamt_exe=amoptd['gesamt_exe'],
@@ -427,7 +437,7 @@ def import_ensembles(amoptd):
         d['ensemble_pdb'] = e
 
         # Get data on the models
-        hierarchy = iotbx.pdb.pdb_input(file_name=e).construct_hierarchy()
+        hierarchy = pdb_edit.cached_hierarchy(e)
         d['subcluster_num_models'] = len(hierarchy.models())
         d['num_residues'] = len(
             hierarchy.models()[0].chains()[0].residue_groups())
@@ -78,6 +78,8 @@ try:
             optd['gesamt_exe'] = ample_util.find_exe('gesamt')
         elif optd['subcluster_program'] == 'maxcluster':
             optd['maxcluster_exe'] = ample_util.find_exe('maxcluster')
+        elif optd['subcluster_program'] in ['cctbx', 'kabsch', 'lsqkab']:
+            pass
         else:
             raise RuntimeError("Unknown subcluster_program: {0}".format(
                 optd['subcluster_program']))
@@ -85,7 +87,7 @@ try:
         optd['ensemble_ok'] = os.path.join(optd['work_dir'], 'ensemble.ok')
         optd['results_path'] = os.path.join(optd['work_dir'], AMPLE_PKL)
     ensembler.create_ensembles(optd)
-    ample_util.save_amoptd(optd)
+    ample_util.save_amoptd(optd, keys=ensembler.AMOPTD_KEYS)
 except Exception as e:
     msg = "Error running ensembling: {0}".format(e.message)
     exit_util.exit_error(msg, sys.exc_info()[2])
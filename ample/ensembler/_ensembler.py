@@ -9,12 +9,14 @@ import logging
 import os
 import re
 import shutil
+import tempfile
 
 from constants import ENSEMBLE_MAX_MODELS, ALLATOM, POLYALA, RELIABLE, UNMODIFIED
 from ample.util import ample_util
 from ample.util import pdb_edit
 from ample.util import sequence_util
 from ample.util import theseus
+from ample.util.stage_cache import StageCache
 
 logger = logging.getLogger(__name__)
 
@@ -232,6 +234,8 @@ class Ensembler(object):
     work_dir : str
         The working directory where all the processing takes place and all intermediary
         files are kept. This may be deleted when AMPLE is run with the purge option.
+    stage_cache_dir : str
+        Directory of the cache of the results of the ensembling steps that are reused between runs
         
     gesamt_exe : str
         Path to an executable
@@ -256,6 +260,7 @@ class Ensembler(object):
                  ensemble_max_models=ENSEMBLE_MAX_MODELS,
                  nproc=1,
                  work_dir=None,
+                 stage_cache_dir=None,
                  # Executables
                  gesamt_exe=None,
                  fast_protein_cluster_exe=None,
@@ -285,6 +290,8 @@ class Ensembler(object):
         work_dir : str
             The working directory where all the processing takes place and all intermediary
             files are kept. This may be deleted when AMPLE is run with the purge option.
+        stage_cache_dir : str
+            Directory of the cache of the results of the ensembling steps. If not given, nothing is cached.
         gesamt_exe : str
             Path to an executable
         fast_protein_cluster_exe : str
@@ -313,6 +320,7 @@ class Ensembler(object):
         if not os.path.isdir(work_dir): os.mkdir(work_dir)
         self.work_dir = work_dir
         os.chdir(work_dir)
+        self.stage_cache = StageCache(stage_cache_dir) if stage_cache_dir else None
         
         # executables
         self.gesamt_exe = gesamt_exe
@@ -365,6 +373,7 @@ class Ensembler(object):
             A `list` of :obj:`Ensemble` objects    
         """
         ensembles = []
+        variants = []
         if side_chain_treatments is None: side_chain_treatments=[UNMODIFIED]
         for sct in side_chain_treatments:
             ensemble = raw_ensemble.copy()
@@ -384,30 +393,54 @@ class Ensembler(object):
             # fpath = ample_util.filename_append(raw_ensemble,astr=sct, directory=ensembles_directory)
             fpath = os.path.join(self.ensembles_directory, "{0}.pdb".format(ensemble.name))
             
-            # Create the files
             if sct == ALLATOM or sct == UNMODIFIED:
-                # For all atom just copy the file
-                shutil.copy2(raw_ensemble.pdb, fpath)
+                variant = 'all'
             elif sct == RELIABLE:
-                pdb_edit.reliable_sidechains(raw_ensemble.pdb, fpath)
+                variant = 'reliable'
             elif sct == POLYALA:
-                pdb_edit.backbone(raw_ensemble.pdb, fpath)
+                variant = 'backbone'
             else:
                 raise RuntimeError, "Unrecognised side_chain_treatment: {0}".format(sct)
-            
-            # Count the number of atoms in the ensemble-only required for benchmark mode
-            natoms, nresidues = pdb_edit.num_atoms_and_residues(fpath, first=True)
-            
-            # Process ensemble data
+            variants.append((fpath, variant))
             ensemble.pdb = fpath
+            ensembles.append(ensemble)
+        
+        # Create all the files from a single read of the raw ensemble, counting the atoms as we go
+        counts = self._side_chain_variants(raw_ensemble.pdb, variants)
+        for ensemble, (natoms, nresidues) in zip(ensembles, counts):
+            # The number of atoms in the ensemble is only required for benchmark mode
             ensemble.ensemble_num_atoms = natoms
             # check
             assert ensemble.num_residues == nresidues, "Unmatching number of residues: {0} : {1}".format(ensemble.num_residues,
                                                                                                          nresidues)
-            ensembles.append(ensemble)
                 
         return ensembles
 
+    def _side_chain_variants(self, pdbin, variants):
+        """Wrapper for pdb_edit.side_chain_variants that takes any variants of the same pdbin created by an earlier
+        run from the stage cache"""
+        if not self.stage_cache: return pdb_edit.side_chain_variants(pdbin, variants)
+        counts = [None] * len(variants)
+        keys = [self.stage_cache.key('side_chains', [pdbin], variant=variant) for _, variant in variants]
+        for i, (fpath, _) in enumerate(variants):
+            if not self.stage_cache.has('side_chains', keys[i]): continue
+            # The cached file has the name of the ensemble it was created for so we restore it to a scratch directory
+            scratch_dir = tempfile.mkdtemp(dir=self.ensembles_directory)
+            try:
+                cached = self.stage_cache.get('side_chains', keys[i], out_dir=scratch_dir)
+                if cached is None: continue
+                cached_path, counts[i] = cached
+                os.rename(cached_path, fpath)
+            finally:
+                shutil.rmtree(scratch_dir)
+        todo = [i for i, c in enumerate(counts) if c is None]
+        if todo:
+            created = pdb_edit.side_chain_variants(pdbin, [variants[i] for i in todo])
+            for i, count in zip(todo, created):
+                counts[i] = count
+                self.stage_cache.put('side_chains', keys[i], (variants[i][0], count), out_dir=self.ensembles_directory)
+        return counts
+
     def generate_ensembles(self, models, **kwargs):
         """Generate ensembles from models and supplied key word arguments.
 
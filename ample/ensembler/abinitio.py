@@ -4,7 +4,10 @@ __author__ = "Jens Thomas, and Felix Simkovic"
 __date__ = "17 Feb 2016"
 __version__ = "1.0"
 
+import copy
 import logging
+import multiprocessing
+import numpy
 import os
 import shutil
 
@@ -16,11 +19,29 @@ import truncation_util
 from constants import SIDE_CHAIN_TREATMENTS, SUBCLUSTER_RADIUS_THRESHOLDS
 
 from ample.util import fast_protein_cluster
+from ample.util import pyspicker
 from ample.util import scwrl_util
 from ample.util import spicker
+from ample.util import stage_cache
 
 logger = logging.getLogger(__name__)
 
+# Holds the ensembler in each process of the pool created by AbinitioEnsembler.process_truncations
+_truncation_worker_ensembler = None
+
+
+def _init_truncation_worker(ensembler):
+    """Give each pool process its own copy of the ensembler"""
+    global _truncation_worker_ensembler
+    _truncation_worker_ensembler = ensembler
+    return
+
+
+def _truncation_worker(args):
+    """Return the ensembles for a single truncation level"""
+    truncation, kwargs = args
+    return _truncation_worker_ensembler.ensembles_from_truncation(truncation, **kwargs)
+
 
 class AbinitioEnsembler(_ensembler.Ensembler):
     """Ensemble creator using on multiple models with identical sequences most
@@ -42,6 +63,12 @@ class AbinitioEnsembler(_ensembler.Ensembler):
         # we save the truncator so that we can query it for data later
         self.truncator = None
         
+        # subclusterer holding the per-residue data for the cluster currently being processed
+        self._residue_clusterer = None
+        # (index2pdb, distance_matrix) for truncation directories whose matrix was calculated before they were
+        # handed to the processes of process_truncations
+        self._distance_matrices = {}
+        
         return
 
     def cluster_models(self,
@@ -63,6 +90,24 @@ class AbinitioEnsembler(_ensembler.Ensembler):
         # Get the cluster_method_type and cluster_score_type from the cluster_method
         cluster_method_type, cluster_score_type, cluster_exe = self.parse_cluster_method(cluster_method)
         
+        # The SPICKER clusters only depend on the models and clustering options so may be in the stage cache
+        cache_key = None
+        if self.stage_cache and cluster_method_type in ['spicker', 'pyspicker']:
+            files = list(models)
+            if self.cluster_score_matrix: files.append(self.cluster_score_matrix)
+            cache_key = self.stage_cache.key('cluster',
+                                             files,
+                                             cluster_method=cluster_method,
+                                             num_clusters=num_clusters,
+                                             max_cluster_size=max_cluster_size)
+            cached = self.stage_cache.get('cluster', cache_key)
+            if cached is not None:
+                logger.info('Using clusters from stage cache')
+                # The models may have moved since they were clustered
+                cached_models, clusters = cached
+                paths = dict(zip(cached_models, models))
+                return stage_cache.map_paths(clusters, lambda s: paths.get(s, s))
+        
         # Set directory
         if cluster_method_type not in ['skip']:
             pass
@@ -92,6 +137,9 @@ class AbinitioEnsembler(_ensembler.Ensembler):
                                                    models,
                                                    num_clusters)
         elif cluster_method_type == 'spicker':
+            score_matrix = self.cluster_score_matrix
+            if cluster_score_type == 'read_matrix' and not score_matrix:
+                score_matrix = self.qscore_matrix(models, os.path.join(self.work_dir, 'qscore_matrix'))
             logger.info('* Running SPICKER to cluster models *')
             spickerer = spicker.Spickerer(spicker_exe=cluster_exe)
             clusters = spickerer.cluster(models,
@@ -99,19 +147,35 @@ class AbinitioEnsembler(_ensembler.Ensembler):
                                          max_cluster_size=max_cluster_size,
                                          score_type=cluster_score_type,
                                          run_dir=cluster_dir,
-                                         score_matrix=None,
+                                         score_matrix=score_matrix,
                                          nproc=self.nproc)
             logger.debug(spickerer.results_summary())
+        elif cluster_method_type == 'pyspicker':
+            logger.info('* Running pyspicker to cluster models *')
+            clusterer = pyspicker.PySpicker()
+            clusters = clusterer.cluster(models,
+                                         num_clusters=num_clusters,
+                                         max_cluster_size=max_cluster_size,
+                                         run_dir=cluster_dir,
+                                         nproc=self.nproc)
+            logger.debug(clusterer.results_summary())
         else:
             msg = 'Unrecognised clustering method: {0}'.format(cluster_method_type)
             raise RuntimeError(msg)
-                
+        
+        if cache_key: self.stage_cache.put('cluster', cache_key, (list(models), clusters))
         return clusters
     
+    def qscore_matrix(self, models, matrix_dir):
+        """Generate the gesamt Q-score matrix of the models and return the path to the saved condensed matrix"""
+        if not os.path.isdir(matrix_dir): os.makedirs(matrix_dir)
+        clusterer = subcluster.GesamtClusterer(self.gesamt_exe, nproc=self.nproc, work_dir=matrix_dir)
+        clusterer._generate_distance_matrix_generic(models, purge=True, metric='qscore')
+        return os.path.join(matrix_dir, subcluster.SCORE_MATRIX_NPY)
+    
     def ensemble_from_subcluster(self, cluster_files, radius, truncation, cluster_score=None):
         subcluster_dir = os.path.join(truncation.directory, 'subcluster_{0}'.format(radius))
         os.mkdir(subcluster_dir)
-        os.chdir(subcluster_dir)
 
         cluster_num = truncation.cluster.index
         truncation_level = truncation.level
@@ -122,7 +186,7 @@ class AbinitioEnsembler(_ensembler.Ensembler):
             for m in cluster_files: f.write(m + "\n")
             f.write("\n")
         
-        cluster_file = self.superpose_models(cluster_files, work_dir=subcluster_dir)
+        cluster_file = self.superpose_subcluster(cluster_files, subcluster_dir)
         if not cluster_file:
             msg = "Error running theseus on ensemble {0} in directory: {1}\nSkipping subcluster: {0}".format(basename,
                                                                                                              subcluster_dir)
@@ -164,6 +228,32 @@ class AbinitioEnsembler(_ensembler.Ensembler):
         
         return ensemble
 
+    def superpose_subcluster(self, cluster_files, subcluster_dir):
+        """Return the file of the cluster_files superposed with theseus, taking it from the stage cache if possible"""
+        if not self.stage_cache: return self.superpose_models(cluster_files, work_dir=subcluster_dir)
+        cache_key = self.stage_cache.key('superpose', cluster_files)
+        cluster_file = self.stage_cache.get('superpose', cache_key, out_dir=subcluster_dir)
+        if cluster_file is None:
+            cluster_file = self.superpose_models(cluster_files, work_dir=subcluster_dir)
+            if cluster_file: self.stage_cache.put('superpose', cache_key, cluster_file, out_dir=subcluster_dir)
+        return cluster_file
+
+    def ensembles_from_truncation(self,
+                                  truncation,
+                                  subcluster_program=None,
+                                  ensemble_max_models=None,
+                                  radius_thresholds=None,
+                                  side_chain_treatments=SIDE_CHAIN_TREATMENTS):
+        """Return the list of ensembles with side chains edited for all subclusters of a truncation level"""
+        ensembles = []
+        for ensemble in self.subcluster_models(truncation,
+                                               subcluster_program=subcluster_program,
+                                               ensemble_max_models=ensemble_max_models,
+                                               radius_thresholds=radius_thresholds):
+            # Now add the side chains
+            ensembles.extend(self.edit_side_chains(ensemble, side_chain_treatments))
+        return ensembles
+
     def generate_ensembles(self,
                            models,
                            cluster_dir=None,
@@ -211,21 +301,22 @@ class AbinitioEnsembler(_ensembler.Ensembler):
             if use_scwrl:
                 cluster.models = self.scwrl_models(cluster.models, truncate_dir, self.scwrl_exe)
                  
+            self._residue_clusterer = None
             self.truncator = truncation_util.Truncator(work_dir=truncate_dir)
             self.truncator.theseus_exe = self.theseus_exe
-            for truncation in self.truncator.truncate_models(models=cluster.models,
-                                                             truncation_method=truncation_method,
-                                                             percent_truncation=percent_truncation,
-                                                             truncation_pruning=truncation_pruning):
-                # Add cluster information
-                truncation.cluster = cluster
-                for ensemble in self.subcluster_models(truncation,
-                                                       subcluster_program=subcluster_program,
-                                                       ensemble_max_models=self.ensemble_max_models,
-                                                       radius_thresholds=subcluster_radius_thresholds):
-                    # Now add the side chains
-                    for ensemble in self.edit_side_chains(ensemble, side_chain_treatments):
-                        self.ensembles.append(ensemble)
+            self.truncator.stage_cache = self.stage_cache
+            truncations = self.truncator.truncate_models(models=cluster.models,
+                                                         truncation_method=truncation_method,
+                                                         percent_truncation=percent_truncation,
+                                                         truncation_pruning=truncation_pruning)
+            # Add cluster information
+            for truncation in truncations: truncation.cluster = cluster
+            for ensembles in self.process_truncations(truncations,
+                                                      subcluster_program=subcluster_program,
+                                                      ensemble_max_models=self.ensemble_max_models,
+                                                      radius_thresholds=subcluster_radius_thresholds,
+                                                      side_chain_treatments=side_chain_treatments):
+                self.ensembles.extend(ensembles)
         return self.ensembles
 
     def generate_ensembles_from_amoptd(self, models, amoptd):
@@ -246,6 +337,9 @@ class AbinitioEnsembler(_ensembler.Ensembler):
         # strip out any that are None
         kwargs = { k : v for k, v in kwargs.iteritems() if v is not None }
         
+        # A user-supplied matrix for spicker - either a spicker score.matrix or a saved DistanceMatrix
+        if amoptd.get('score_matrix'): self.cluster_score_matrix = amoptd['score_matrix']
+        
         ensembles = self.generate_ensembles(models, **kwargs)
         
         # We need to save these data to amopt as it's impossible to reconstruct otherwise
@@ -268,7 +362,7 @@ class AbinitioEnsembler(_ensembler.Ensembler):
                 cluster_score_type = 'read_matrix'
             elif cluster_method == 'spicker_tm':
                 cluster_score_type = 'tm'
-        elif cluster_method in ['import', 'random', 'skip']:
+        elif cluster_method in ['import', 'pyspicker', 'random', 'skip']:
             cluster_method_type = cluster_method
             cluster_exe = None
         else:
@@ -277,6 +371,56 @@ class AbinitioEnsembler(_ensembler.Ensembler):
         logger.debug('cluster_method_type: %s cluster_score_type: %s cluster_exe %s', cluster_method_type, cluster_score_type, cluster_exe)
         return cluster_method_type, cluster_score_type, cluster_exe
     
+    def process_truncations(self, truncations, **kwargs):
+        """Return a list of the ensembles for each truncation, in the same order as the truncations.
+        
+        With nproc > 1 the truncation levels are shared across a pool of processes. All the directories used
+        for a truncation level are derived from Truncation.directory, so the levels are independent of each
+        other and any change of working directory is private to the process handling that level. Each process
+        runs any external programs on a single processor.
+        
+        Parameters
+        ----------
+        truncations : :obj:`list`
+            A list of :obj:`Truncation` objects with their models and cluster set
+        **kwargs
+            Keyword arguments passed to `ensembles_from_truncation`
+
+        Returns
+        -------
+        ensembles : :obj:`list`
+            A `list` of a `list` of :obj:`Ensemble` objects for each truncation
+        """
+        if self.nproc < 2 or len(truncations) < 2:
+            return [self.ensembles_from_truncation(truncation, **kwargs) for truncation in truncations]
+        
+        worker_ensembler = copy.copy(self)
+        worker_ensembler.nproc = 1
+        if kwargs.get('subcluster_program') == 'kabsch':
+            # The kabsch matrices are cheap to derive from each other one level after another, so calculate them all
+            # here rather than splitting the levels, and rebuilding the per-residue data, across the processes
+            worker_ensembler._distance_matrices = {}
+            for truncation in truncations:
+                if truncation.num_residues <= 2: continue
+                clusterer = self.subcluster_distance_matrix(truncation, 'kabsch')
+                worker_ensembler._distance_matrices[truncation.directory] = (list(clusterer.index2pdb),
+                                                                             numpy.array(clusterer.distance_matrix))
+        nproc = min(self.nproc, len(truncations))
+        logger.info('Processing %d truncation levels on %d processors', len(truncations), nproc)
+        pool = multiprocessing.Pool(processes=nproc,
+                                    initializer=_init_truncation_worker,
+                                    initargs=(worker_ensembler,))
+        try:
+            # map returns the results in the order of the truncations
+            ensembles = pool.map(_truncation_worker, [(truncation, kwargs) for truncation in truncations])
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return ensembles
+
     def scwrl_models(self, models, work_dir, scwrl_exe):
         """Add side chains to the models with Scwrl"""
         
@@ -288,18 +432,65 @@ class AbinitioEnsembler(_ensembler.Ensembler):
                                                                               strip_oxt=True)
         return scwrled_models
 
-    def subclusterer_factory(self, subcluster_program):
-        """Return an instantiated subclusterer based on the given program"""
+    def subclusterer_factory(self, subcluster_program, work_dir=None):
+        """Return an instantiated subclusterer based on the given program, working in work_dir"""
         if subcluster_program == 'gesamt':
-            clusterer = subcluster.GesamtClusterer(self.gesamt_exe, nproc=self.nproc)
+            clusterer = subcluster.GesamtClusterer(self.gesamt_exe, nproc=self.nproc, work_dir=work_dir)
         elif subcluster_program == 'maxcluster':
-            clusterer = subcluster.MaxClusterer(self.maxcluster_exe)
+            clusterer = subcluster.MaxClusterer(self.maxcluster_exe, work_dir=work_dir)
+        elif subcluster_program == 'kabsch':
+            clusterer = subcluster.KabschClusterer(work_dir=work_dir)
+        elif subcluster_program == 'cctbx':
+            clusterer = subcluster.CctbxClusterer(nproc=self.nproc, work_dir=work_dir)
         elif subcluster_program == 'lsqkab':
-            clusterer = subcluster.LsqkabClusterer(self.lsqkab_exe)
+            clusterer = subcluster.LsqkabClusterer(self.lsqkab_exe, nproc=self.nproc, work_dir=work_dir)
         else:
             raise RuntimeError("Unrecognised subcluster_program: {0}".format(subcluster_program))
         return clusterer
 
+    def subcluster_distance_matrix(self, truncation, subcluster_program):
+        """Return a subclusterer with the distance matrix calculated for the models of a truncation.
+        
+        For the kabsch subcluster_program the per-residue data for the models of a cluster are calculated once
+        and the distance matrix for each truncation level is derived from them.
+        
+        The matrix for the same truncated models and subcluster_program is taken from the stage cache if possible.
+        Any files are written to the truncation directory.
+        """
+        if truncation.directory in self._distance_matrices:
+            clusterer = self.subclusterer_factory(subcluster_program, work_dir=truncation.directory)
+            index2pdb, clusterer.distance_matrix = self._distance_matrices[truncation.directory]
+            clusterer.index2pdb = list(index2pdb)
+            return clusterer
+        
+        cache_key = None
+        if self.stage_cache:
+            cache_key = self.stage_cache.key('subcluster_matrix', truncation.models, subcluster_program=subcluster_program)
+            cached = self.stage_cache.get('subcluster_matrix', cache_key)
+            if cached is not None:
+                # The order of the models in the matrix is stored as indices into the truncated models
+                order, matrix = cached
+                clusterer = self.subclusterer_factory(subcluster_program, work_dir=truncation.directory)
+                clusterer.index2pdb = [truncation.models[i] for i in order]
+                clusterer.distance_matrix = matrix
+                return clusterer
+        
+        if subcluster_program == 'kabsch' and truncation.residues_idxs is not None:
+            if self._residue_clusterer is None:
+                self._residue_clusterer = subcluster.ResidueKabschClusterer(self.truncator.models)
+            clusterer = self._residue_clusterer
+            clusterer.generate_distance_matrix(truncation.models, residue_idxs=truncation.residues_idxs)
+        else:
+            clusterer = self.subclusterer_factory(subcluster_program, work_dir=truncation.directory)
+            clusterer.generate_distance_matrix(truncation.models)
+        
+        if cache_key:
+            paths = [os.path.abspath(m) for m in truncation.models]
+            order = [paths.index(os.path.abspath(m)) for m in clusterer.index2pdb if os.path.abspath(m) in paths]
+            if len(order) == len(clusterer.index2pdb):
+                self.stage_cache.put('subcluster_matrix', cache_key, (order, numpy.array(clusterer.distance_matrix)))
+        return clusterer
+
     def subcluster_models(self,
                           truncation,
                           subcluster_program=None,
@@ -328,13 +519,8 @@ class AbinitioEnsembler(_ensembler.Ensembler):
         
         if not radius_thresholds: radius_thresholds = self.subcluster_radius_thresholds
         
-        # Make sure everyting happens in the truncation directory
-        owd = os.getcwd()
-        os.chdir(truncation.directory)
-            
         # Generate the distance matrix
-        clusterer = self.subclusterer_factory(subcluster_program)
-        clusterer.generate_distance_matrix(truncation.models)
+        clusterer = self.subcluster_distance_matrix(truncation, subcluster_program)
         # clusterer.dump_matrix(os.path.join(truncation_dir,"subcluster_distance.matrix")) # for debugging
 
         # Loop through the radius thresholds
@@ -365,9 +551,6 @@ class AbinitioEnsembler(_ensembler.Ensembler):
             if ensemble is None: continue
             ensembles.append(ensemble)
         
-        # back to where we started
-        os.chdir(owd)
-        
         return ensembles
     
     def subcluster_models_floating_radii(self,
@@ -376,8 +559,7 @@ class AbinitioEnsembler(_ensembler.Ensembler):
                                          ensemble_max_models=None):
         logger.info("subclustering with floating radii")
 
-        clusterer = self.subclusterer_factory(subcluster_program)
-        clusterer.generate_distance_matrix(truncation.models)
+        clusterer = self.subcluster_distance_matrix(truncation, subcluster_program)
         # clusterer.dump_matrix(os.path.join(truncation_dir,"subcluster_distance.matrix")) # for debugging
         
         subclusters = []
@@ -5,23 +5,89 @@ __date__ = "01 Oct 2016"
 __version__ = "1.0"
 
 from collections import namedtuple
-import itertools
 import logging
 import mmtbx.superpose
+import multiprocessing
 import numpy
 import re
 import os
 import shutil
+import tempfile
 
 from ample.util import ample_util
 from ample.util import pdb_edit
+from ample.util.distance_matrix import DistanceMatrix
 
 logger = logging.getLogger()
 
 SCORE_MATRIX_NAME = 'score.matrix'
+SCORE_MATRIX_NPY = 'score_matrix.npy'
 FILE_LIST_NAME = 'files.list'
 RMSD_MAX = 50
 QSCORE_MIN = 0.01
+KABSCH_BLOCK_SIZE = 100
+
+
+def kabsch_rmsd_matrix(coords, block_size=KABSCH_BLOCK_SIZE):
+    """Return the all-by-all rmsd matrix of a set of coordinates after optimal superposition.
+
+    The rmsd after Kabsch superposition can be calculated from the singular values of the covariance matrix
+    of each pair of centred structures, so we calculate the covariance matrices of a block of rows against
+    all following models in one go and never need to construct the rotation matrices themselves.
+
+    Parameters
+    ----------
+    coords : :obj:`numpy.ndarray`
+       (num_models, num_atoms, 3) array of coordinates
+    block_size : int
+       The number of rows of the matrix to calculate at once - limits memory usage to 
+       block_size * num_models 3x3 matrices
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+       A square symmetric (num_models, num_models) matrix of rmsds
+    """
+    num_models, num_atoms, _ = coords.shape
+    coords = coords - coords.mean(axis=1)[:, numpy.newaxis, :]
+    sq_norms = numpy.einsum('ijk,ijk->i', coords, coords)
+    matrix = numpy.zeros([num_models, num_models])
+    for start in range(0, num_models, block_size):
+        stop = min(start + block_size, num_models)
+        # (block, num_models - start, 3, 3) covariance matrices
+        cov = numpy.tensordot(coords[start:stop], coords[start:], axes=([1], [1])).transpose(0, 2, 1, 3)
+        rmsds = _superposed_rmsds(cov, sq_norms[start:stop, numpy.newaxis], sq_norms[numpy.newaxis, start:], num_atoms)
+        matrix[start:stop, start:] = rmsds
+        matrix[start:, start:stop] = rmsds.T
+    numpy.fill_diagonal(matrix, 0.0)
+    return matrix
+
+
+def _superposed_rmsds(cov, sq_norms1, sq_norms2, num_atoms):
+    """Return the rmsds after superposition from the covariance matrices and squared norms of centred coordinates"""
+    singular = numpy.linalg.svd(cov, compute_uv=False)
+    # Correct for reflections so that we only consider proper rotations
+    singular[..., 2] *= numpy.sign(numpy.linalg.det(cov))
+    sq_dev = sq_norms1 + sq_norms2 - 2.0 * singular.sum(axis=-1)
+    return numpy.sqrt(numpy.clip(sq_dev, 0.0, None) / num_atoms)
+
+
+# Holds the subclusterer in each process of a pool created by SubClusterer._pairwise_distance_matrix
+_pair_worker_clusterer = None
+
+
+def _init_pair_worker(clusterer, scratch_dir):
+    """Give each pool process its own copy of the subclusterer with its own scratch directory"""
+    global _pair_worker_clusterer
+    _pair_worker_clusterer = clusterer
+    _pair_worker_clusterer._scratch_dir = tempfile.mkdtemp(prefix='worker_', dir=scratch_dir)
+    return
+
+
+def _pair_worker_row(i):
+    """Return the distances from model i to all models after it in the subclusterer's _model_paths"""
+    num_models = len(_pair_worker_clusterer._model_paths)
+    return i, [_pair_worker_clusterer._pair_distance(i, j) for j in range(i + 1, num_models)]
 
 
 class SubClusterer(object):
@@ -29,20 +95,75 @@ class SubClusterer(object):
     Sub-classes just need to provide a generate_distance_matrix class
     """
     
-    def __init__(self,executable=None, nproc=1):
+    def __init__(self,executable=None, nproc=1, work_dir=None):
         if executable and not os.path.exists(executable) and os.access(executable, os.X_OK):
             msg = "Cannot find subclusterer executable: {0}".format(executable)
             raise RuntimeError(msg)
         self.executable = executable
         self.nproc = nproc
+        # The directory any files are written to and external programs are run in [default: the current directory]
+        self.work_dir = work_dir
         self.distance_matrix = None
         self.index2pdb = []
         self.cluster_score = None
+        self._model_paths = []
+        self._scratch_dir = None
+        self._sweep = None
         return
     
     def generate_distance_matrix(self, *args, **kwargs):
         assert False
 
+    def _directory(self):
+        """Return the absolute path of the work directory"""
+        return os.path.abspath(self.work_dir or os.getcwd())
+
+    def _work_path(self, name):
+        """Return the absolute path of a file in the work directory"""
+        return os.path.join(self._directory(), name)
+
+    def _pair_distance(self, i, j):
+        """Return the distance between models i and j in _model_paths - needed by _pairwise_distance_matrix"""
+        assert False
+
+    def _pairwise_distance_matrix(self):
+        """Return the distance matrix for the models in index2pdb by calling _pair_distance for each pair.
+        
+        Each row of the upper triangle of the matrix is a separate task. The tasks are shared across a pool of
+        nproc processes, each of which has its own scratch directory (_scratch_dir) and keeps its own copy of any
+        data the subclusterer caches for each model. The scratch directories are deleted once the matrix is complete.
+        """
+        num_models = len(self.index2pdb)
+        matrix = DistanceMatrix(num_models, dtype=numpy.float64)
+        # The pairs are run in the scratch directories so need absolute paths to the models
+        self._model_paths = [os.path.abspath(m) for m in self.index2pdb]
+        scratch_dir = tempfile.mkdtemp(prefix='subcluster_pairs_', dir=self._directory())
+        try:
+            if self.nproc > 1 and num_models > 2:
+                pool = multiprocessing.Pool(processes=min(self.nproc, num_models - 1),
+                                            initializer=_init_pair_worker,
+                                            initargs=(self, scratch_dir))
+                try:
+                    rows = pool.imap_unordered(_pair_worker_row, range(num_models - 1))
+                    for i, distances in rows:
+                        matrix.set_row(i, distances)
+                    pool.close()
+                except:
+                    pool.terminate()
+                    raise
+                finally:
+                    pool.join()
+            else:
+                self._scratch_dir = scratch_dir
+                for i in range(num_models - 1):
+                    matrix.set_row(i, [self._pair_distance(i, j) for j in range(i + 1, num_models)])
+        finally:
+            self._scratch_dir = None
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+        
+        # We use a full matrix as it's easier to scan for clusters
+        return matrix.to_square()
+
     def cluster_by_radius(self, radius):
         """Return a list of pdbs clustered by the given radius"""
         if self.distance_matrix is None:
@@ -56,63 +177,97 @@ class SubClusterer(object):
 
     def _cluster_indices(self,thresh):
         """Return the indices of the largest cluster that have distances < thresh.
-        We loop through each row of the distance matrix and for each row (pdb) see
-        how many pdbs are < thresh to this pdb. We return the largest cluster.
+        For each row (pdb) of the distance matrix we count how many pdbs are < thresh to this pdb
+        and return the largest cluster, with the first such row as the centroid.
         """
-        #self.dump_matrix("maxcluster.csv")
-        thresh = float(thresh)
-        
-        # get mask of all elements where condition is true. We exclude 0.0 to ensure we don't get the
-        # index of the model that the row is compared with, as this needs to be the first model in the 
-        # ensemble. This means we would also exclude models that had an rmsd of zero to the centroid, but
-        # as these are likely to be identical (and this occurrence rare), this should be ok
-        condition = numpy.logical_and(self.distance_matrix <= thresh, self.distance_matrix != 0.0)
-        # Array of sums of each row - largest number is a row where most items satisfy condition
-        condition_sum =  sum(condition)
-        # Find all rows that have the maximum of the condition true and then select the first one
-        row_index = numpy.where(condition_sum == numpy.max(condition_sum))[0][0]
-        # Select all values from that row where the condition is true and insert the first index so that
-        # it becomes the centroid of that cluster 
-        max_cluster = numpy.insert(numpy.where(condition[row_index])[0], 0, row_index)
-        
-#             max_cluster = []
-#             len_matrix = len(self.distance_matrix)
-#             for i in range(len_matrix):
-#                 cluster = [i]
-#                 for j in range(len_matrix):
-#                     if self.distance_matrix[i][j] is None or j==i: continue
-#                     if float(self.distance_matrix[i][j]) < thresh:
-#                         cluster.append(j)
-#                 if len(cluster) > len(max_cluster):
-#                     max_cluster = copy.copy(cluster)
-
-        if len(max_cluster) == 1:
-            return None, None
-        else:
-            cluster_score = self.calculate_score(max_cluster)
-            return sorted(max_cluster), cluster_score
+        radii, centroids, sizes = self.radius_sweep()
+        idx = numpy.searchsorted(radii, float(thresh), side='right') - 1
+        if idx < 0: return None, None
+        return self._cluster_members(centroids[idx], radii[idx], sizes[idx])
+
+    def _cluster_members(self, centroid, radius, size):
+        """Return the sorted indices and score of the cluster around centroid under radius"""
+        row = self.distance_matrix[centroid]
+        max_cluster = numpy.where(numpy.logical_and(row <= radius, row != 0.0))[0]
+        assert len(max_cluster) + 1 == size
+        max_cluster = numpy.insert(max_cluster, 0, centroid)
+        cluster_score = self.calculate_score(max_cluster)
+        return sorted(max_cluster), cluster_score
+
+    def radius_sweep(self):
+        """Return the largest cluster for every radius in one pass over the distance matrix.
+
+        The largest cluster only changes at radii equal to one of the distances in the matrix, so we sort
+        all the distances and treat each as an event that adds a model to the cluster centred on its row.
+        The size of the largest cluster after each event is the running maximum of the row counts and the
+        centroid is the first row with that many members, matching the search in _cluster_indices.
+        As in _cluster_indices, distances of 0.0 are excluded so that a model is never counted in its own cluster.
+
+        Returns
+        -------
+        radii : :obj:`numpy.ndarray`
+           The sorted radii at which the largest cluster changes
+        centroids : :obj:`numpy.ndarray`
+           The index of the centroid of the largest cluster for radii >= radii[i]
+        sizes : :obj:`numpy.ndarray`
+           The number of models in the largest cluster (including the centroid) for radii >= radii[i]
+        """
+        if self._sweep is not None and self._sweep[0] is self.distance_matrix: return self._sweep[1]
+        matrix = numpy.asarray(self.distance_matrix, dtype=numpy.float64)
+        num_models = len(matrix)
+        rows, cols = numpy.nonzero(matrix)
+        distances = matrix[rows, cols]
+        order = numpy.argsort(distances, kind='mergesort')
+        distances, rows = distances[order], rows[order]
+        # The number of members of each event's row after the event
+        by_row = numpy.argsort(rows, kind='mergesort')
+        row_starts = numpy.searchsorted(rows[by_row], numpy.arange(num_models))
+        counts = numpy.empty(len(rows), dtype=numpy.int64)
+        counts[by_row] = numpy.arange(len(rows)) - row_starts[rows[by_row]] + 1
+        max_counts = numpy.maximum.accumulate(counts) if len(counts) else counts
+        # Within each stretch of events where the maximum is unchanged, the centroid is the lowest row that
+        # has reached the maximum - encode as max_count * (num_models + 1) + (num_models - row) so that a
+        # running maximum picks it out
+        stride = num_models + 1
+        encoded = max_counts * stride
+        at_max = counts == max_counts
+        encoded[at_max] += num_models - rows[at_max]
+        encoded = numpy.maximum.accumulate(encoded) if len(encoded) else encoded
+        centroids = num_models - encoded % stride
+        sizes = max_counts + 1
+        # Only keep the last event at each radius and those where the largest cluster changes
+        last = numpy.ones(len(distances), dtype=bool)
+        last[:-1] = distances[1:] != distances[:-1]
+        distances, centroids, sizes = distances[last], centroids[last], sizes[last]
+        keep = numpy.ones(len(distances), dtype=bool)
+        keep[1:] = numpy.logical_or(centroids[1:] != centroids[:-1], sizes[1:] != sizes[:-1])
+        sweep = distances[keep], centroids[keep], sizes[keep]
+        self._sweep = (self.distance_matrix, sweep)
+        return sweep
+
+    def radius_for_nmodels(self, nmodels):
+        """Return the smallest radius at which the largest cluster has at least nmodels models.
+
+        If there is no such radius we return the radius at which all models are clustered, or None if no models cluster.
+        """
+        radii, _, sizes = self.radius_sweep()
+        if not len(radii): return None
+        idx = min(numpy.searchsorted(sizes, nmodels, side='left'), len(radii) - 1)
+        return float(radii[idx])
     
     def calculate_score(self, cluster):
         """Given a list of indices of a cluster, calculate the rmsd we want to give to phaser 
         """
         ALL_BY_ALL = True
+        cluster = numpy.asarray(cluster)
         if ALL_BY_ALL:
-            # # Calculate all the rmsds of all decoys in the cluster with each other
-            # rmsds = []
-            # lenc = len(cluster)
-            # for i in range(lenc):
-            #     for j in range(i+1,lenc):
-            #         i1 = cluster[i]
-            #         i2 = cluster[j]
-            #         rmsds.append(self.distance_matrix[i1][i2])
-            rmsds = [ self.distance_matrix[i] for i in itertools.combinations(cluster, 2) ]
+            # The largest rmsd of all decoys in the cluster with each other
+            rmsds = numpy.asarray(self.distance_matrix)[numpy.ix_(cluster, cluster)]
         else:
             # Just use the rmsds of the decoys to the the cluster centroid - assumes
             # the centroid approximates the native
-            row = cluster[0]
-            rmsds = [self.distance_matrix[row][j] for j in cluster[1:]]
-
-        return max(rmsds)
+            rmsds = numpy.asarray(self.distance_matrix)[cluster[0], cluster[1:]]
+        return rmsds.max()
     
     def dump_raw_matrix(self,file_name):
         with open(file_name,'w') as f:
@@ -122,17 +277,21 @@ class SubClusterer(object):
         return
             
     def dump_pdb_matrix(self, file_name=SCORE_MATRIX_NAME, offset=0):
-        with open(file_name,'w') as f:
-            l = len(self.distance_matrix) + offset
-            for i in range(offset, l):
-                for j in range(i, l):
-                    f.write("{0: > 4d} {1: > 4d} {2: > 8.3F}\n".format(i,j, self.distance_matrix[i-offset][j-offset]))
-            f.write("\n")
-        return os.path.abspath(file_name)
+        """Write the distance matrix in the spicker score.matrix format"""
+        return DistanceMatrix.from_square(self.distance_matrix).write_spicker(file_name, offset=offset)
+
+    def save_matrix(self, file_name=SCORE_MATRIX_NPY):
+        """Save the distance matrix as a condensed :obj:`DistanceMatrix` .npy file"""
+        return DistanceMatrix.from_square(self.distance_matrix, dtype=numpy.float64).save(file_name)
 
 
 class CctbxClusterer(SubClusterer):
-    """Class to cluster files with maxcluster"""
+    """Class to cluster files with cctbx"""
+
+    def __init__(self, executable=None, nproc=1, work_dir=None):
+        super(CctbxClusterer, self).__init__(executable=executable, nproc=nproc, work_dir=work_dir)
+        self._structures = {}
+        return
 
     def generate_distance_matrix(self, pdb_list):
         """Run cctbx to generate the distance distance_matrix"""
@@ -147,29 +306,23 @@ class CctbxClusterer(SubClusterer):
         self.index2pdb = pdb_list
      
         # Create a square matrix storing the rmsd distances between models 
-        self.distance_matrix = numpy.zeros([num_models, num_models])
-        for m1, m2 in itertools.combinations(pdb_list, 2):
-            i, j = pdb_list.index(m1), pdb_list.index(m2)
-            fixed = mmtbx.superpose.SuperposePDB(m1, preset='ca', log=None, quiet=True)
-            moving = mmtbx.superpose.SuperposePDB(m2, preset='ca', log=None, quiet=True)
-            rmsd, _ = moving.superpose(fixed)
-            self.distance_matrix[i, j] = self.distance_matrix[j, i] = float(rmsd)
-        
-        # # Might be deleted when confirmed that above code works
-        # for i, m1 in enumerate(pdb_list):
-        #     fixed = mmtbx.superpose.SuperposePDB(m1, preset='ca', log=None, quiet=True)
-        #     for j, m2 in enumerate(pdb_list):
-        #         if j <= i: continue
-        #         moving = mmtbx.superpose.SuperposePDB(m2, preset='ca', log=None, quiet=True)
-        #         rmsd, _ = moving.superpose(fixed)
-        #         self.distance_matrix[i][j] = float(rmsd)
-         
-        # # Copy in other half of matrix - we use a full matrix as it's easier to scan for clusters
-        # for x in range(len(self.distance_matrix)):
-        #     for y in range(len(self.distance_matrix)):
-        #         self.distance_matrix[y][x] = self.distance_matrix[x][y]
+        self._structures = {}
+        try:
+            self.distance_matrix = self._pairwise_distance_matrix()
+        finally:
+            self._structures = {}
         return
 
+    def _pair_distance(self, i, j):
+        rmsd, _ = self._structure(j).superpose(self._structure(i))
+        return float(rmsd)
+
+    def _structure(self, i):
+        """Return the parsed structure for model i, only reading each model once"""
+        if i not in self._structures:
+            self._structures[i] = mmtbx.superpose.SuperposePDB(self._model_paths[i], preset='ca', log=None, quiet=True)
+        return self._structures[i]
+
 
 class FpcClusterer(SubClusterer):
     """Class to cluster files with fast_protein_clusterer"""
@@ -177,7 +330,7 @@ class FpcClusterer(SubClusterer):
     def generate_distance_matrix(self,pdb_list):
         
         # Create list of pdb files
-        fname = os.path.join(os.getcwd(), "files.list" )
+        fname = self._work_path("files.list")
         with open( fname, 'w' ) as f: f.write( "\n".join( pdb_list )+"\n" )
             
         # Index is just the order of the pdb in the file
@@ -186,50 +339,28 @@ class FpcClusterer(SubClusterer):
         # Run fast_protein_cluster - this is just to generate the distance matrix, but there
         # doesn't seem to be a way to stop it clustering as well - not a problem as it just
         # generates more files
-        log_name = os.path.abspath("fast_protein_cluster.log")
-        matrix_file = "fpc.matrix"
+        log_name = self._work_path("fast_protein_cluster.log")
+        matrix_file = self._work_path("fpc.matrix")
         cmd = [self.executable,
                "--cluster_write_text_matrix",
                matrix_file,
                "-i",
                fname]
                
-        retcode = ample_util.run_command( cmd, logfile=log_name )
+        retcode = ample_util.run_command( cmd, logfile=log_name, directory=self._directory() )
         if retcode != 0:
             msg = "non-zero return code for fast_protein_cluster in generate_distance_matrix!\nCheck logfile:{0}".format(log_name)
             logging.critical(msg)
             raise RuntimeError(msg)
 
-        mlen=0
-        data=[]
-        with open(matrix_file) as f:
-            for l in f:
-                l = l.strip().split()
-                x = int(l[0])
-                y = int(l[1])
-                d = float(l[2])
-                mlen = max(mlen,x+1) # +1 as we want the length
-                data.append((x,y,d))
-         
-        # create empty matrix - we use None's but this means we need to check for then when
-        # looking through the matrix
+        data = numpy.loadtxt(matrix_file, usecols=(0, 1, 2), ndmin=2)
+        x = data[:, 0].astype(int)
+        y = data[:, 1].astype(int)
+        mlen = x.max() + 1 # +1 as we want the length
+        m = DistanceMatrix(mlen, dtype=numpy.float64)
+        m.set_pairs(x, y, data[:, 2])
         # use square matrix to make indexing easier as we're unlikely to be very big
-        m = numpy.zeros([mlen, mlen])
-         
-        # Fill in all values (upper triangle)
-        for i,j,d in data:
-            if i > j:
-                m[j][i] = d
-            else:
-                m[i][j] = d
-                 
-        # Copy to lower
-        for x in range(mlen):
-            for y in range(mlen):
-                if x==y: continue
-                m[y][x] = m[x][y]
-                
-        self.distance_matrix = m
+        self.distance_matrix = m.to_square()
         return
 
 
@@ -266,7 +397,7 @@ where inp_list.dat  contains:
         self.index2pdb = models
 
         # Create file with list of pdbs and model/chain
-        glist = 'gesamt_models.dat'
+        glist = self._work_path('gesamt_models.dat')
         with open(glist, 'w') as w:
             for m in models:
                 w.write("{0} -s /1/A \n".format(m))
@@ -274,8 +405,8 @@ where inp_list.dat  contains:
         
         cmd = [ self.executable, '-input-list', glist, '-sheaf-x', '-nthreads={0}'.format(self.nproc)]
 
-        logfile = os.path.abspath('gesamt_archive.log')
-        rtn = ample_util.run_command(cmd, logfile)
+        logfile = self._work_path('gesamt_archive.log')
+        rtn = ample_util.run_command(cmd, logfile, directory=self._directory())
         if rtn != 0: 
             raise RuntimeError("Error running gesamt - check logfile: {0}".format(logfile))
         
@@ -320,7 +451,7 @@ where inp_list.dat  contains:
             raise RuntimeError("All pdb files are not in the same directory!")
         
         # Create list of pdb files
-        fname = os.path.join(os.getcwd(), FILE_LIST_NAME)
+        fname = self._work_path(FILE_LIST_NAME)
         with open(fname, 'w') as f: f.write("\n".join(models)+"\n")
             
         # Index is just the order of the pdb in the file
@@ -329,16 +460,16 @@ where inp_list.dat  contains:
         
         # Make the archive
         logger.debug("Generating gesamt archive from models in directory %s", mdir)
-        garchive = 'gesamt.archive'
+        garchive = self._work_path('gesamt.archive')
         if not os.path.isdir(garchive): os.mkdir(garchive)
-        logfile = os.path.abspath('gesamt_archive.log')
+        logfile = self._work_path('gesamt_archive.log')
         cmd = [ self.executable, '--make-archive', garchive, '-pdb', mdir ]
         #cmd += [ '-nthreads=auto' ]
         cmd += [ '-nthreads={0}'.format(self.nproc) ]
         # HACK FOR DYLD!!!!
         env = None
         #env = {'DYLD_LIBRARY_PATH' : '/opt/ccp4-devtools/install/lib'}
-        rtn = ample_util.run_command(cmd, logfile,env = env )
+        rtn = ample_util.run_command(cmd, logfile, directory=self._directory(), env = env )
         if rtn != 0: 
             raise RuntimeError("Error running gesamt - check logfile: {0}".format(logfile))
         
@@ -352,16 +483,15 @@ where inp_list.dat  contains:
         else: 
             raise RuntimeError("Unrecognised metric: {0}".format(metric))
         
-        #m = [[parity for _ in range(nmodels)] for _ in range(nmodels)]
-        m = numpy.full([nmodels, nmodels], parity)
+        m = DistanceMatrix(nmodels, diagonal=parity, fill=parity, dtype=numpy.float64)
         
         for i, model in enumerate(models):
             mname = os.path.basename(model)
-            gesamt_out = '{0}_gesamt.out'.format(mname)
-            logfile = '{0}_gesamt.log'.format(mname)
+            gesamt_out = self._work_path('{0}_gesamt.out'.format(mname))
+            logfile = self._work_path('{0}_gesamt.log'.format(mname))
             cmd = [ self.executable, model, '-archive', garchive, '-o', gesamt_out ]
             cmd += [ '-nthreads={0}'.format(self.nproc) ]
-            rtn = ample_util.run_command(cmd, logfile)
+            rtn = ample_util.run_command(cmd, logfile, directory=self._directory())
             if rtn != 0: 
                 raise RuntimeError("Error running gesamt!")
             else:
@@ -371,40 +501,22 @@ where inp_list.dat  contains:
             assert gdata[0].file_name == mname, gdata[0].file_name + " " + mname
             score_dict = { g.file_name: (g.rmsd, g.q_score) for g in gdata  }
             
-            for j in range(i + 1, nmodels):
-                # Try and get the rmsd and qscore for this model. If it's missing we assume the model was 
-                # too divergent for gesamt to find it and we set the rmsd and qscore to fixed values
-                model2 = os.path.basename(models[j])
-                try:
-                    rmsd, qscore = score_dict[model2]
-                except KeyError:
-                    rmsd = RMSD_MAX
-                    qscore = QSCORE_MIN
-                
-                if metric == 'rmsd':
-                    score = rmsd
-                elif metric == 'qscore':
-                    score = qscore
-                else: 
-                    raise RuntimeError("Unrecognised metric: {0}".format(metric))
-                
-                m[i][j] = score
+            # Try and get the rmsd and qscore for each model. If it's missing we assume the model was 
+            # too divergent for gesamt to find it and we set the rmsd and qscore to fixed values
+            missing = (RMSD_MAX, QSCORE_MIN)
+            score_idx = 0 if metric == 'rmsd' else 1
+            m.set_row(i, [score_dict.get(os.path.basename(models[j]), missing)[score_idx] for j in range(i + 1, nmodels)])
                 
             if purge_all: os.unlink(gesamt_out)
                     
-        # Copy upper half of matrix to lower
-        for x in range(nmodels):
-            for y in range(nmodels):
-                if x == y: continue
-                m[y][x] = m[x][y]
-                
-        self.distance_matrix = m
+        self.distance_matrix = m.to_square()
 
         # Remove the gesamt archive
         if purge: shutil.rmtree(garchive)
         
-        # Write out the matrix in a form spicker can use
-        self.dump_pdb_matrix(SCORE_MATRIX_NAME)
+        # Write out the matrix in a form spicker can use and save it so that it can be shared
+        m.write_spicker(self._work_path(SCORE_MATRIX_NAME))
+        m.save(self._work_path(SCORE_MATRIX_NPY))
         return
 
     def _parse_gesamt_out(self, out_file):
@@ -435,10 +547,103 @@ where inp_list.dat  contains:
         return data
     
 
+class KabschClusterer(SubClusterer):
+    """Class to cluster files in-process by superposing their CA atoms with numpy
+
+    The whole matrix is a single vectorised calculation so nproc is not used.
+    """
+
+    def generate_distance_matrix(self, pdb_list):
+        """Generate the CA rmsd distance_matrix without running any external programs"""
+
+        num_models = len(pdb_list)
+        if not num_models:
+            msg = "generate_distance_matrix got empty pdb_list!"
+            logging.critical(msg)
+            raise RuntimeError(msg)
+
+        # Index is just the order of the pdb in the file
+        self.index2pdb = pdb_list
+        self.distance_matrix = kabsch_rmsd_matrix(pdb_edit.ca_coordinates(pdb_list))
+        return
+
+
+class ResidueKabschClusterer(KabschClusterer):
+    """Class to cluster truncations of a set of models, reusing per-residue data across truncation levels.
+
+    The covariance matrix between two models is a sum over their residues, so the CA coordinates of the
+    untruncated models are read once and for each truncation level we only add or remove the contribution of
+    the residues that differ from the previous level, rather than re-reading the truncated models and
+    recalculating everything from scratch.
+    """
+
+    def __init__(self, models):
+        super(ResidueKabschClusterer, self).__init__()
+        coords = pdb_edit.ca_coordinates(models)
+        # Centre on the centroid of the untruncated models to keep the accumulated sums small
+        self.coords = coords - coords.mean(axis=1)[:, numpy.newaxis, :]
+        num_models = len(models)
+        self._pairs = numpy.triu_indices(num_models, 1)
+        self._residue_idxs = set()
+        self._cov = numpy.zeros([len(self._pairs[0]), 3, 3])
+        self._sum = numpy.zeros([num_models, 3])
+        self._sq_norms = numpy.zeros(num_models)
+        return
+
+    def generate_distance_matrix(self, pdb_list, residue_idxs=None):
+        """Generate the distance matrix for the models in pdb_list.
+
+        If residue_idxs is given, pdb_list must hold the truncated models created by selecting the residues with
+        those indices from the models this object was created with, and the matrix is derived from the stored
+        per-residue data without reading pdb_list.
+        """
+        if residue_idxs is None:
+            return super(ResidueKabschClusterer, self).generate_distance_matrix(pdb_list)
+
+        num_models, num_residues, _ = self.coords.shape
+        if len(pdb_list) != num_models:
+            msg = "generate_distance_matrix got {0} models but was created with {1}".format(len(pdb_list), num_models)
+            raise RuntimeError(msg)
+        residue_idxs = set(residue_idxs)
+        if not residue_idxs or min(residue_idxs) < 0 or max(residue_idxs) >= num_residues:
+            msg = "Residue indices out of range for models with {0} CA atoms: {1}".format(num_residues, sorted(residue_idxs))
+            raise RuntimeError(msg)
+
+        self._update(residue_idxs - self._residue_idxs, 1.0)
+        self._update(self._residue_idxs - residue_idxs, -1.0)
+        self._residue_idxs = residue_idxs
+
+        # Convert the sums over the residues into the values for coordinates centred on this subset of residues
+        num_atoms = len(residue_idxs)
+        i, j = self._pairs
+        cov = self._cov - numpy.einsum('pa,pb->pab', self._sum[i], self._sum[j]) / num_atoms
+        sq_norms = self._sq_norms - numpy.einsum('ia,ia->i', self._sum, self._sum) / num_atoms
+        rmsds = _superposed_rmsds(cov, sq_norms[i], sq_norms[j], num_atoms)
+
+        self.index2pdb = pdb_list
+        self.distance_matrix = numpy.zeros([num_models, num_models])
+        self.distance_matrix[i, j] = rmsds
+        self.distance_matrix[j, i] = rmsds
+        return
+
+    def _update(self, residue_idxs, sign):
+        """Add (sign=1.0) or remove (sign=-1.0) the contribution of a set of residues to the stored sums"""
+        if not residue_idxs: return
+        xyz = self.coords[:, sorted(residue_idxs)]
+        i, j = self._pairs
+        cov = numpy.tensordot(xyz, xyz, axes=([1], [1])).transpose(0, 2, 1, 3)
+        self._cov += sign * cov[i, j]
+        self._sum += sign * xyz.sum(axis=1)
+        self._sq_norms += sign * numpy.einsum('ijk,ijk->i', xyz, xyz)
+        return
+
+
 class LsqkabClusterer(SubClusterer):
     """Class to cluster files with Lsqkab"""
     
-    def calc_rmsd(self, model1, model2, nresidues=None, logfile='lsqkab.out', purge=False):
+    def calc_rmsd(self, model1, model2, nresidues=None, logfile='lsqkab.out', purge=False, directory=None):
+        """Return the CA rmsd between two models, running lsqkab in directory [default: the current directory]"""
+        if directory: logfile = os.path.join(directory, logfile)
         
         if not nresidues:  _, nresidues = pdb_edit.num_atoms_and_residues(model1, first=True)
         
@@ -449,13 +654,13 @@ end""".format(nresidues, 'A')
 
         cmd = [ 'lsqkab', 'XYZINM', model1, 'XYZINF', model2 ]
         
-        ample_util.run_command(cmd, logfile=logfile, stdin=stdin)
+        ample_util.run_command(cmd, logfile=logfile, stdin=stdin, directory=directory)
         rmsd =  self.parse_lsqkab_output(logfile)
         
         # cleanup 
         if purge:
             os.unlink(logfile)
-            os.unlink('RMSTAB')
+            os.unlink(os.path.join(directory or os.getcwd(), 'RMSTAB'))
         
         return rmsd
                 
@@ -463,35 +668,19 @@ end""".format(nresidues, 'A')
 
         # Index is just the order of the pdb in the file
         self.index2pdb = models
-        num_models = len(models)
         
         # Assume all models are the same size and only have a single chain
         # We also assume that the chain is called 'A' (not relevant here)
-        _, nresidues = pdb_edit.num_atoms_and_residues(models[0], first=True)
-        
-        # Create a square distance_matrix no_models in size filled with None
-        self.distance_matrix = numpy.zeros([num_models, num_models])
+        _, self._nresidues = pdb_edit.num_atoms_and_residues(models[0], first=True)
         
-        logfile='lsqkab.out'
-        parity = 0.0
-        for i, fixed in enumerate(models):
-            for j, model2 in enumerate(models):
-                if j < i: continue
-                if j == i:
-                    rmsd = parity
-                elif j > i:
-                    rmsd = self.calc_rmsd(fixed, model2, nresidues=nresidues, logfile=logfile)
-                self.distance_matrix[i][j] = rmsd
-        
-        # Clean up output files from lsqkab
-        os.unlink(logfile)
-        os.unlink('RMSTAB')
-         
-        # Copy in other half of matrix - we use a full matrix as it's easier to scan for clusters
-        for x in range(len(self.distance_matrix)):
-            for y in range(len(self.distance_matrix)):
-                self.distance_matrix[y][x] = self.distance_matrix[x][y]
+        # Each pair is run in the scratch directory of the process calculating it, so the
+        # lsqkab output files don't clash and are removed with the scratch directories
+        self.distance_matrix = self._pairwise_distance_matrix()
         return
+
+    def _pair_distance(self, i, j):
+        return self.calc_rmsd(self._model_paths[i], self._model_paths[j], nresidues=self._nresidues,
+                              directory=self._scratch_dir)
     
     def parse_lsqkab_output(self, output_file):
         with open(output_file) as f:
@@ -526,23 +715,21 @@ class MaxClusterer(SubClusterer):
         #print 'MAX Done'
         
         # Create the list of files for maxcluster
-        fname = os.path.join(os.getcwd(), FILE_LIST_NAME )
+        fname = self._work_path(FILE_LIST_NAME)
         with open( fname, 'w' ) as f:
             f.write( "\n".join( pdb_list )+"\n" )
             
         #log_name = "maxcluster_radius_{0}.log".format(radius)
-        log_name = os.path.abspath("maxcluster.log")
+        log_name = self._work_path("maxcluster.log")
         cmd = [ self.executable, "-l", fname, "-L", "4", "-rmsd", "-d", "1000", "-bb", "-C0" ]
-        retcode = ample_util.run_command( cmd, logfile=log_name )
+        retcode = ample_util.run_command( cmd, logfile=log_name, directory=self._directory() )
         
         if retcode != 0:
             msg = "non-zero return code for maxcluster in generate_distance_matrix!\nSee logfile: {0}".format(log_name)
             logging.critical(msg)
             raise RuntimeError(msg)
         
-        # Create a square distance_matrix no_models in size filled with None
-        parity = 0.0
-        self.distance_matrix = numpy.full([num_models, num_models], parity)
+        matrix = DistanceMatrix(num_models, dtype=numpy.float64)
 
         #jmht Save output for parsing - might make more sense to use one of the dedicated maxcluster output formats
         #max_log = open(cur_dir+'/MAX_LOG')
@@ -558,7 +745,7 @@ class MaxClusterer(SubClusterer):
                 # 3: path to model 2 without .pdb suffix
                 # 4: distance metric
                 split = re.split('INFO  \: Model\s*(\d*)\s*(.*)\.pdb\s*vs\. Model\s*(\d*)\s*(.*)\.pdb\s*=\s*(\d*\.\d*)', line)
-                self.distance_matrix[  int(split[1]) -1 ][  int(split[3]) -1]  = float(split[5])
+                matrix[int(split[1]) - 1, int(split[3]) - 1] = float(split[5])
     
                 if split[2]+'.pdb' not  in self.index2pdb:
                     self.index2pdb[int(split[1]) -1]  =  split[2]+'.pdb'
@@ -566,9 +753,9 @@ class MaxClusterer(SubClusterer):
                 if split[4]+'.pdb' not  in self.index2pdb:
                     self.index2pdb[int(split[3]) -1]  =  split[4]+'.pdb'
     
-        # Copy in other half of matrix - we use a full matrix as it's easier to scan for clusters
-        for x in range(len(self.distance_matrix)):
-            for y in range(len(self.distance_matrix)):
-                self.distance_matrix[y][x] = self.distance_matrix[x][y]
+        max_log.close()
+        
+        # We use a full matrix as it's easier to scan for clusters
+        self.distance_matrix = matrix.to_square()
         return
 
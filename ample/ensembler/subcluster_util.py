@@ -68,45 +68,21 @@ def slice_subcluster(cluster_files, previous_clusters, ensemble_max_models, radi
     return None
 
 
-def subcluster_nmodels(nmodels, radius, clusterer, direction, increment):
+def subcluster_nmodels(nmodels, radius, clusterer, direction=None, increment=None):
+    """Return the largest cluster with nmodels models and the radius that gives it.
 
-    MINRADIUS = 0.0001
-    MAXRADIUS = 100
-    
+    If the cluster under radius doesn't have nmodels models, we use the clusterer's radius sweep to find the
+    smallest radius that clusters at least nmodels models, rather than stepping the radius up and down.
+    direction and increment are no longer needed and are only kept for compatibility.
+    """
     subcluster_models = clusterer.cluster_by_radius(radius)
     len_models = len(subcluster_models) if subcluster_models else 0
     
-    logger.debug("subcluster nmodels: {0} {1} {2} {3} {4}".format(len_models, nmodels, radius, direction, increment))
-    if len_models == nmodels or radius < MINRADIUS or radius > MAXRADIUS:
-        logger.debug("nmodels: {0} radius: {1}".format(len_models, radius))
-        return subcluster_models, radius
-    
-    def lower_increment(increment):
-        increment = increment / float(10)
-        if increment <= 0.00001: raise RuntimeError, "increment out of bounds"
-        return increment
-    
-    # Am sure the logic could be improved here, but it seems to  work
-    try:
-        if len_models > nmodels:
-            # If we have more models than we want and we are increasing the radius, we've overshot, so we need to
-            # decrease the radius but by a smaller increment
-            # If the radius is the same as the increment, we need to decrease the incrememnt before we subtract it
-            # as both of the above require decreasing the increment we have one test and just change the direction
-            # for the overshoot
-            if direction == 'up' or abs(radius - increment) < 0.0000001:
-                if direction == 'up': direction = 'down'
-                increment = lower_increment(increment)
-            radius -= increment
-        elif len_models < nmodels:
-            if direction == 'down' :
-                direction = 'up'
-                increment = lower_increment(increment)
-            radius += increment
-    except RuntimeError:
-        # Can't get a match so just return what we have
-        logger.debug("subcluster nmodels exceeded increment. Returning: nmodels: {0} radius: {1}".format(len(subcluster_models), radius))
-        return subcluster_models, radius
-        
-    return subcluster_nmodels(nmodels, radius, clusterer, direction, increment)
-
+    logger.debug("subcluster nmodels: {0} {1} {2}".format(len_models, nmodels, radius))
+    if len_models != nmodels:
+        sweep_radius = clusterer.radius_for_nmodels(nmodels)
+        if sweep_radius is not None:
+            radius = sweep_radius
+            subcluster_models = clusterer.cluster_by_radius(radius)
+    logger.debug("nmodels: {0} radius: {1}".format(len(subcluster_models) if subcluster_models else 0, radius))
+    return subcluster_models, radius
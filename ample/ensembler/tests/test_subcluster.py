@@ -1,10 +1,12 @@
 
 import glob
+import numpy
 import os
 import unittest
 from ample import constants
 from ample.ensembler import subcluster
 from ample.util import ample_util
+from ample.util import pdb_edit
 from ample.testing import test_funcs
 
 class Test_1(unittest.TestCase):
@@ -29,6 +31,100 @@ class Test_1(unittest.TestCase):
         ref = ['1_S_00000002.pdb', '1_S_00000004.pdb']
         self.assertItemsEqual(ref,cluster_files1)
     
+    def test_radius_cctbx_nproc(self):
+        # Test we get the same clusters when the pairs are shared across processes
+        radius = 8
+        clusterer = subcluster.CctbxClusterer(nproc=2)
+        pdb_list = [ os.path.join(self.testfiles_dir,"models",pdb) for pdb in ['1_S_00000001.pdb',
+                                                                               '1_S_00000002.pdb',
+                                                                               '1_S_00000003.pdb',
+                                                                               '1_S_00000004.pdb'] ]
+        clusterer.generate_distance_matrix(pdb_list)
+        cluster_files1 = [os.path.basename(x) for x in clusterer.cluster_by_radius(radius)]
+        ref = ['1_S_00000002.pdb', '1_S_00000004.pdb']
+        self.assertItemsEqual(ref,cluster_files1)
+
+    def test_radius_kabsch(self):
+        # Test we can reproduce the cctbx clustering
+        radius = 8
+        clusterer = subcluster.KabschClusterer()
+        pdb_list = [ os.path.join(self.testfiles_dir,"models",pdb) for pdb in ['1_S_00000001.pdb',
+                                                                               '1_S_00000002.pdb',
+                                                                               '1_S_00000003.pdb',
+                                                                               '1_S_00000004.pdb'] ]
+        clusterer.generate_distance_matrix(pdb_list)
+        cluster_files1 = [os.path.basename(x) for x in clusterer.cluster_by_radius(radius)]
+        ref = ['1_S_00000002.pdb', '1_S_00000004.pdb']
+        self.assertItemsEqual(ref,cluster_files1)
+
+    def test_kabsch_rmsd_matrix(self):
+        # A rotated and translated copy of a structure should superpose exactly
+        numpy.random.seed(1)
+        xyz = numpy.random.rand(20, 3) * 10.0
+        theta = 0.5
+        rot = numpy.array([[numpy.cos(theta), -numpy.sin(theta), 0.0],
+                           [numpy.sin(theta), numpy.cos(theta), 0.0],
+                           [0.0, 0.0, 1.0]])
+        moved = numpy.dot(xyz, rot.T) + numpy.array([1.0, -2.0, 3.0])
+        shifted = xyz.copy()
+        shifted[0] += numpy.array([2.0, 0.0, 0.0])
+        coords = numpy.array([xyz, moved, shifted])
+        matrix = subcluster.kabsch_rmsd_matrix(coords, block_size=2)
+        self.assertAlmostEqual(matrix[0, 1], 0.0, 5)
+        self.assertTrue(numpy.allclose(matrix, matrix.T))
+        self.assertTrue(matrix[0, 2] > 0.0 and matrix[0, 2] < numpy.sqrt(4.0 / 20))
+        self.assertAlmostEqual(matrix[0, 2], matrix[1, 2], 5)
+
+    def test_radius_sweep(self):
+        # The sweep should give the same clusters as searching the matrix at each radius
+        numpy.random.seed(2)
+        matrix = numpy.triu(numpy.round(numpy.random.rand(20, 20) * 10.0, 1), 1)
+        matrix = matrix + matrix.T
+        clusterer = subcluster.SubClusterer()
+        clusterer.distance_matrix = matrix
+        radii, centroids, sizes = clusterer.radius_sweep()
+        self.assertTrue(numpy.all(numpy.diff(radii) > 0))
+        self.assertTrue(numpy.all(numpy.diff(sizes) >= 0))
+        for radius in numpy.arange(0.0, 10.5, 0.05):
+            condition = numpy.logical_and(matrix <= radius, matrix != 0.0)
+            counts = condition.sum(axis=1)
+            row = numpy.argmax(counts)
+            indices, score = clusterer._cluster_indices(radius)
+            if counts[row] == 0:
+                self.assertIsNone(indices)
+                continue
+            ref = sorted([row] + list(numpy.where(condition[row])[0]))
+            self.assertEqual(ref, indices)
+            self.assertEqual(matrix[numpy.ix_(ref, ref)].max(), score)
+        for nmodels in range(2, 21):
+            radius = clusterer.radius_for_nmodels(nmodels)
+            self.assertGreaterEqual(len(clusterer._cluster_indices(radius)[0]), nmodels)
+            self.assertLess(len(clusterer._cluster_indices(radius - 0.01)[0] or []), nmodels)
+
+    def test_radius_threshold(self):
+        # A pair exactly at the radius is inside the cluster
+        class Clusterer(subcluster.SubClusterer):
+            def _pair_distance(self, i, j):
+                return 1.1 if i == 0 else 3.3
+        clusterer = Clusterer()
+        clusterer.index2pdb = ['a.pdb', 'b.pdb', 'c.pdb']
+        clusterer.distance_matrix = clusterer._pairwise_distance_matrix()
+        self.assertEqual(clusterer.distance_matrix[0, 1], 1.1)
+        self.assertEqual(clusterer.cluster_by_radius(1.1), ['a.pdb', 'b.pdb', 'c.pdb'])
+        self.assertEqual(clusterer.cluster_by_radius(3.3), ['a.pdb', 'b.pdb', 'c.pdb'])
+        self.assertIsNone(clusterer.cluster_by_radius(1.0))
+
+    def test_residue_kabsch(self):
+        # The matrices derived incrementally should match those calculated from scratch
+        pdb_list = sorted(glob.glob(os.path.join(self.testfiles_dir,"models",'*.pdb')))
+        coords = pdb_edit.ca_coordinates(pdb_list)
+        clusterer = subcluster.ResidueKabschClusterer(pdb_list)
+        for residue_idxs in [range(50), range(5, 30), range(10, 20) + range(40, 45)]:
+            clusterer.generate_distance_matrix(pdb_list, residue_idxs=residue_idxs)
+            ref = subcluster.kabsch_rmsd_matrix(coords[:, residue_idxs])
+            self.assertTrue(numpy.allclose(ref, clusterer.distance_matrix))
+            self.assertEqual(pdb_list, clusterer.index2pdb)
+
     @unittest.skipUnless(test_funcs.found_exe("gesamt" + ample_util.EXE_EXT), "gesamt exec missing")
     def test_gesamt_matrix_generic(self):
         # Test we can reproduce the original thresholds
@@ -4,7 +4,9 @@
 @author: hlasimpk
 """
 
+import numpy
 import unittest
+from ample.ensembler import subcluster
 from ample.ensembler import subcluster_util
 
 class Test(unittest.TestCase):
@@ -96,6 +98,25 @@ class Test(unittest.TestCase):
         pdbs = subcluster_util.pick_nmodels(models, clusters, 30)
         ref_pdbs = None
         self.assertEqual(ref_pdbs, pdbs)
+
+    def test_subclusterNmodels(self):
+        clusterer = subcluster.SubClusterer()
+        clusterer.index2pdb = ['model_{0}.pdb'.format(i) for i in range(5)]
+        clusterer.distance_matrix = numpy.array([[0.0, 1.0, 2.0, 3.0, 4.0],
+                                                 [1.0, 0.0, 1.5, 2.5, 5.0],
+                                                 [2.0, 1.5, 0.0, 6.0, 6.0],
+                                                 [3.0, 2.5, 6.0, 0.0, 6.0],
+                                                 [4.0, 5.0, 6.0, 6.0, 0.0]])
+        pdbs, radius = subcluster_util.subcluster_nmodels(3, 0.5, clusterer, direction='up', increment=1)
+        self.assertEqual(['model_0.pdb', 'model_1.pdb', 'model_2.pdb'], pdbs)
+        self.assertEqual(1.5, radius)
+        pdbs, radius = subcluster_util.subcluster_nmodels(3, 2.0, clusterer, direction='up', increment=1)
+        self.assertEqual(['model_0.pdb', 'model_1.pdb', 'model_2.pdb'], pdbs)
+        self.assertEqual(2.0, radius)
+        self.assertEqual(2.0, clusterer.cluster_score)
+        pdbs, radius = subcluster_util.subcluster_nmodels(5, 0.5, clusterer, direction='up', increment=1)
+        self.assertEqual(5, len(pdbs))
+        self.assertEqual(4.0, radius)
         
 if __name__ == "__main__":
     unittest.main()
@@ -342,6 +342,8 @@ class Truncator(object):
         self.aligned_models = None
         self.truncations = None
         self.theseus_exe = None
+        # Optional StageCache for the variances and truncated models
+        self.stage_cache = None
         
         # We keep these for bookeeping as they go in the ample dictionary
         self.truncation_levels =  None
@@ -371,8 +373,15 @@ class Truncator(object):
         os.chdir(self.work_dir)
         
         self.models = models
+        # The theseus variances of the same models may be in the stage cache
+        var_by_res = None
+        cache_key = None
+        if self.stage_cache and truncation_method != "scores" and not homologs:
+            cache_key = self.stage_cache.key('variances', models)
+            var_by_res = self.stage_cache.get('variances', cache_key)
+        
         # Calculate variances between pdb and align them (we currently only require the aligned models for homologs)
-        if truncation_method != "scores":
+        if truncation_method != "scores" and var_by_res is None:
             run_theseus = theseus.Theseus(work_dir=self.work_dir, theseus_exe=self.theseus_exe)
             try:
                 run_theseus.superpose_models(self.models, homologs=homologs, alignment_file=alignment_file)
@@ -398,8 +407,11 @@ class Truncator(object):
                 return []
         
         # No THESEUS variances required if scores for each residue provided
-        var_by_res = run_theseus.var_by_res if truncation_method != "scores" \
-            else self._convert_residue_scores(residue_scores)
+        if truncation_method == "scores":
+            var_by_res = self._convert_residue_scores(residue_scores)
+        elif var_by_res is None:
+            var_by_res = run_theseus.var_by_res
+            if cache_key and var_by_res: self.stage_cache.put('variances', cache_key, var_by_res)
             
         if not len(var_by_res) > 0:
             msg = "Error reading residue variances!"
@@ -467,6 +479,20 @@ class Truncator(object):
                         alignment_file=None,
                         work_dir=None):
         """Generate a set of Truncation objects, referencing a set of truncated models generated from the supplied models"""
+        cache_key = None
+        if self.stage_cache and not homologs:
+            cache_key = self.stage_cache.key('truncate',
+                                             models,
+                                             truncation_method=truncation_method,
+                                             percent_truncation=percent_truncation,
+                                             truncation_pruning=truncation_pruning,
+                                             residue_scores=residue_scores)
+            cached = self.stage_cache.get('truncate', cache_key, out_dir=self.work_dir)
+            if cached is not None:
+                logger.info('Using truncated models from stage cache')
+                self.models = models
+                self.truncations, self.truncation_levels, self.truncation_variances, self.truncation_nresidues = cached
+                return self.truncations
         truncations = self.calculate_truncations(models=models,
                                                  truncation_method=truncation_method,
                                                  percent_truncation=percent_truncation,
@@ -485,12 +511,20 @@ class Truncator(object):
             os.mkdir(truncation.directory)
             logger.info('Truncating at: {0} in directory {1}'.format(truncation.level, truncation.directory))
             truncation.models = []
-            for infile in self.models:
+        # Read each model once, creating the truncated models for all truncation levels from it
+        for infile in self.models:
+            selections = []
+            for truncation in truncations:
                 pdbout = ample_util.filename_append(infile, str(truncation.level), directory=truncation.directory)
-                # Loop through PDB files and create new ones that only contain the residues left after truncation
-                pdb_edit.select_residues(pdbin=infile, pdbout=pdbout, tokeep_idx=truncation.residues_idxs)
+                selections.append((pdbout, truncation.residues_idxs))
                 truncation.models.append(pdbout)
+            pdb_edit.select_residues_multiple(infile, selections)
         self.truncations = truncations
+        if cache_key:
+            self.stage_cache.put('truncate',
+                                 cache_key,
+                                 (truncations, self.truncation_levels, self.truncation_variances, self.truncation_nresidues),
+                                 out_dir=self.work_dir)
         return truncations
 
     @staticmethod
@@ -23,6 +23,7 @@ from ample.util import mrbump_util
 from ample.util import options_processor
 from ample.util import pdb_edit
 from ample.util import pyrvapi_results
+from ample.util import results_store
 from ample.util import workers_util
 from ample.util import version
 
@@ -119,7 +120,9 @@ class Ample(object):
         amopt.write_config_file()
         # Flag to show that we reached the end without error - useful for integration testing
         amopt.d['AMPLE_finished'] = True
-        ample_util.save_amoptd(amopt.d)
+        # Write the complete dictionary to the results file, including any options that weren't saved with the step
+        # that set them, and empty the journal
+        results_store.results_store(amopt.d['results_path']).compact(amopt.d)
 
         logger.info("AMPLE finished at: {0}".format(
             time.strftime("%a, %d %b %Y %H:%M:%S", time.gmtime())))
@@ -136,8 +139,8 @@ class Ample(object):
 
     def benchmarking(self, optd):
         if optd['submit_cluster']:
-            # Pickle dictionary so it can be opened by the job to get the parameters
-            ample_util.save_amoptd(optd)
+            # The steps have saved what they set, so this only writes anything if nothing has been saved yet
+            ample_util.save_amoptd(optd, keys=[])
             script = benchmark_util.cluster_script(optd)
             workers_util.run_scripts(job_scripts=[script],
                                      monitor=monitor,
@@ -153,7 +156,7 @@ class Ample(object):
             optd.update(ample_util.read_amoptd(optd['results_path']))
         else:
             benchmark_util.analyse(optd)
-            ample_util.save_amoptd(optd)
+            ample_util.save_amoptd(optd, keys=benchmark_util.AMOPTD_KEYS)
 
         return
 
@@ -173,14 +176,14 @@ class Ample(object):
 
             # Check we have some models to work with
             if not (optd['single_model_mode'] or optd['models']):
-                ample_util.save_amoptd(optd)
+                ample_util.save_amoptd(optd, keys=['models'])
                 msg = "ERROR! Cannot find any pdb files in: {0}".format(
                     optd['models_dir'])
                 exit_util.exit_error(msg)
             optd['ensemble_ok'] = os.path.join(optd['work_dir'], 'ensemble.ok')
             if optd['submit_cluster']:
-                # Pickle dictionary so it can be opened by the job to get the parameters
-                ample_util.save_amoptd(optd)
+                # Save the options the job needs that were set here
+                ample_util.save_amoptd(optd, keys=['models', 'ensemble_ok'])
                 script = ensembler.cluster_script(optd)
                 workers_util.run_scripts(job_scripts=[script],
                                          monitor=monitor,
@@ -214,7 +217,7 @@ class Ample(object):
                 logger.info(ensemble_summary)
 
         # Save the results
-        ample_util.save_amoptd(optd)
+        ample_util.save_amoptd(optd, keys=ensembler.AMOPTD_KEYS)
 
         # Bail here if we didn't create anything
         if not len(optd['ensembles']):
@@ -309,7 +312,7 @@ class Ample(object):
                     msg = "Error running ROSETTA to create models: {0}".format(
                         e)
                     exit_util.exit_error(msg, sys.exc_info()[2])
-                if not pdb_edit.check_pdb_directory(optd['models_dir'], sequence=optd['sequence']):
+                if not pdb_edit.check_pdb_directory(optd['models_dir'], sequence=optd['sequence'], nproc=optd['nproc']):
                     msg = "Problem with rosetta pdb files - please check the log for more information"
                     exit_util.exit_error(msg)
                 msg = 'Modelling complete - models stored in: {0}\n'.format(
@@ -343,7 +346,9 @@ class Ample(object):
                 optd['models'], 'pdb', mode=optd['subselect_mode'], **optd)
 
         # Save the results
-        ample_util.save_amoptd(optd)
+        ample_util.save_amoptd(optd, keys=['frags_3mers', 'frags_9mers', 'psipred_ss2', 'contacts_dir', 'contact_file',
+                                           'contact_format', 'contact_map', 'contact_ppv', 'restraints_file', 'models',
+                                           'use_scwrl', 'side_chain_treatments'])
 
         return
 
@@ -387,18 +392,28 @@ class Ample(object):
                                                                     ensemble_options=optd['ensemble_options'],
                                                                     directory=bump_dir)
 
+        # Collect the results incrementally so each poll only looks at jobs that haven't finished
+        results_collector = mrbump_util.ResultsCollector(optd['mrbump_dir'], purge=optd['purge'])
+
         # Create function for monitoring jobs - static function decorator?
         if self.ample_output:
             def monitor():
-                r = mrbump_util.ResultsSummary()
-                r.extractResults(optd['mrbump_dir'], purge=optd['purge'])
-                optd['mrbump_results'] = r.results
+                changed = results_collector.poll()
+                if changed:
+                    optd['mrbump_results'] = results_collector.results
+                    # Checkpoint just the results for the jobs that have changed
+                    results_store.results_store(optd['results_path']).update_rows(
+                        'mrbump_results', 'ensemble_name',
+                        [r for r in results_collector.results if r['ensemble_name'] in changed])
                 return self.ample_output.display_results(optd)
         else:
             monitor = None
 
         # Save results here so that we have the list of scripts and mrbump directory set
-        ample_util.save_amoptd(optd)
+        ample_util.save_amoptd(optd, keys=['mrbump_dir', 'mrbump_results', 'mrbump_scripts', 'ensemble_options'])
+
+        # Re-rank the queued jobs as results come in so that we get to a solution sooner
+        priority = mrbump_util.JobPrioritiser(optd['mrbump_scripts'], optd.get('ensembles_data'))
 
         # Change to mrbump directory before running
         os.chdir(optd['mrbump_dir'])
@@ -406,6 +421,7 @@ class Ample(object):
                                       monitor=monitor,
                                       check_success=mrbump_util.checkSuccess,
                                       early_terminate=optd['early_terminate'],
+                                      priority=priority,
                                       nproc=optd['nproc'],
                                       job_time=mrbump_util.MRBUMP_RUNTIME,
                                       job_name='mrbump',
@@ -413,7 +429,8 @@ class Ample(object):
                                       submit_qtype=optd['submit_qtype'],
                                       submit_queue=optd['submit_queue'],
                                       submit_array=optd['submit_array'],
-                                      submit_max_array=optd['submit_max_array'])
+                                      submit_max_array=optd['submit_max_array'],
+                                      submit_pack=optd['submit_pack'])
 
         if not ok:
             msg = "Error running MRBUMP on the ensembles!\nCheck logs in directory: {0}".format(
@@ -421,12 +438,11 @@ class Ample(object):
             exit_util.exit_error(msg)
 
         # Collect the MRBUMP results
-        results_summary = mrbump_util.ResultsSummary()
-        optd['mrbump_results'] = results_summary.extractResults(
-            optd['mrbump_dir'], purge=optd['purge'])
-        optd['success'] = results_summary.success
+        results_collector.poll()
+        optd['mrbump_results'] = results_collector.results
+        optd['success'] = results_collector.success
 
-        ample_util.save_amoptd(optd)
+        ample_util.save_amoptd(optd, keys=['mrbump_results', 'success'])
 
         # Now print out the final summary
         summary = mrbump_util.finalSummary(optd)
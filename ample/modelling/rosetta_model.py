@@ -768,7 +768,8 @@ class RosettaModel(object):
                                         submit_qtype=self.submit_qtype,
                                         submit_queue=self.submit_queue,
                                         submit_array=self.submit_array,
-                                        submit_max_array=self.submit_max_array)
+                                        submit_max_array=self.submit_max_array,
+                                        submit_pack=self.submit_pack)
 
     def setup_domain_restraints(self):
         """
@@ -904,6 +905,7 @@ class RosettaModel(object):
             self.submit_queue = optd['submit_queue']
             self.submit_array = optd['submit_array']
             self.submit_max_array = optd['submit_max_array']
+            self.submit_pack = optd['submit_pack']
         return
 
     def set_paths(self,optd=None,rosetta_dir=None):
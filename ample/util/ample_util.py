@@ -4,7 +4,6 @@ __author__ = "Jens Thomas, and Felix Simkovic"
 __date__ = "01 Jan 2016"
 __version__ = "1.0"
 
-import cPickle
 import glob
 import logging
 import os
@@ -18,6 +17,7 @@ import zipfile
 
 import exit_util
 import pdb_edit
+import results_store
 
 from ample.constants import SHARE_DIR, AMPLEDIR, I2DIR
 
@@ -253,14 +253,25 @@ def extract_models(amoptd, sequence=None, single=True, allsame=True):
     -----------
     Check a directory of pdbs or extract pdb files from a given tar/zip file or directory of pdbs
     and set the amoptd['models_dir'] entry with the directory of unpacked/validated pdbs
+
+    The pdbs are checked in parallel on amoptd['nproc'] processors while they are being extracted,
+    and checking stops at the first invalid pdb.
     """
 
     filename = amoptd['models']
     models_dir = amoptd['models_dir']
+    checker = pdb_edit.PdbChecker(sequence=sequence, single=single, allsame=allsame,
+                                  nproc=amoptd.get('nproc', 1), fail_fast=True)
 
     # If it's already a models_dir, just check it's valid
     if os.path.isdir(filename):
         models_dir = filename
+        models = glob.glob(os.path.join(models_dir, "*.pdb"))
+        if not len(models):
+            msg = "Cannot find any pdb files in directory: {0}".format(models_dir)
+            exit_util.exit_error(msg)
+        for pdb in models:
+            if not checker.add(pdb): break
     else:
         # Here we are extracting from a file
         if not os.path.isfile(filename):
@@ -286,10 +297,17 @@ def extract_models(amoptd, sequence=None, single=True, allsame=True):
             msg = "Do not know how to extract files from file: {0}\n " \
                   "Acceptable file types are: {1}".format(filename, suffixes)
             exit_util.exit_error(msg)
+        # Start checking the files as they are extracted. A single file could be a set of QUARK decoys, so the
+        # first file is only checked once a second one has been found.
+        extracted = []
+        def check(pdb):
+            extracted.append(pdb)
+            if len(extracted) == 2: checker.add(extracted[0])
+            if len(extracted) >= 2: checker.add(pdb)
         if suffix in tar_suffixes:
-            files = extract_tar(filename, models_dir)
+            files = extract_tar(filename, models_dir, callback=check)
         else:
-            files = extract_zip(filename, models_dir)
+            files = extract_zip(filename, models_dir, callback=check)
 
         # Assume anything with one member is quark decoys
         if len(files) == 1:
@@ -301,15 +319,18 @@ def extract_models(amoptd, sequence=None, single=True, allsame=True):
                 msg += "If this file contains valid QUARK decoys, please email: ccp4@stfc.ac.uk"
                 exit_util.exit_error(msg)
             # Now extract the quark pdb files from the monolithic file
-            split_quark(files[0], models_dir)
+            models = split_quark(files[0], models_dir)
             # We delete the quark_name file as otherwise we'll try and model it
             os.unlink(files[0])
+            for pdb in models:
+                if not checker.add(pdb): break
             # If we've got quark models we don't want to modify the side chains as we only have polyalanine so we
             # set this here - horribly untidy as we should have one place to decide on side chains
             logger.info('Found QUARK models in file: %s', filename)
             amoptd['quark_models'] = True
     
-    if not pdb_edit.check_pdb_directory(models_dir, sequence=sequence, single=single, allsame=allsame):
+    logger.info("Checking pdbs in directory: {0}".format(models_dir))
+    if not checker.finish():
         msg = "Problem importing pdb files - please check the log for more information"
         exit_util.exit_error(msg)
     
@@ -317,7 +338,7 @@ def extract_models(amoptd, sequence=None, single=True, allsame=True):
     return glob.glob(os.path.join(models_dir, "*.pdb"))
 
 
-def extract_tar(filename, directory, suffixes=['.pdb']):
+def extract_tar(filename, directory, suffixes=['.pdb'], callback=None):
     # Extracting tarfile
     logger.info('Extracting files from tarfile: %s', filename)
     files = []
@@ -332,13 +353,14 @@ def extract_tar(filename, directory, suffixes=['.pdb']):
                 m.name = os.path.basename(m.name)
                 tf.extract(m, path=directory)
                 files.append(os.path.join(directory, m.name))
+                if callback: callback(files[-1])
     if not len(files):
         msg='Could not find any files with suffixes {0} in archive: {1}'.format(suffixes, filename)
         exit_util.exit_error(msg)
     return files
 
 
-def extract_zip(filename, directory, suffixes=['.pdb']):
+def extract_zip(filename, directory, suffixes=['.pdb'], callback=None):
     # zip file extraction
     logger.info('Extracting files from zipfile: %s', filename)
     if not zipfile.is_zipfile(filename):
@@ -356,6 +378,7 @@ def extract_zip(filename, directory, suffixes=['.pdb']):
             f.filename = os.path.basename(f.filename)
             zipf.extract(f, path=directory)
             files.append(os.path.join(directory, f.filename))
+            if callback: callback(files[-1])
     if not len(files):
         msg = 'Could not find any files with suffixes {0} in zipfile: {1}'.format(suffixes,filename)
         exit_util.exit_error(msg)
@@ -594,25 +617,31 @@ def run_command(cmd, logfile=None, directory=None, dolog=True, stdin=None, check
 
 
 def read_amoptd(amoptd_fname):
-    """Read a PICKLE-formatted AMPLE options file
+    """Read an AMPLE options file written by save_amoptd
+
+    This includes the options saved to the journal since the file was last written in full, so should be used
+    rather than reading the file with cPickle.
 
     Parameters
     ----------
     amoptd_fname : str
-       The path to the PICKLE-formatted AMPLE options file
+       The path to the AMPLE options file
 
     Returns
     -------
     amoptd : dict
        AMPLE options from saved state
 
+    See Also
+    --------
+    results_store
+
     """
     if not is_file(amoptd_fname):
         raise RuntimeError("Cannot access AMPLE options file: {0}\n".format(amoptd_fname))
 
-    with open(amoptd_fname, 'r') as f:
-        amoptd = cPickle.load(f)
-        logger.info("Loaded state from file: %s\n", amoptd['results_path'])
+    amoptd = results_store.results_store(amoptd_fname).read()
+    logger.info("Loaded state from file: %s\n", amoptd['results_path'])
     return amoptd
 
 
@@ -634,19 +663,27 @@ def saveAmoptd(*args):
     return
 
 
-def save_amoptd(amoptd):
-    """Save AMPLE options to a PICKLE-formatted file
+def save_amoptd(amoptd, keys=None):
+    """Save AMPLE options to the results journal
+
+    Only the options that have changed since they were last saved are written. If keys are given, only those
+    options are checked after the first save, so each step should pass the keys it sets.
 
     Parameters
     ----------
     amoptd : dict
        AMPLE options from saved state
+    keys : list, optional
+       Only save these options
+
+    See Also
+    --------
+    results_store
 
     """
     # Save results
-    with open(amoptd['results_path'], 'w') as f:
-        cPickle.dump(amoptd, f)
-        logger.info("Saved state as file: %s\n", amoptd['results_path'])
+    nchanged = results_store.results_store(amoptd['results_path']).save(amoptd, keys=keys)
+    logger.info("Saved %d changed options to file: %s\n", nchanged, amoptd['results_path'])
     return
 
 
@@ -66,6 +66,9 @@ def add_cluster_submit_options(parser=None):
     submit_group.add_argument('-submit_max_array', type=int,
                               help='The maximum number of jobs to run concurrently with SGE array job submission')
 
+    submit_group.add_argument('-submit_pack', type=int,
+                              help='Cluster submission: run this many scripts in each cluster job to cut the time spent waiting in the queue')
+
     submit_group.add_argument('-submit_num_array_jobs', type=int,
                               help='The number of jobs to run concurrently with SGE array job submission')
 
@@ -8,6 +8,7 @@ Created on 24 Oct 2014
 import copy
 import glob
 import logging
+import multiprocessing
 import os
 import pandas as pd
 import shutil
@@ -31,8 +32,14 @@ logger = logging.getLogger(__name__)
 _oldroot = None
 _newroot = None
 _MAXCLUSTERER = None
+# The keys of the AMPLE dictionary that are set by analyse
+AMOPTD_KEYS = ['benchmark_results', 'res_seq_map', 'ref_model_pdb_info', 'tmComp']
 SHELXE_STEM = 'shelxe'
 
+# Set in each process that analyses the MR solutions
+_worker_amoptd = None
+_worker_mrinfo = None
+
 _CSV_KEYLIST = [
     'ample_version',
 
@@ -222,10 +229,12 @@ def analyse(amoptd, newroot=None):
                 'native_pdb_space_group', 'native_pdb_num_chains', 'native_pdb_num_atoms', 'native_pdb_num_residues'
             ]
             d.update({key: amoptd[key] for key in native_keys})
-            # Analyse the solution
-            analyseSolution(amoptd, d, mrinfo)
         data.append(d)
 
+    if amoptd['native_pdb']:
+        # Analyse the solutions
+        data = analyseSolutions(amoptd, data, mrinfo, nproc=amoptd['nproc'] if 'nproc' in amoptd else 1)
+
     # Put everything in a pandas DataFrame
     dframe = pd.DataFrame(data)
 
@@ -299,7 +308,7 @@ def analyseModels(amoptd):
 
     if amoptd['have_tmscore']:
         try:
-            tm = tm_util.TMscore(amoptd['tmscore_exe'], wdir=fixpath(amoptd['benchmark_dir']))
+            tm = tm_util.TMscore(amoptd['tmscore_exe'], wdir=fixpath(amoptd['benchmark_dir']), nproc=amoptd['nproc'])
             # Calculation of TMscores for all models
             logger.info("Analysing Rosetta models with TMscore")
             model_list = sorted(glob.glob(os.path.join(amoptd['models_dir'], "*pdb")))
@@ -383,7 +392,59 @@ def analysePdb(amoptd):
     return
 
 
-def analyseSolution(amoptd, d, mrinfo):
+def analyseSolutions(amoptd, data, mrinfo, nproc=1):
+    """Analyse the solutions across a pool of nproc processes, returning the results in the same order
+
+    Each process works in its own directory under the benchmark directory with its own copy of mrinfo, and each
+    solution is analysed in its own scratch directory, so that the programs run for different solutions do
+    not overwrite each other's files.
+    """
+    nproc = min(nproc, len(data))
+    initargs = (amoptd, mrinfo, _oldroot, _newroot)
+    if nproc > 1:
+        logger.info("Benchmark: analysing {0} results on {1} processors".format(len(data), nproc))
+        pool = multiprocessing.Pool(nproc, initializer=_init_worker, initargs=initargs)
+        try:
+            data = pool.map(_analyse_solution, data, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(*initargs)
+        data = map(_analyse_solution, data)
+    for work_dir in glob.glob(os.path.join(fixpath(amoptd['benchmark_dir']), 'worker_*')):
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return data
+
+
+def _init_worker(amoptd, mrinfo, oldroot, newroot):
+    global _oldroot, _newroot, _worker_amoptd, _worker_mrinfo
+    _oldroot, _newroot = oldroot, newroot
+    _worker_amoptd = amoptd
+    work_dir = os.path.join(fixpath(amoptd['benchmark_dir']), 'worker_{0}'.format(os.getpid()))
+    if not os.path.isdir(work_dir): os.mkdir(work_dir)
+    _worker_mrinfo = mrinfo.copy(work_dir)
+
+
+def _analyse_solution(d):
+    cwd = os.getcwd()
+    scratch_dir = os.path.join(_worker_mrinfo.work_dir, d['ensemble_name'])
+    if not os.path.isdir(scratch_dir): os.mkdir(scratch_dir)
+    os.chdir(scratch_dir)
+    try:
+        analyseSolution(_worker_amoptd, d, _worker_mrinfo, work_dir=scratch_dir)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    return d
+
+
+def analyseSolution(amoptd, d, mrinfo, work_dir=None):
+    """Analyse a single MR solution, adding the results to d
+
+    Any intermediate files are written to work_dir, which defaults to the benchmark directory.
+    """
+    if work_dir is None: work_dir = fixpath(amoptd['benchmark_dir'])
 
     logger.info("Benchmark: analysing result: {0}".format(d['ensemble_name']))
 
@@ -455,7 +516,7 @@ def analyseSolution(amoptd, d, mrinfo):
                                placedPdbInfo=mrPdbInfo,
                                refModelPdbInfo=amoptd['ref_model_pdb_info'],
                                cAlphaOnly=True,
-                               workdir=fixpath(amoptd['benchmark_dir']))
+                               workdir=work_dir)
                 d['reforigin_RMSD']=rmsder.rmsd
             except Exception,e:
                 logger.critical("Error calculating RMSD: {0}".format(e))
@@ -467,7 +528,7 @@ def analyseSolution(amoptd, d, mrinfo):
                                           mrPdbInfo=mrPdbInfo,
                                           nativePdbInfo=amoptd['native_pdb_info'],
                                           resSeqMap=amoptd['res_seq_map'],
-                                          workdir=fixpath(amoptd['benchmark_dir'])
+                                          workdir=work_dir
                                           )
         
             # Set attributes
@@ -600,4 +661,4 @@ if __name__ == "__main__":
     logger.addHandler(fl)
 
     analyse(amoptd)
-    ample_util.save_amoptd(amoptd)
+    ample_util.save_amoptd(amoptd, keys=AMOPTD_KEYS)
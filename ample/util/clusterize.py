@@ -8,6 +8,7 @@
 
 import logging
 import os
+import pipes
 import subprocess
 import shlex
 import shutil
@@ -18,13 +19,39 @@ if not "CCP4" in sorted(os.environ.keys()):
 
 logger = logging.getLogger(__name__)
 
+# Suffix of the sentinel file holding the exit code that is written when a job script completes
+SENTINEL_SUFFIX = ".done"
+# Range of intervals in seconds between checks for sentinel files. The interval is reset to the minimum whenever
+# a job completes and increases by POLL_BACKOFF each time nothing has changed.
+POLL_MIN = 2
+POLL_MAX = 30
+POLL_BACKOFF = 1.5
+# Minimum interval in seconds between queries of the queueing system while jobs are running
+QUEUE_POLL_INTERVAL = 60
+# Maximum interval in seconds between calls to the monitor function
+MONITOR_INTERVAL = 60
+# Number of jobs submitted by each call to the shell
+SUBMIT_BATCH_SIZE = 50
+
+def sentinel_file(script):
+    """Return the path of the sentinel file written when the job script completes"""
+    return os.path.splitext(script)[0] + SENTINEL_SUFFIX
+
+def sentinel_command(script):
+    """Return the line of shell script that writes the sentinel file for script when the shell exits"""
+    return "trap 'echo $? > {0}' EXIT\n".format(pipes.quote(sentinel_file(script)))
+
 class ClusterRun:
 
     def __init__(self):
 
         self.qList=[]
-        self.runningQueueList=[]
+        self.runningQueueList=set()
         self.QTYPE=""
+        
+        # The scripts that will write sentinel files and those we are still waiting for
+        self._scripts = set()
+        self._remaining = set()
 
         self.modeller = None
 
@@ -126,7 +153,7 @@ JOBID   USER    STAT  QUEUE      FROM_HOST   EXEC_HOST   JOB_NAME   SUBMIT_TIME
                 command_line='bjobs -u ' + user
 
         log_lines=[]
-        self.runningQueueList=[]
+        self.runningQueueList=set()
 
         process_args = shlex.split(command_line)
         p = subprocess.Popen(process_args, stdout = subprocess.PIPE)
@@ -149,35 +176,75 @@ JOBID   USER    STAT  QUEUE      FROM_HOST   EXEC_HOST   JOB_NAME   SUBMIT_TIME
             if self.QTYPE=="SGE":
                 log_lines.pop(0)
             for i in log_lines:
-                self.runningQueueList.append(i.split()[0])
+                if i: self.runningQueueList.add(i.split()[0])
+        return
+
+    def trackScripts(self, scripts):
+        """Remove any old sentinel files for the job scripts so that monitorQueue can watch for them being written"""
+        for script in scripts:
+            sentinel = sentinel_file(script)
+            if os.path.isfile(sentinel): os.unlink(sentinel)
+        self._scripts.update(scripts)
+        self._remaining.update(scripts)
         return
 
+    def _pollSentinels(self):
+        """Return the number of tracked jobs that have written their sentinel file since the last call"""
+        finished = set()
+        for script in self._remaining:
+            sentinel = sentinel_file(script)
+            if not os.path.isfile(sentinel): continue
+            finished.add(script)
+            with open(sentinel) as f: code = f.read().strip()
+            if code and code != "0":
+                logger.critical("Job {0} failed with exit code {1}".format(script, code))
+        self._remaining -= finished
+        return len(finished)
+
     def monitorQueue(self, user="",monitor=None):
-        """ Monitor the Cluster queue to see when all jobs are completed """
+        """ Monitor the Cluster queue to see when all jobs are completed
+        
+        Jobs submitted with submitArrayJob or submitJobs write a sentinel file when they complete, which we check for
+        at intervals between POLL_MIN and POLL_MAX seconds, so that short jobs are noticed quickly. The queueing system
+        is only queried every QUEUE_POLL_INTERVAL seconds to catch jobs that were killed before they could write their
+        sentinel file, or when all the sentinel files have been written, to make sure the jobs have left the queue.
+        """
 
         if not len(self.qList):
             raise RuntimeError,"No jobs found in self.qList!"
 
         logger.info("Jobs submitted to cluster queue, awaiting their completion...")
 
-        # set a holder for the qlist
-        runningList=self.qList
-        newRunningList=[]
-
-        while runningList!=[]:
-            #print "runningList is ",runningList
-            time.sleep(60)
-            self.getRunningJobList(user)
-            for job in runningList:
-                if str(job) in self.runningQueueList:
-                    newRunningList.append(job)
-            if len(runningList) > len(newRunningList):
-                logger.info("Queue Monitor: %d out of %d jobs remaining in cluster queue..." %  (len(newRunningList),len(self.qList)))
-            if len(newRunningList) == 0:
+        running = set(str(job) for job in self.qList)
+        nscripts = len(self._scripts)
+        interval = POLL_MIN
+        last_queue = last_monitor = time.time()
+        while running:
+            time.sleep(interval if self._scripts else QUEUE_POLL_INTERVAL)
+            nfinished = self._pollSentinels()
+            now = time.time()
+            if not (self._scripts and self._remaining) or now - last_queue >= QUEUE_POLL_INTERVAL:
+                self.getRunningJobList(user)
+                last_queue = now
+                nrunning = len(running)
+                running &= self.runningQueueList
+                if not self._scripts: nfinished = nrunning - len(running)
+                if not running and self._remaining:
+                    logger.critical("Queue Monitor: jobs left the queue without completing: {0}".format(sorted(self._remaining)))
+                    self._remaining.clear()
+            if nfinished:
+                if self._scripts:
+                    logger.info("Queue Monitor: %d out of %d jobs remaining in cluster queue..." % (len(self._remaining), nscripts))
+                else:
+                    logger.info("Queue Monitor: %d out of %d jobs remaining in cluster queue..." % (len(running), len(self.qList)))
+                interval = POLL_MIN
+            else:
+                interval = min(interval * POLL_BACKOFF, POLL_MAX)
+            if not running:
                 logger.info("Queue Monitor: All jobs complete!")
-            runningList=newRunningList
-            newRunningList=[]
-            if monitor: monitor()
+            if monitor and (nfinished or not running or now - last_monitor >= MONITOR_INTERVAL):
+                monitor()
+                last_monitor = now
             
         return
 
@@ -297,27 +364,74 @@ JOBID   USER    STAT  QUEUE      FROM_HOST   EXEC_HOST   JOB_NAME   SUBMIT_TIME
 
         qNumber=0
         while out:
-            qNumber = None
-            if self.QTYPE == "SGE":
-                if "Your job-array" in out:
-                    # Array jobs have different form
-                    #Your job-array 19094.1-10:1 ("array.script") has been submitted
-                    qNumber=int(out.split()[2].split(".")[0])
-                    self.qList.append(qNumber)
-                elif "Your job" in out:
-                    qNumber=int(out.split()[2])
-                    self.qList.append(qNumber)
-            elif self.QTYPE == "LSF":
-                # Job <35339> is submitted to queue <q1h32>.
-                if "is submitted to queue" in out:
-                    qStr=out.split()[1]
-                    qNumber=int(qStr.strip("<>"))
-                    self.qList.append(qNumber)                
+            qNumber = self._parseSubmission(out)
             if qNumber:
+                self.qList.append(qNumber)
                 logger.debug("Submission script {0} submitted to queue as job {1}".format( subScript, qNumber ) )
             out = child_stdout.readline()
         child_stdout.close()
         return str(qNumber)
+
+    def _parseSubmission(self, out):
+        """Return the job number from a line of output of the submission command or None"""
+        qNumber = None
+        if self.QTYPE == "SGE":
+            if "Your job-array" in out:
+                # Array jobs have different form
+                #Your job-array 19094.1-10:1 ("array.script") has been submitted
+                qNumber=int(out.split()[2].split(".")[0])
+            elif "Your job" in out:
+                qNumber=int(out.split()[2])
+        elif self.QTYPE == "LSF":
+            # Job <35339> is submitted to queue <q1h32>.
+            if "is submitted to queue" in out:
+                qStr=out.split()[1]
+                qNumber=int(qStr.strip("<>"))
+        return qNumber
+
+    def submitJobs(self, job_scripts, batch_size=SUBMIT_BATCH_SIZE):
+        """Submit a list of job scripts and return their job numbers
+        
+        Rather than starting a submission process for every job, the submission commands for batch_size scripts at a
+        time are run by a single shell. The scripts should write their sentinel files (see sentinel_command) so that
+        monitorQueue can see when they complete.
+        
+        Args:
+        job_scripts -- the paths to the submission scripts
+        batch_size -- the number of scripts submitted by each shell
+        """
+        if self.QTYPE == "SGE":
+            command = 'qsub -V {0}'
+        elif self.QTYPE == "LSF":
+            command = 'bsub < {0}'
+        else:
+            msg = "Unrecognised QTYPE: {0}".format(self.QTYPE)
+            raise RuntimeError(msg)
+
+        self.trackScripts(job_scripts)
+        qNumbers = []
+        for i in range(0, len(job_scripts), batch_size):
+            batch = job_scripts[i:i + batch_size]
+            command_line = "\n".join([command.format(pipes.quote(s)) for s in batch])
+            logger.debug("Submitting {0} jobs with commands:\n{1}".format(len(batch), command_line))
+            try:
+                p = subprocess.Popen(['/bin/sh', '-c', command_line],
+                                     stdout = subprocess.PIPE,
+                                     stderr = subprocess.PIPE)
+                stdout_str, stderr_str = p.communicate()
+            except Exception,e:
+                raise RuntimeError("Error submitting jobs to queue with commands: {0}\n{1}".format(command_line,e))
+            if self.QTYPE=="SGE" and "Unable to run job" in stderr_str:
+                raise RuntimeError("Error submitting job to cluster queueing system: {0}".format(stderr_str))
+            batch_numbers = [q for q in [self._parseSubmission(out) for out in stdout_str.splitlines()] if q]
+            if len(batch_numbers) != len(batch):
+                raise RuntimeError("Submitted {0} jobs to the queue but got {1} job numbers:\n{2}{3}".format(
+                    len(batch), len(batch_numbers), stdout_str, stderr_str))
+            for subScript, qNumber in zip(batch, batch_numbers):
+                logger.debug("Submission script {0} submitted to queue as job {1}".format( subScript, qNumber ) )
+            qNumbers += batch_numbers
+        self.qList += qNumbers
+        return [str(q) for q in qNumbers]
     
     def submitArrayJob(self,
                        job_scripts,
@@ -386,10 +500,12 @@ jobname=`basename $script .sh`
 # cd to jobdir and runit
 cd $jobdir
 
-# Run the script
+# Run the script and write its sentinel file
 $script
-""".format(self._scriptFile, task_env)
+echo $? > $jobdir/$jobname{2}
+""".format(self._scriptFile, task_env, SENTINEL_SUFFIX)
         with open(arrayScript,'w') as f: f.write(s)
+        self.trackScripts(job_scripts)
         self.submitJob(arrayScript)
         return
 
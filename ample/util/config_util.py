@@ -78,6 +78,7 @@ _SECTIONS_REFERENCE = {"AMPLE_info": ["ample_version",
                                  'score_matrix_file_list',
                                  'sf_cif',
                                  'single_model',
+                                 'stage_cache_dir',
                                  'transmembrane_octopusfile',
                                  'transmembrane_lipofile',
                                  'transmembrane_spanfile',
@@ -6,17 +6,15 @@ __author__ = "Felix Simkovic"
 __date__ = "18 Mar 2017"
 __version__ = "2.1"
 
-from distutils.version import StrictVersion
-
 import inspect
 import logging
+import multiprocessing
 import numpy
 import os
-import sys
-import tempfile
 
 from ample.modelling import energy_functions
 from ample.util import ample_util
+from ample.util import pdb_edit
 
 import conkit
 import conkit.io
@@ -24,6 +22,100 @@ import conkit.plot
 
 logger = logging.getLogger(__name__)
 
+# Residues are in contact if their CB atoms (CA for glycine) are closer than this
+CONTACT_DISTANCE_CUTOFF = 8.0
+
+
+def select_contacts(contacts, seq_len, min_distance, factor=1.0):
+    """Select the contacts that conkit-precision scores
+
+    As in conkit-precision, contacts between residues closer than min_distance in sequence are removed
+    and the top seq_len * factor of the remaining contacts by raw score are kept.
+
+    Parameters
+    ----------
+    contacts : list, tuple
+       A list of the (res1_seq, res2_seq, raw_score) of each contact
+    seq_len : int
+       The length of the target sequence
+    min_distance : int
+       The minimum sequence separation of the contacting residues
+    factor : float, optional
+       The contact list truncation factor [default: 1.0]
+
+    Returns
+    -------
+    list
+       The (res1_seq, res2_seq) of the selected contacts
+
+    """
+    contacts = [c for c in contacts if abs(c[0] - c[1]) >= min_distance]
+    # A stable sort so that contacts with the same score stay in the order of the contact file
+    contacts.sort(key=lambda c: c[2], reverse=True)
+    return [(c[0], c[1]) for c in contacts[:int(seq_len * factor)]]
+
+
+def decoy_precisions(decoys, contacts, distance_cutoff=CONTACT_DISTANCE_CUTOFF, nproc=1):
+    """Calculate the precision of a list of contacts in each of a list of decoys
+
+    The CB coordinates of all decoys are read into a single array and the distances of the contacting
+    residues in all decoys are calculated in one go. As with ``remove_unmatched`` in conkit-precision,
+    contacts including a residue that is missing from a decoy are not scored for that decoy.
+
+    Parameters
+    ----------
+    decoys : list, tuple
+       A list containing paths to decoy files in PDB format
+    contacts : list, tuple
+       A list of the (res1_seq, res2_seq) residue numbers of each contact
+    distance_cutoff : float, optional
+       The distance between the CB atoms of residues in contact
+    nproc : int, optional
+       The number of processors to use to read the decoys
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+       The fraction of the scored contacts that are present in each decoy, or 0 if no contacts could be scored
+
+    """
+    if nproc > 1 and len(decoys) > nproc:
+        pool = multiprocessing.Pool(nproc)
+        try:
+            coordinates = pool.map(pdb_edit.cb_coordinates, decoys, chunksize=max(1, len(decoys) // (nproc * 4)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        coordinates = [pdb_edit.cb_coordinates(decoy) for decoy in decoys]
+
+    contacts = numpy.asarray(contacts, dtype=numpy.int64).reshape(-1, 2)
+    if len(contacts) < 1:
+        return numpy.zeros(len(decoys))
+
+    # The decoys are usually all numbered the same so only look up the contact residues once per numbering
+    indices = {}
+    pairs = numpy.full((len(decoys), len(contacts), 2, 3), numpy.nan)
+    for i, (resseq, xyz) in enumerate(coordinates):
+        key = resseq.tostring()
+        if key not in indices:
+            index = numpy.full(contacts.shape, -1, dtype=numpy.intp)
+            if len(resseq):
+                order = numpy.argsort(resseq, kind='mergesort')
+                position = numpy.minimum(numpy.searchsorted(resseq[order], contacts), len(resseq) - 1)
+                found = resseq[order][position] == contacts
+                index[found] = order[position][found]
+            indices[key] = index
+        index = indices[key]
+        present = (index >= 0).all(axis=1)
+        pairs[i, present] = xyz[index[present]]
+
+    distances = numpy.sqrt(((pairs[:, :, 0] - pairs[:, :, 1]) ** 2).sum(axis=2))
+    with numpy.errstate(invalid='ignore'):
+        satisfied = distances < distance_cutoff
+    matched = numpy.isfinite(distances).sum(axis=1)
+    return numpy.where(matched > 0, satisfied.sum(axis=1) / numpy.maximum(matched, 1.0), 0.0)
+
 
 class SubselectionAlgorithm(object):
     """A class to collect all subselection algorithms"""
@@ -241,7 +333,7 @@ class ContactUtil(object):
         subdistance_to_neighbor : int, optional
            The minimum distance between neighboring residues in the subselection [default: 24]
         **kwargs
-           Job submission related keyword arguments
+           Job submission related keyword arguments - only nproc is used as the decoys are scored in this process
 
         Returns
         -------
@@ -249,15 +341,11 @@ class ContactUtil(object):
            A list of paths to the sub-selected decoys
 
         """
-        from ample.util import ample_util
-        from ample.util import workers_util
-
         # Compute the long range contact satisfaction on a per-decoy basis
         logger.info(
             'Long-range contacts are defined with sequence separation of 24+')
 
-        # Hack a custom copy of the contact map together that we can use with the script
-        # All decoys should be sequence identical and thus we can just match it to the top
+        # All decoys should be sequence identical and thus we can just match the contact map to the top one
         contact_map = self.contact_map
 
         contact_map.match(
@@ -265,66 +353,11 @@ class ContactUtil(object):
                 decoys[0], decoy_format
             ).top_map, inplace=True
         )
-        tmp_contact_file = tempfile.NamedTemporaryFile(delete=False)
-        conkit.io.write(tmp_contact_file.name, 'casprr', contact_map)
-
-        # Construct the job scripts
-        job_scripts = []
-        log_files = []
-        executable = 'conkit-precision.bat' \
-            if sys.platform.startswith('win') \
-            else 'conkit-precision'
-        for decoy in decoys:
-            decoy_name = os.path.splitext(os.path.basename(decoy))[0]
-            contact_name = os.path.splitext(
-                os.path.basename(self.contact_file))[0]
-            prefix = '{0}_{1}_'.format(contact_name, decoy_name)
-            script = tempfile.NamedTemporaryFile(
-                prefix=prefix, suffix=ample_util.SCRIPT_EXT, delete=False)
-
-            # TODO: Get the log file business working properly
-            cmd = [executable, '-d', subdistance_to_neighbor]
-            if StrictVersion(conkit.__version__) <= StrictVersion('0.6.3'):
-                cmd += [decoy]
-            else:
-                cmd += [decoy, decoy_format]
-            cmd += [self.sequence_file, self.sequence_format]
-            cmd += [tmp_contact_file.name, 'casprr']
-            script.write(
-                ample_util.SCRIPT_HEADER + os.linesep
-                + " ".join(map(str, cmd)) + os.linesep
-            )
-            script.close()
-            os.chmod(script.name, 0o777)
-            job_scripts.append(script.name)
-            log_files.append(os.path.splitext(script.name)[0] + ".log")
-
-        success = workers_util.run_scripts(
-            job_scripts=job_scripts,
-            monitor=None,
-            check_success=None,
-            early_terminate=None,
-            nproc=kwargs['nproc'] if 'nproc' in kwargs else 1,
-            job_time=7200,          # Might be too long/short, taken from Rosetta modelling
-            job_name='subselect',
-            submit_cluster=kwargs['submit_cluster'] if 'submit_cluster' in kwargs else False,
-            submit_qtype=kwargs['submit_qtype'] if 'submit_qtype' in kwargs else None,
-            submit_queue=kwargs['submit_queue'] if 'submit_queue' in kwargs else False,
-            submit_array=kwargs['submit_array'] if 'submit_array' in kwargs else None,
-            submit_max_array=kwargs['submit_max_array'] if 'submit_max_array' in kwargs else None,
-        )
+        seq_len = conkit.io.read(self.sequence_file, self.sequence_format).top_sequence.seq_len
+        contacts = select_contacts([(contact.res1_seq, contact.res2_seq, contact.raw_score) for contact in contact_map],
+                                   seq_len, subdistance_to_neighbor)
 
-        if not success:
-            msg = "Error running decoy subselection"
-            raise RuntimeError(msg)
-
-        scores = numpy.zeros(len(decoys))
-        for i, (decoy, log, script) in enumerate(zip(decoys, log_files, job_scripts)):
-            for line in open(log, 'r'):
-                if line.startswith('Precision score'):
-                    scores[i] = float(line.strip().split()[-1])
-            os.unlink(log)
-            os.unlink(script)
+        scores = decoy_precisions(decoys, contacts, nproc=kwargs['nproc'] if 'nproc' in kwargs else 1)
 
         logger.info('Model selection mode: %s', mode)
         if mode == 'scaled':
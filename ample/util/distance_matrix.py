@@ -0,0 +1,179 @@
+"""Storage for symmetric matrices of distances or scores between models"""
+
+import logging
+import numpy
+import os
+
+logger = logging.getLogger(__name__)
+
+# Number of rows of the matrix written to a spicker score.matrix file at a time
+SPICKER_BLOCK_SIZE = 100
+
+
+class DistanceMatrix(object):
+    """Symmetric matrix of the distances between a set of models, stored as the condensed upper triangle.
+
+    Only the n*(n-1)/2 values above the diagonal are stored, as float32 by default, in a flat array that can be
+    saved to and memory-mapped from a .npy file, so the matrices for thousands of models can be built
+    in place on disk and shared between programs without ever holding the full square matrix in memory.
+    Matrices whose values are compared against thresholds given as python floats (e.g. subclustering radii)
+    should be stored as float64, as a value rounded to float32 can fall just above the threshold it was equal to.
+    The diagonal is a single value - 0.0 for distances, or e.g. 1.0 for similarity scores such as the Q-score -
+    which is stored after the condensed matrix in the .npy file.
+
+    Attributes
+    ----------
+    num_models : int
+       The number of models (rows) in the matrix
+    diagonal : float
+       The value of the diagonal elements
+    data : :obj:`numpy.ndarray`
+       The condensed upper triangle, ordered by row
+    """
+
+    def __init__(self, num_models, diagonal=0.0, fill=0.0, data=None, file_name=None, dtype=numpy.float32):
+        """
+        Parameters
+        ----------
+        num_models : int
+           The number of models
+        diagonal : float
+           The value of the diagonal elements
+        fill : float
+           The initial value of the off-diagonal elements if data is not given
+        data : :obj:`numpy.ndarray`, optional
+           An existing condensed upper triangle
+        file_name : str, optional
+           Create the matrix as a memory-mapped .npy file with this name
+        dtype : :obj:`numpy.dtype`
+           The type of the stored values
+        """
+        self.num_models = num_models
+        size = num_models * (num_models - 1) // 2
+        self._file_name = None
+        if data is not None:
+            if len(data) != size:
+                raise RuntimeError("Condensed matrix for {0} models needs {1} values not {2}".format(num_models, size, len(data)))
+            self._store = numpy.empty(size + 1, dtype=dtype)
+            self._store[:size] = data
+        elif file_name:
+            self._store = numpy.lib.format.open_memmap(file_name, mode='w+', dtype=dtype, shape=(size + 1,))
+            self._store[:size] = fill
+            self._file_name = os.path.abspath(file_name)
+        else:
+            self._store = numpy.full(size + 1, fill, dtype=dtype)
+        self.data = self._store[:size]
+        self.diagonal = diagonal
+        return
+
+    @property
+    def diagonal(self):
+        return float(self._store[-1])
+
+    @diagonal.setter
+    def diagonal(self, value):
+        self._store[-1] = value
+
+    @classmethod
+    def from_square(cls, matrix, diagonal=None, dtype=numpy.float32):
+        """Create from the upper triangle of a square matrix"""
+        matrix = numpy.asarray(matrix)
+        num_models = len(matrix)
+        if diagonal is None: diagonal = float(matrix[0, 0]) if num_models else 0.0
+        i, j = numpy.triu_indices(num_models, 1)
+        return cls(num_models, diagonal=diagonal, data=matrix[i, j], dtype=dtype)
+
+    @classmethod
+    def load(cls, file_name, mmap=True):
+        """Read a matrix saved with :meth:`save`, memory-mapping it read-only unless mmap is False"""
+        store = numpy.load(file_name, mmap_mode='r' if mmap else None)
+        # Invert size = n*(n-1)/2
+        size = len(store) - 1
+        num_models = int(round((1 + numpy.sqrt(1 + 8 * size)) / 2))
+        if num_models * (num_models - 1) // 2 != size:
+            raise RuntimeError("File {0} does not hold a DistanceMatrix".format(file_name))
+        dmatrix = cls.__new__(cls)
+        dmatrix.num_models = num_models
+        dmatrix._file_name = os.path.abspath(file_name)
+        dmatrix._store = store
+        dmatrix.data = store[:size]
+        return dmatrix
+
+    def save(self, file_name):
+        """Save the matrix to a .npy file and return its absolute path"""
+        file_name = os.path.abspath(file_name)
+        if file_name == self._file_name:
+            if isinstance(self._store, numpy.memmap): self._store.flush()
+        else:
+            numpy.save(file_name, self._store)
+        return file_name
+
+    def index(self, i, j):
+        """Return the index into data of element (i, j), where i < j. i and j can be arrays."""
+        return self.num_models * i - i * (i + 1) // 2 + j - i - 1
+
+    def __getitem__(self, ij):
+        i, j = ij
+        if i == j: return self.diagonal
+        if i > j: i, j = j, i
+        return self.data[self.index(i, j)]
+
+    def __setitem__(self, ij, value):
+        i, j = ij
+        if i == j: raise IndexError("Cannot set the diagonal of a DistanceMatrix")
+        if i > j: i, j = j, i
+        self.data[self.index(i, j)] = value
+
+    def set_pairs(self, i, j, values):
+        """Set the values for arrays of row and column indices in either triangle - diagonal elements are ignored"""
+        i, j, values = numpy.asarray(i), numpy.asarray(j), numpy.asarray(values)
+        off = i != j
+        i, j, values = i[off], j[off], values[off]
+        lo, hi = numpy.minimum(i, j), numpy.maximum(i, j)
+        self.data[self.index(lo, hi)] = values
+
+    def set_row(self, i, values):
+        """Set the distances from model i to all models after it"""
+        start = self.index(i, i + 1)
+        self.data[start:start + self.num_models - i - 1] = values
+
+    def row(self, i):
+        """Return the full row i of the matrix"""
+        row = numpy.empty(self.num_models, dtype=self.data.dtype)
+        before = numpy.arange(i)
+        row[:i] = self.data[self.index(before, i)]
+        row[i] = self.diagonal
+        start = self.index(i, i + 1)
+        row[i + 1:] = self.data[start:start + self.num_models - i - 1]
+        return row
+
+    def to_square(self, dtype=numpy.float64):
+        """Return the full square matrix"""
+        matrix = numpy.empty((self.num_models, self.num_models), dtype=dtype)
+        i, j = numpy.triu_indices(self.num_models, 1)
+        matrix[i, j] = self.data
+        matrix[j, i] = self.data
+        numpy.fill_diagonal(matrix, self.diagonal)
+        return matrix
+
+    def write_spicker(self, file_name, offset=0):
+        """Write the matrix in the format of the spicker score.matrix file and return its absolute path.
+
+        Each line holds the indices of a pair of models (counting from offset) and their score, for the
+        upper triangle including the diagonal.
+        """
+        n = self.num_models
+        with open(file_name, 'w') as f:
+            for start in range(0, n, SPICKER_BLOCK_SIZE):
+                rows = numpy.arange(start, min(start + SPICKER_BLOCK_SIZE, n))
+                # Row i has the columns i..n-1
+                counts = n - rows
+                i = numpy.repeat(rows, counts)
+                j = i + numpy.arange(len(i)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+                values = numpy.full(len(i), self.diagonal, dtype=numpy.float64)
+                off = i != j
+                values[off] = self.data[self.index(i[off], j[off])]
+                block = numpy.column_stack((i + offset, j + offset, values))
+                numpy.savetxt(f, block, fmt="% 4d % 4d % 8.3F")
+            f.write("\n")
+        return os.path.abspath(file_name)
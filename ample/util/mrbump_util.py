@@ -7,6 +7,7 @@ import logging
 import os
 import shutil
 import sys
+import threading
 
 # Hack to make sure we can find the modules we need
 if __name__ == "__main__":
@@ -17,6 +18,7 @@ if __name__ == "__main__":
 from ample.util import ample_util
 from ample.util import mrbump_cmd
 from ample.util import printTable
+from ample.util import workers_util
 
 # MRBUMP imports
 if not "CCP4" in os.environ.keys(): raise RuntimeError('CCP4 not found')
@@ -28,6 +30,8 @@ import parse_buccaneer
 import parse_phaser
 
 TOP_KEEP = 3 # How many of the top shelxe/phaser results to keep for the gui
+PROMISING_SHELXE_CC = 20.0 # Scores that make an unsuccessful job worth following up
+PROMISING_PHASER_TFZ = 7.0
 MRBUMP_RUNTIME = 172800 # allow 48 hours for each mrbump job
 
 # We need a null logger so that we can be used without requiring a logger
@@ -59,7 +63,7 @@ class ResultsSummary(object):
         
         # Extract mrbump results from a pickled results file if given one.
         if results_pkl and os.path.isfile(results_pkl):
-            with open(results_pkl) as f: resd = cPickle.load(f)
+            resd = ample_util.read_amoptd(results_pkl)
             mkey = 'mrbump_results'
             if mkey in resd and len(resd[mkey]):
                 self.results = resd[mkey]
@@ -482,10 +486,11 @@ class ResultsSummary(object):
         for r in results: resultsTable.append([r[k] for k in keys])
         return resultsTable
 
-    def sortResults(self, prioritise=None):
+    def sortResults(self, results=None, prioritise=None):
         """
-        Sort the results
+        Sort the results in place and return them - if results is not given, self.results is sorted
         """
+        if results is None: results = self.results
         # Check each result to see what attributes are set and use this to work out how we rate this run
         
         SHELXE = False
@@ -493,7 +498,7 @@ class ResultsSummary(object):
         ARP = False
         REFMAC = False
         PHASER = False
-        for r in self.results:
+        for r in results:
             if 'SHELXE_CC' in r and r['SHELXE_CC'] and float(r['SHELXE_CC']) > 0.0:
                 SHELXE = True
             if 'BUCC_final_Rfact' in r and r['BUCC_final_Rfact'] and float(r['BUCC_final_Rfact']) < 1.0:
@@ -522,8 +527,8 @@ class ResultsSummary(object):
             
         if sortf:
             # Now sort by the key
-            self.results.sort(key=sortf, reverse=reverse)
-        return
+            results.sort(key=sortf, reverse=reverse)
+        return results
 
     def summariseResults(self, mrbump_dir):
         """Return a string summarising the results"""
@@ -593,6 +598,213 @@ class ResultsSummary(object):
                     break # Stop as soon as we find one
         if len(topf): return topf
             
+class ResultsCollector(ResultsSummary):
+    """
+    Incrementally collect the results for a series of MRBUMP runs in a directory
+    
+    The results of jobs that have finished are parsed once and remembered, along with the path and modification
+    time of the file they were read from, so each call to poll only needs to parse the jobs that hadn't finished
+    the last time, or whose results file has been rewritten since it was read. Jobs that finished without a results
+    file are final. The list of jobs is only refreshed when the mrbump directory changes, and archived results
+    are kept in memory rather than being re-read from the archive directory.
+    """
+    
+    def __init__(self, mrbump_dir, purge=False):
+        """
+        Parameters
+        ----------
+        mrbump_dir : str
+           The directory the MRBUMP jobs are running in
+        purge : bool
+           Remove the directories of completed jobs that aren't in the top results
+        """
+        super(ResultsCollector, self).__init__()
+        if not mrbump_dir or not os.path.isdir(mrbump_dir): raise RuntimeError,"Cannot find mrbump_dir: {0}".format(mrbump_dir)
+        self.mrbump_dir = os.path.abspath(mrbump_dir)
+        self.purge = purge
+        self.changed = []
+        self._archived = {} # ensemble name -> archived result
+        self._dir_mtime = None
+        self._ensembles = []
+        self._finished = {} # ensemble name -> (results file, mtime, list of results) - file is None if there wasn't one
+        self._status = {} # ensemble name -> status of an unfinished job
+        if self.purge: self._archived = self._extractOld(self.mrbump_dir)
+        return
+    
+    def extractResults(self, mrbump_dir=None, purge=None):
+        """Update and return the results - for compatibility with ResultsSummary"""
+        self.poll()
+        return self.results
+    
+    def poll(self):
+        """Update the results with any jobs that have changed since the last poll.
+        
+        Returns
+        -------
+        changed : list
+           The names of the ensembles whose results have changed since the last poll
+        """
+        changed = []
+        for ensemble in self._job_ensembles():
+            if ensemble in self._archived: continue
+            if ensemble in self._finished:
+                if self._results_rewritten(ensemble): changed.append(ensemble)
+                continue
+            status = self._job_status(ensemble)
+            if status is None:
+                changed.append(ensemble)
+                self._status.pop(ensemble, None)
+            elif self._status.get(ensemble) != status:
+                changed.append(ensemble)
+                self._status[ensemble] = status
+        
+        if changed and self.purge: self._archiveFailed()
+        self.changed = changed
+        
+        results = []
+        for _, _, r in self._finished.itervalues(): results += r
+        if self._status: results += self._processFailed(self.mrbump_dir, self._status)
+        results += self._archived.values()
+        self.results = self.sortResults(results)
+        self.success = any([jobSucceeded(r) for r in self.results])
+        return changed
+    
+    def _archiveFailed(self):
+        """Archive the results of completed jobs that don't pass the keep criteria and remove their directories"""
+        completed = []
+        for _, _, r in self._finished.itervalues(): completed += [ x for x in r if not job_unfinished(x) ]
+        to_keep = []
+        for prioritise in ['SHELXE_CC', 'PHASER_TFZ']:
+            for r in self.sortResults(list(completed), prioritise=prioritise)[0:TOP_KEEP]:
+                if r not in to_keep: to_keep.append(r)
+        for ensemble in self._finished.keys():
+            _, _, results = self._finished[ensemble]
+            if any([ r in to_keep for r in results ]): continue
+            for r in results:
+                pkl = os.path.join(self.pdir, "{0}.pkl".format(r['ensemble_name']))
+                with open(pkl, 'w') as f: cPickle.dump(r, f)
+                self._archived[r['ensemble_name']] = r
+            shutil.rmtree(results[0]['Search_directory'], ignore_errors=True)
+            del self._finished[ensemble]
+        return
+    
+    def _job_ensembles(self):
+        """Return the names of the ensembles in the mrbump directory, only searching it again if it has changed"""
+        mtime = os.stat(self.mrbump_dir).st_mtime
+        if mtime != self._dir_mtime:
+            ext = '.bat' if sys.platform.startswith("win") else '.sh'
+            scripts = glob.glob(os.path.join(self.mrbump_dir, "*" + ext))
+            if not len(scripts): scripts = glob.glob(os.path.join(self.mrbump_dir, "*.sub"))
+            self._ensembles = [ os.path.splitext(os.path.basename(e))[0] for e in scripts ]
+            self._dir_mtime = mtime
+        return self._ensembles
+    
+    def _job_status(self, ensemble):
+        """Parse the results of a job if it has finished and return None, otherwise return why it is unfinished"""
+        jobDir = os.path.join(self.mrbump_dir, 'search_' + ensemble + '_mrbump')
+        if not os.path.isdir(jobDir): jobDir = os.path.join(self.mrbump_dir, 'search_' + ensemble)
+        if not os.path.isdir(jobDir): return "no_job_directory"
+        if not os.path.exists(os.path.join(jobDir, "results", "finished.txt")): return "unfinished"
+        
+        resultsDict = os.path.join(jobDir, "results", "resultsTable.pkl")
+        resultsTable = os.path.join(jobDir, "results", "resultsTable.dat")
+        if os.path.isfile(resultsDict):
+            rfile = resultsDict
+        elif os.path.isfile(resultsTable):
+            rfile = resultsTable
+        else:
+            # The job has finished so this won't change
+            results = self._processFailed(self.mrbump_dir, {ensemble : "missing-results-file"})
+            results[0]['Search_directory'] = jobDir
+            self._finished[ensemble] = (None, None, results)
+            return None
+        mtime = os.stat(rfile).st_mtime
+        self._finished[ensemble] = (rfile, mtime, self._parse(rfile))
+        return None
+    
+    def _parse(self, rfile):
+        if rfile.endswith('.pkl'): return self.processMrbumpPkl(rfile)
+        return self.parseTableDat(rfile)
+    
+    def _results_rewritten(self, ensemble):
+        """Re-parse the results file of a finished job if it has changed and return True if it has"""
+        rfile, mtime, _ = self._finished[ensemble]
+        if rfile is None: return False
+        try:
+            new_mtime = os.stat(rfile).st_mtime
+        except OSError:
+            return False
+        if new_mtime == mtime: return False
+        self._finished[ensemble] = (rfile, new_mtime, self._parse(rfile))
+        return True
+
+
+class JobPrioritiser(workers_util.JobPriority):
+    """Re-rank queued MRBUMP jobs as the results of completed jobs come in
+    
+    Jobs start in the order of the job scripts (normally that of :func:`ensembler.sort_ensembles`).
+    Ensembles are grouped into families by cluster and truncation level. When a job succeeds or
+    gets a promising SHELXE_CC or PHASER_TFZ, the queued jobs in its family and the neighbouring
+    truncation levels of its cluster are moved to the front of the queue. When a job fails, the
+    queued jobs in its family are moved behind all the others.
+    """
+    
+    def __init__(self, job_scripts, ensembles_data=None):
+        """
+        Parameters
+        ----------
+        job_scripts : list
+           The MRBUMP job scripts in their initial order
+        ensembles_data : list
+           The ensembles' data dictionaries
+        """
+        self._rank = dict((self._job_name(j), i) for i, j in enumerate(job_scripts))
+        self._family = {}
+        levels = {}
+        for d in ensembles_data or []:
+            if d.get('cluster_num') is None or d.get('truncation_level') is None: continue
+            family = (d['cluster_num'], d['truncation_level'])
+            self._family[d['name']] = family
+            levels.setdefault(family[0], set()).add(family[1])
+        self._levels = dict((c, sorted(l)) for c, l in levels.iteritems())
+        self._failed = set()
+        self._promoted = set()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _job_name(job):
+        return os.path.splitext(os.path.basename(job))[0]
+    
+    def key(self, job):
+        name = self._job_name(job)
+        family = self._family.get(name)
+        tier = 0
+        if family in self._promoted:
+            tier = -1
+        elif family in self._failed:
+            tier = 1
+        return (tier, self._rank.get(name, len(self._rank)))
+    
+    def job_done(self, job, returncode):
+        name = self._job_name(job)
+        family = self._family.get(name)
+        if family is None: return
+        promising = False
+        if returncode == 0:
+            results = _scriptResults(job)
+            if results: promising = any(jobSucceeded(r) or jobPromising(r) for r in results)
+        with self._lock:
+            if promising:
+                cluster, level = family
+                idx = self._levels[cluster].index(level)
+                for l in self._levels[cluster][max(0, idx - 1):idx + 2]:
+                    self._promoted.add((cluster, l))
+                logger.debug("Promoting jobs similar to promising job %s", name)
+            else:
+                self._failed.add(family)
+        return
+
+
 def _resultsKeys(results):
     keys = []
     # Build up list of keys we want to print based on what we find in the results
@@ -632,22 +844,21 @@ def checkSuccess(script_path):
     Success is assumed as a SHELX CC score of >= SHELXSUCCESS
 
     """
+    results = _scriptResults(script_path)
+    if not results: return False
+    return jobSucceeded(results[0])
+
+def _scriptResults(script_path):
+    """Return the sorted results of the MRBUMP job run by a script or None if there are none"""
     directory, script = os.path.split(script_path)
     scriptname = os.path.splitext(script)[0]
     rfile = os.path.join(directory, 'search_' + scriptname + '_mrbump', 
                          'results', 'resultsTable.pkl')
-    # print "{0} checking for file: {1}".format(multiprocessing.current_process().name,rfile)
-    if not os.path.isfile(rfile):
-        # print "{0} cannot find results file: {1}".format(multiprocessing.current_process().name,rfile)
-        return False
+    if not os.path.isfile(rfile): return None
     
     # Results summary object to parse table file
     mrbR = ResultsSummary()
-    
-    # Put into order and take top one
-    results = mrbR.processMrbumpPkl(rfile)
-    mrbR.sortResults(results)
-    return jobSucceeded(results[0])
+    return mrbR.sortResults(mrbR.processMrbumpPkl(rfile))
 
 def finalSummary(amoptd):
     """Print a final summary of the job"""
@@ -715,6 +926,12 @@ def jobSucceeded(job_dict):
         success = True
     return success
 
+def jobPromising(job_dict):
+    """Return True if a job has scores that suggest it may be close to a solution"""
+    if job_dict.get('SHELXE_CC') and float(job_dict['SHELXE_CC']) >= PROMISING_SHELXE_CC: return True
+    if job_dict.get('PHASER_TFZ') and float(job_dict['PHASER_TFZ']) >= PROMISING_PHASER_TFZ: return True
+    return False
+
 def job_unfinished(job_dict):
     if not 'Solution_Type' in job_dict: return True
     return job_dict['Solution_Type'] == "unfinished" or job_dict['Solution_Type'] == "no_job_directory"
@@ -385,7 +385,7 @@ def process_options(optd):
             msg = "Cannot find fast_protein_cluster executable: {0}".format(
                 optd['fast_protein_cluster_exe'])
             exit_util.exit_error(msg)
-    elif optd['cluster_method'] in ['import', 'random', 'skip']:
+    elif optd['cluster_method'] in ['import', 'pyspicker', 'random', 'skip']:
         pass
     else:
         msg = "Unrecognised cluster_method: {0}".format(optd['cluster_method'])
@@ -416,6 +416,10 @@ def process_options(optd):
             unrecognised_sidechains)
         logger.critical(msg)
         exit_util.exit_error(msg)
+
+    # The cache of ensembling results is shared by all the runs in the run directory
+    if optd.get('stage_cache') and not optd.get('stage_cache_dir'):
+        optd['stage_cache_dir'] = os.path.join(optd['run_dir'], 'AMPLE_stage_cache')
     #
     # SCRWL - we always check for SCRWL as if we are processing QUARK models we want to add sidechains to them
     #
@@ -587,7 +591,8 @@ def process_restart_options(optd):
                 optd['models_dir']))
             # Check the models
             allsame = False if optd['homologs'] else True
-            if not pdb_edit.check_pdb_directory(optd['models_dir'], sequence=None, single=True, allsame=allsame):
+            if not pdb_edit.check_pdb_directory(optd['models_dir'], sequence=None, single=True, allsame=allsame,
+                                                nproc=optd['nproc']):
                 msg = "Error importing restart models: {0}".format(
                     optd['models_dir'])
                 exit_util.exit_error(msg)
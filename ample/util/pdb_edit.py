@@ -4,12 +4,16 @@ Useful manipulations on PDB files
 '''
 
 # Python imports
+import collections
 import copy
 import glob
 import logging
+import multiprocessing
+import numpy
 import os
 import re
 import sys
+import threading
 import unittest
 
 import iotbx.file_reader
@@ -51,6 +55,76 @@ one2three =  dict((v, k) for (k, v) in three2one.items())
 
 _logger = logging.getLogger()
 
+# Maximum number of parsed structures held by the structure cache
+STRUCTURE_CACHE_SIZE = 256
+
+class StructureCache(object):
+    """A bounded least-recently-used cache of parsed pdb files.
+
+    Entries are keyed by the absolute path, size and modification time of the file together with the kind
+    of object that was parsed from it, so a file that is rewritten is parsed again. The cached objects are
+    shared between all callers and must not be modified - callers that edit a hierarchy should take a copy.
+    """
+    
+    def __init__(self, maxsize=STRUCTURE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._cache)
+    
+    def clear(self):
+        """Empty the cache and reset the counters"""
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
+    
+    def get(self, pdbin, kind, parser):
+        """Return the object of the given kind for pdbin, calling parser(pdbin) to create it if it is not cached"""
+        st = os.stat(pdbin)
+        key = (os.path.abspath(pdbin), st.st_size, st.st_mtime, kind)
+        with self._lock:
+            if key in self._cache:
+                self.hits += 1
+                value = self._cache.pop(key)
+                self._cache[key] = value
+                return value
+            self.misses += 1
+        value = parser(pdbin)
+        with self._lock:
+            self._cache[key] = value
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return value
+    
+    def stats(self):
+        """Return a dictionary of the cache size and the number of hits and misses"""
+        return {'size' : len(self._cache), 'maxsize' : self.maxsize, 'hits' : self.hits, 'misses' : self.misses}
+
+_structure_cache = StructureCache()
+
+def structure_cache():
+    """Return the process-wide StructureCache"""
+    return _structure_cache
+
+def cached_pdb_input(pdbin):
+    """Return the (shared) iotbx pdb_input object for pdbin"""
+    return _structure_cache.get(pdbin, 'pdb_input', lambda p: iotbx.pdb.pdb_input(file_name=p))
+
+def cached_hierarchy(pdbin, copy=False):
+    """Return the hierarchy for pdbin.
+    
+    The hierarchy is shared with other callers unless copy is True, in which case a deep copy that can be
+    edited is returned.
+    """
+    hierarchy = _structure_cache.get(pdbin, 'hierarchy', lambda p: cached_pdb_input(p).construct_hierarchy())
+    if copy: return hierarchy.deep_copy()
+    return hierarchy
+
 def backbone(inpath=None, outpath=None):
     """Only output backbone atoms.
     """        
@@ -137,7 +211,7 @@ def calpha_only(inpdb, outpdb):
 #         
 #         return
 
-def check_pdb_directory(directory,single=True,allsame=True,sequence=None):
+def check_pdb_directory(directory,single=True,allsame=True,sequence=None,nproc=1):
     _logger.info("Checking pdbs in directory: {0}".format(directory))
     if not os.path.isdir(directory):
         _logger.critical("Cannot find directory: {0}".format(directory))
@@ -147,81 +221,212 @@ def check_pdb_directory(directory,single=True,allsame=True,sequence=None):
         _logger.critical("Cannot find any pdb files in directory: {0}".format(directory))
         return False
     if not (single or sequence or allsame): return True
-    return check_pdbs(models,sequence=sequence,single=single,allsame=allsame)
+    return check_pdbs(models,sequence=sequence,single=single,allsame=allsame,nproc=nproc)
 
-def check_pdbs(models,single=True,allsame=True,sequence=None):
-    if allsame and not sequence:
-        # Get sequence from first model
-        try:
-            h=iotbx.pdb.pdb_input(models[0]).construct_hierarchy()
-        except Exception,e:
-            s="*** ERROR reading sequence from first pdb: {0}\n{1}".format(models[0],e)
-            _logger.critical(s)
-            return False
-        sequence = _sequence1(h) # only one model/chain
-    errors = []
-    multi = []
-    no_protein = []
-    sequence_err = []
-    unnamed_chain = []
+def check_pdbs(models,single=True,allsame=True,sequence=None,nproc=1,fail_fast=False):
+    """Check that the pdbs can be read and, if single is True, that they contain a single named protein chain with
+    the given sequence (or that of the first pdb if allsame is True and no sequence is given).
+
+    If nproc > 1 the pdbs are checked in a pool of processes. If fail_fast is True, checking stops at the
+    first invalid pdb.
+    """
+    checker = PdbChecker(single=single, allsame=allsame, sequence=sequence, nproc=nproc, fail_fast=fail_fast)
     for pdb in models:
-        try:
-            h = iotbx.pdb.pdb_input(pdb).construct_hierarchy()
-        except Exception,e:
-            errors.append((pdb,e))
-            continue
-        if not single: continue
-        if not (h.models_size()==1 and h.models()[0].chains_size()==1):
-            multi.append(pdb)
-            continue
-        # single chain from one model so check is protein
-        if not h.models()[0].chains()[0].is_protein():
-            no_protein.append(pdb)
-            continue
-        if not h.models()[0].chains()[0].id.strip(): # Check we have a named chain
-            unnamed_chain.append(pdb)
-            continue
-        if sequence:
-            s=_sequence1(h) # only one chain/model
-            if not s == sequence: sequence_err.append((pdb,s))
-    
-    if not (len(errors) or len(multi) or len(sequence_err) or len(no_protein) or len(unnamed_chain)):
-        _logger.info("check_pdb_directory - pdb files all seem valid")
-        return True
-    
-    s="\n"
-    if len(errors):
-        s="*** ERROR ***\n"
-        s+="The following pdb files have errors:\n\n"
-        for pdb,e in errors:
-            s+="{0}: {1}\n".format(pdb,e)
-    
-    if len(multi):
-        s+="\n"
-        s+="The following pdb files have more than one chain:\n\n"
-        for pdb in multi:
-            s+="{0}\n".format(pdb)
+        if not checker.add(pdb): break
+    return checker.finish()
+
+def _scan_pdb(pdbin):
+    """Read the chains and sequence of a pdb from its ATOM records without building a hierarchy.
+
+    Returns a tuple of the number of models, the list of chain IDs and the sequence of the first chain of the
+    first model, or None if the pdb contains anything (HETATMs, alternate conformations, non-standard residues,
+    chain breaks) that needs to be checked with a full parse.
+    """
+    nmodels = 0
+    chains = []
+    sequence = []
+    last_resid = None
+    ter = False
+    with open(pdbin) as f:
+        for line in f:
+            record = line[:6]
+            if record == 'MODEL ':
+                nmodels += 1
+                if nmodels > 1: break
+            elif record == 'ATOM  ':
+                if ter or line[16] != ' ': return None
+                chain_id = line[21]
+                if not chains or chain_id != chains[-1]:
+                    if chain_id in chains: return None
+                    chains.append(chain_id)
+                if len(chains) > 1: continue
+                resid = line[22:27]
+                if resid != last_resid:
+                    resname = line[17:20].strip()
+                    if resname not in three2one or resname == 'UNK': return None
+                    sequence.append(three2one[resname])
+                    last_resid = resid
+            elif record == 'HETATM':
+                return None
+            elif record.startswith('TER'):
+                ter = True
+            elif record == 'ENDMDL':
+                break
+    if not chains: return None
+    return max(nmodels, 1), chains, "".join(sequence)
+
+def _check_hierarchy(pdbin, single, sequence):
+    """Check a pdb by building its hierarchy and return a tuple of the problem (or None) and its details"""
+    try:
+        h = cached_hierarchy(pdbin)
+    except Exception,e:
+        return 'error', str(e)
+    if not single: return None, None
+    if not (h.models_size()==1 and h.models()[0].chains_size()==1):
+        return 'multi', None
+    # single chain from one model so check is protein
+    if not h.models()[0].chains()[0].is_protein():
+        return 'no_protein', None
+    if not h.models()[0].chains()[0].id.strip(): # Check we have a named chain
+        return 'unnamed_chain', None
+    if sequence:
+        s=_sequence1(h) # only one chain/model
+        if not s == sequence: return 'sequence', s
+    return None, None
+
+def _check_pdb(args):
+    """Check a single pdb, using a scan of the ATOM records if possible, and return (pdb, problem, details)"""
+    pdbin, single, sequence = args
+    try:
+        scan = _scan_pdb(pdbin)
+    except Exception:
+        scan = None
+    if scan:
+        nmodels, chains, seq = scan
+        if not single or (nmodels == 1 and len(chains) == 1 and chains[0].strip() and seq and \
+                          (not sequence or seq == sequence)):
+            return pdbin, None, None
+    # Anything the scan can't pass is checked properly so that problems are diagnosed as before
+    problem, details = _check_hierarchy(pdbin, single, sequence)
+    return pdbin, problem, details
+
+class PdbChecker(object):
+    """Check a set of pdbs as they are added, in a pool of processes if nproc > 1.
+
+    Pdbs can be added as they become available (e.g. as they are extracted from an archive). When allsame is
+    True and no sequence is given the first pdb provides the sequence that the others are checked against.
+    finish() waits for all the checks to complete, logs any problems and returns True if all the pdbs are valid.
+    """
+
+    def __init__(self, single=True, allsame=True, sequence=None, nproc=1, fail_fast=False):
+        self.single = single
+        self.allsame = allsame
+        self.sequence = sequence
+        self.nproc = nproc
+        self.fail_fast = fail_fast
+        self.failed = False
+        self._error = None
+        self._pool = None
+        self._results = []
+        
+    def add(self, pdbin):
+        """Add a pdb to be checked and return False if no more pdbs need to be added"""
+        if (self.failed and self.fail_fast) or self._error: return False
+        if self.allsame and not self.sequence:
+            # Get sequence from first model
+            scan = None
+            try:
+                scan = _scan_pdb(pdbin)
+            except Exception:
+                pass
+            if scan and len(scan[1]) == 1 and scan[2]:
+                self.sequence = scan[2]
+            else:
+                try:
+                    self.sequence = _sequence1(cached_hierarchy(pdbin)) # only one model/chain
+                except Exception,e:
+                    self._error = "*** ERROR reading sequence from first pdb: {0}\n{1}".format(pdbin,e)
+                    return False
+        args = (pdbin, self.single, self.sequence)
+        if self.nproc > 1:
+            if self._pool is None: self._pool = multiprocessing.Pool(self.nproc)
+            self._results.append(self._pool.apply_async(_check_pdb, (args,), callback=self._checked))
+        else:
+            self._results.append(_check_pdb(args))
+            self._checked(self._results[-1])
+        return not (self.failed and self.fail_fast)
+    
+    def _checked(self, result):
+        if result[1]: self.failed = True
+    
+    def finish(self):
+        """Wait for the checks to finish and return True if all the pdbs are valid"""
+        if self._error:
+            if self._pool: self._pool.terminate()
+            _logger.critical(self._error)
+            return False
+        errors = []
+        multi = []
+        no_protein = []
+        sequence_err = []
+        unnamed_chain = []
+        problems = {'error' : errors, 'multi' : multi, 'no_protein' : no_protein,
+                    'unnamed_chain' : unnamed_chain, 'sequence' : sequence_err}
+        for result in self._results:
+            if self._pool:
+                if self.failed and self.fail_fast and not result.ready(): continue
+                result = result.get()
+            pdb, problem, details = result
+            if problem in ('error', 'sequence'):
+                problems[problem].append((pdb, details))
+            elif problem:
+                problems[problem].append(pdb)
+        if self._pool:
+            if self.failed and self.fail_fast:
+                self._pool.terminate()
+            else:
+                self._pool.close()
+            self._pool.join()
+            self._pool = None
+        sequence = self.sequence
+        
+        if not (len(errors) or len(multi) or len(sequence_err) or len(no_protein) or len(unnamed_chain)):
+            _logger.info("check_pdb_directory - pdb files all seem valid")
+            return True
+    
+        s="\n"
+        if len(errors):
+            s="*** ERROR ***\n"
+            s+="The following pdb files have errors:\n\n"
+            for pdb,e in errors:
+                s+="{0}: {1}\n".format(pdb,e)
+    
+        if len(multi):
+            s+="\n"
+            s+="The following pdb files have more than one chain:\n\n"
+            for pdb in multi:
+                s+="{0}\n".format(pdb)
             
-    if len(no_protein):
-        s+="\n"
-        s+="The following pdb files do not appear to contain any protein:\n\n"
-        for pdb in no_protein:
-            s+="{0}\n".format(pdb)
+        if len(no_protein):
+            s+="\n"
+            s+="The following pdb files do not appear to contain any protein:\n\n"
+            for pdb in no_protein:
+                s+="{0}\n".format(pdb)
             
-    if len(unnamed_chain):
-        s+="\n"
-        s+="The following pdb files do not have named chains:\n\n"
-        for pdb in unnamed_chain:
-            s+="{0}\n".format(pdb)
+        if len(unnamed_chain):
+            s+="\n"
+            s+="The following pdb files do not have named chains:\n\n"
+            for pdb in unnamed_chain:
+                s+="{0}\n".format(pdb)
             
-    if len(sequence_err):
-        s+="\n"
-        s+="The following pdb files have differing sequences from the reference sequence:\n\n{0}\n\n".format(sequence)
-        for pdb,seq in sequence_err:
-            s+="PDB: {0}\n{1}\n".format(pdb,seq)
+        if len(sequence_err):
+            s+="\n"
+            s+="The following pdb files have differing sequences from the reference sequence:\n\n{0}\n\n".format(sequence)
+            for pdb,seq in sequence_err:
+                s+="PDB: {0}\n{1}\n".format(pdb,seq)
 
-    _logger.critical(s)
-    return False
+        _logger.critical(s)
+        return False
 
 def extract_chain(inpdb, outpdb, chainID=None, newChainID=None, cAlphaOnly=False, renumber=True ):
     """Extract chainID from inpdb and renumner.
@@ -799,15 +1004,18 @@ def _keep_matching(refpdb=None, targetpdb=None, outpdb=None, resSeqMap=None ):
 
 def get_info(inpath):
     """Read a PDB and extract as much information as possible into a PdbInfo object
+
+    The PdbInfo is cached and shared between callers so must not be modified.
     """
-    
+    return _structure_cache.get(inpath, 'info', _get_info)
+
+def _get_info(inpath):
     info = pdb_model.PdbInfo()
     info.pdb = inpath
     
     currentModel = None
-    currentChain = -1
     
-    modelAtoms = [] # list of models, each of which is a list of chains with the list of atoms
+    modelAtoms = [] # list of models, each of which is a list of the ATOM lines
     
     # Go through refpdb and find which ref_residues are present
     f = open(inpath, 'r')
@@ -873,6 +1081,7 @@ def get_info(inpath):
         if line.startswith("MODEL"):
             if currentModel:
                 # Need to make sure that we have an id if only 1 chain and none given
+                currentModel.setAtoms( modelAtoms[ -1 ] )
                 if len( currentModel.chains ) <= 1:
                     if currentModel.chains[0] == None:
                         currentModel.chains[0] = 'A'
@@ -884,27 +1093,18 @@ def get_info(inpath):
             # Get serial
             currentModel.serial = int(line.split()[1])
             
-            currentChain = None
             modelAtoms.append( [] )
         
-        # Count chains (could also check against the COMPND line if present?)
+        # The atoms are only collected here - they are split into chains and residues when the model is complete
         if line.startswith('ATOM'):
             
-            # Create atom object
-            atom = pdb_model.PdbAtom(line)
-            
             # Check for the first model
             if not currentModel:
                 # This must be the first model and there should only be one
                 currentModel = pdb_model.PdbModel()
                 modelAtoms.append( [] )
-        
-            if atom.chainID != currentChain:
-                currentChain = atom.chainID
-                currentModel.chains.append( currentChain )
-                modelAtoms[ -1 ].append( [] )
             
-            modelAtoms[ -1 ][-1].append( atom )
+            modelAtoms[ -1 ].append( line )
             
         # Can ignore TER and ENDMDL for time being as we'll pick up changing chains anyway,
         # and new models get picked up by the models line
@@ -913,69 +1113,41 @@ def get_info(inpath):
         # End while loop
     
     # End of reading loop so add the last model to the list
+    if currentModel: currentModel.setAtoms( modelAtoms[ -1 ] )
     info.models.append( currentModel )
     
     f.close()
     
-    
     bbatoms = [ 'N','CA','C','O','CB' ]
     
-    # Now process the atoms
-    for modelIdx, model in enumerate( info.models ):
-        
-        chainList = modelAtoms[ modelIdx ]
-        
-        for chainIdx, atomList in enumerate( chainList ):
-            
-            # Paranoid check
-            assert model.chains[ chainIdx ] == atomList[0].chainID
-            
-            # Add list of atoms to model
-            model.atoms.append( atomList )
+    # Now process the residues of each chain
+    for model in info.models:
+        if model is None: continue
+        names = model.atom_data['name']
+        # Running counts of the CA and backbone atoms so the atoms of any range of atoms can be checked at once
+        counts = dict( ( bb, numpy.concatenate( ( [0], numpy.cumsum( names == bb ) ) ) ) for bb in bbatoms )
+        
+        for chainIdx in range( len( model.chains ) ):
+            starts = model.chainResidues( chainIdx )
+            natoms = starts[-1]
+            starts = starts[:-1]
+            # The atoms that are checked for each residue are those after its first atom up to and including
+            # the first atom of the next residue (all of the first residue and only up to the end of the last).
+            # If the last residue has a single atom it is skipped and the residue before it is checked against
+            # that atom alone. This preserves the results of the original atom-by-atom reading of the file.
+            lo = starts.copy()
+            lo[1:] += 1
+            hi = numpy.append( starts[1:], natoms - 1 )
+            if len( starts ) > 1 and starts[-1] == natoms - 1:
+                starts = starts[:-1]
+                lo, hi = lo[:-1], hi[:-1]
+                lo[-1] = natoms - 1
             
-            # Initialise new chain
-            currentResSeq = atomList[0].resSeq
-            currentResName = atomList[0].resName
-            model.resSeqs.append( [] )
-            model.sequences.append( "" )
-            model.caMask.append( [] )
-            model.bbMask.append( [] )
-            
-            atomTypes = []
-            for i, atom in enumerate( atomList ):
-                
-                aname = atom.name.strip()
-                if atom.resSeq != currentResSeq and i == len(atomList) -1 :
-                    # Edge case - last residue containing one atom
-                    atomTypes = [ aname ]
-                else:
-                    if aname not in atomTypes:
-                        atomTypes.append( aname )
-                
-                if atom.resSeq != currentResSeq or i == len(atomList) -1 :
-                    # End of reading the atoms for a residue
-                    model.resSeqs[ chainIdx ].append( currentResSeq  )
-                    model.sequences[ chainIdx ] += three2one[ currentResName ]
-                    
-                    if 'CA' not in atomTypes:
-                        model.caMask[ chainIdx ].append( True )
-                    else:
-                        model.caMask[ chainIdx ].append( False )
-                    
-                    missing=False
-                    for bb in bbatoms:
-                        if bb not in atomTypes:
-                            missing=True
-                            break
-                        
-                    if missing:
-                        model.bbMask[ chainIdx ].append( True )
-                    else:
-                        model.bbMask[ chainIdx ].append( False )
-                    
-                    currentResSeq = atom.resSeq
-                    currentResName = atom.resName
-                    atomTypes = []
+            present = dict( ( bb, counts[ bb ][ hi + 1 ] > counts[ bb ][ lo ] ) for bb in bbatoms )
+            model.resSeqs.append( model.atom_data['resSeq'][ starts ].tolist() )
+            model.sequences.append( "".join( [ three2one[ r ] for r in model.atom_data['resName'][ starts ] ] ) )
+            model.caMask.append( ( ~present['CA'] ).tolist() )
+            model.bbMask.append( ( ~numpy.logical_and.reduce( [ present[ bb ] for bb in bbatoms ] ) ).tolist() )
     
     return info
 
@@ -1149,8 +1321,7 @@ def num_atoms_and_residues(pdbin,first=False):
         natoms, nresidues, _ = _parse_rwcontents(logfile)
         os.unlink(logfile)
     else:
-        pdb_obj = iotbx.pdb.hierarchy.input(file_name=pdbin)
-        model=pdb_obj.hierarchy.models()[0]
+        model=cached_hierarchy(pdbin).models()[0]
         nresidues=len(model.chains()[0].residues())
         natoms=len(model.chains()[0].atoms())
         
@@ -1276,6 +1447,92 @@ def reliable_sidechains(inpath=None, outpath=None ):
     
     return
 
+def side_chain_variants(inpath, variants):
+    """Write several side chain treatments of a pdb file, reading it once.
+
+    The atoms kept are the same as for :func:`reliable_sidechains` and :func:`backbone`, but the selection uses
+    the fixed PDB columns and the atoms and residues of each output are counted as it is written, so there is
+    no need to run pdbcur or to re-parse the outputs with :func:`num_atoms_and_residues`.
+
+    Parameters
+    ----------
+    inpath : str
+       The pdb file to read
+    variants : list
+       A list of (outpath, treatment) tuples, where treatment is 'all' (copy all atoms), 'reliable'
+       (strip the unreliable side chains) or 'backbone' (N, CA, C, O and CB atoms only)
+
+    Returns
+    -------
+    counts : list
+       A (natoms, nresidues) tuple for the first chain of the first model of each output, 
+       as returned by num_atoms_and_residues(first=True)
+    """
+    reliable_res_names = set([ 'MET', 'ASP', 'PRO', 'GLN', 'LYS', 'ARG', 'GLU', 'SER'])
+    kept_atom_names = set([ 'N', 'CA', 'C', 'O', 'CB' ])
+    def keep_all(line):
+        return True
+    def keep_reliable(line):
+        return not (line.startswith('ATOM') and line[17:20].strip() in reliable_res_names \
+                    and line[12:16].strip() not in kept_atom_names)
+    def keep_backbone(line):
+        return line[12:16].strip() in kept_atom_names and line[76:78].strip() in ('', 'N', 'C', 'O')
+    selectors = { 'all' : keep_all, 'reliable' : keep_reliable, 'backbone' : keep_backbone }
+    
+    outputs = []
+    try:
+        for outpath, treatment in variants:
+            if treatment not in selectors: raise RuntimeError("Unrecognised side chain treatment: {0}".format(treatment))
+            outputs.append((open(outpath, 'w'), selectors[treatment], _FirstChainCounter()))
+        kept = [True] * len(outputs)
+        with open(inpath) as f:
+            for line in f:
+                record = line[0:6]
+                is_atom = record in ('ATOM  ', 'HETATM')
+                is_anisou = record in ('ANISOU', 'SIGATM', 'SIGUIJ')
+                for i, (out, keep, counter) in enumerate(outputs):
+                    if is_atom:
+                        kept[i] = keep(line)
+                        if not kept[i]: continue
+                    elif is_anisou:
+                        # These belong to the preceding atom
+                        if not kept[i]: continue
+                    out.write(line)
+                    counter.add(line)
+    finally:
+        for out, _, _ in outputs: out.close()
+    return [ counter.counts() for _, _, counter in outputs ]
+
+class _FirstChainCounter(object):
+    """Count the atoms and residues in the first chain of the first model of a stream of pdb records"""
+    def __init__(self):
+        self.natoms = 0
+        self.nresidues = 0
+        self._chain_id = None
+        self._residue = None
+        self._done = False
+
+    def add(self, line):
+        if self._done: return
+        record = line[0:6]
+        if record in ('ATOM  ', 'HETATM'):
+            chain_id = line[21]
+            if self._chain_id is None:
+                self._chain_id = chain_id
+            elif chain_id != self._chain_id:
+                self._done = True
+                return
+            residue = line[22:27]
+            if residue != self._residue:
+                self.nresidues += 1
+                self._residue = residue
+            self.natoms += 1
+        elif self.natoms and (record.startswith('TER') or record.startswith('ENDMDL')):
+            self._done = True
+
+    def counts(self):
+        return self.natoms, self.nresidues
+
 def reliable_sidechains_cctbx(pdbin=None, pdbout=None ):
     """Only output non-backbone atoms for residues in the res_names list.
     """
@@ -1330,7 +1587,7 @@ def rename_chains(inpdb=None, outpdb=None, fromChain=None, toChain=None ):
     return
 
 def resseq(pdbin):
-    return _resseq(iotbx.pdb.pdb_input(pdbin).construct_hierarchy())
+    return _resseq(cached_hierarchy(pdbin))
 
 def _resseq(hierarchy):
     """Extract the sequence of residues from a pdb file."""
@@ -1416,11 +1673,8 @@ def Xselect_residues(inpath=None, outpath=None, residues=None):
 
 def select_residues(pdbin, pdbout, delete=None, tokeep=None, delete_idx=None, tokeep_idx=None):
     
-    pdbf = iotbx.file_reader.any_file(pdbin, force_type="pdb")
-    pdbf.check_file_type("pdb")
-    hierarchy = pdbf.file_object.construct_hierarchy()
-    
-    crystal_symmetry=pdbf.file_object.crystal_symmetry()
+    hierarchy = cached_hierarchy(pdbin, copy=True)
+    crystal_symmetry = cached_pdb_input(pdbin).crystal_symmetry()
     
     if len(hierarchy.models()) > 1 or len(hierarchy.models()[0].chains()) > 1:
         print "pdb {0} has > 1 model or chain - only first model/chain will be kept".format(pdbin)
@@ -1465,8 +1719,63 @@ def select_residues(pdbin, pdbout, delete=None, tokeep=None, delete_idx=None, to
         f.write(hierarchy.as_pdb_string(anisou=False))
     return
 
+def select_residues_multiple(pdbin, selections):
+    """Create several pdbs from a single pdb, each keeping a different set of residue indices.
+
+    The pdb is only read once. The ATOM/HETATM records of the first chain of the first model are split into
+    residues and each output only contains the residues whose indices are in its set. As with select_residues,
+    HETATM residues are not counted when indexing and are kept in all outputs. ANISOU records are discarded.
+
+    Parameters
+    ----------
+    pdbin : str
+       The path to the input pdb
+    selections : list
+       A list of (pdbout, tokeep_idx) tuples with the path to an output pdb and the indices of the residues to keep
+    """
+    header = []
+    residues = [] # List of (index, lines) where index is None for HETATM residues
+    chain_id = None
+    last_resid = None
+    with open(pdbin) as f:
+        for line in f:
+            record = line[:6]
+            if record in ('CRYST1', 'SCALE1', 'SCALE2', 'SCALE3'):
+                header.append(line)
+            elif record in ('ATOM  ', 'HETATM'):
+                if chain_id is None:
+                    chain_id = line[21]
+                elif line[21] != chain_id:
+                    break
+                resid = line[22:27]
+                if resid != last_resid:
+                    residues.append([False, []])
+                    last_resid = resid
+                residues[-1][0] = residues[-1][0] or record == 'HETATM'
+                residues[-1][1].append(line)
+            elif (record.startswith('TER') or record == 'ENDMDL') and chain_id is not None:
+                break
+
+    if chain_id is None: raise RuntimeError("Cannot find any atoms in pdb: {0}".format(pdbin))
+
+    idx = -1
+    indexed = []
+    for hetero, lines in residues:
+        if not hetero: idx += 1
+        indexed.append((None if hetero else idx, "".join(lines)))
+
+    for pdbout, tokeep_idx in selections:
+        tokeep_idx = set(tokeep_idx)
+        with open(pdbout, 'w') as w:
+            w.write("REMARK Original file:\n")
+            w.write("REMARK   {0}\n".format(pdbin))
+            w.writelines(header)
+            w.writelines(lines for idx, lines in indexed if idx is None or idx in tokeep_idx)
+            w.write("TER\n")
+    return
+
 def sequence(pdbin):
-    return _sequence(iotbx.pdb.pdb_input(pdbin).construct_hierarchy())
+    return _sequence(cached_hierarchy(pdbin))
 
 def _sequence(hierarchy):
     """Extract the sequence of residues from a pdb file."""
@@ -1479,7 +1788,7 @@ def _sequence1(hierarchy):
     return d[sorted(d.keys())[0]]
 
 def sequence_data(pdbin):
-    return _sequence_data(iotbx.pdb.pdb_input(pdbin).construct_hierarchy())
+    return _sequence_data(cached_hierarchy(pdbin))
 
 def _sequence_data(hierarchy):
     """Extract the sequence of residues and resseqs from a pdb file."""
@@ -1879,6 +2188,52 @@ def translate(inpdb=None, outpdb=None, ftranslate=None):
         
     return
 
+def _first_chain_atom_lines(pdbin, names):
+    """Return the ATOM records of the atoms with the given names in the first chain of the first model of a pdb.
+
+    Only the first alternate location (blank or A) of each atom is kept.
+    """
+    lines = []
+    chain_id = None
+    with open(pdbin) as f:
+        for line in f:
+            if line.startswith('ENDMDL'): break
+            if not line.startswith('ATOM'): continue
+            if chain_id is None: chain_id = line[21]
+            elif line[21] != chain_id: break
+            if line[12:16].strip() in names and line[16] in ' A': lines.append(line)
+    return lines
+
+def ca_atoms(pdbin):
+    """Return a pdb_model.ATOM_DTYPE array of the CA atoms of the first chain of the first model of a pdb.
+
+    The file is read once and only the fixed columns of the CA records are parsed, so this is much quicker than
+    building a hierarchy when only the CA trace is needed.
+    """
+    return pdb_model.atom_array(_first_chain_atom_lines(pdbin, ('CA',)))
+
+def ca_coordinates(pdbins, nproc=1):
+    """Return an array of shape (len(pdbins), length, 3) of the CA coordinates read with ca_atoms.
+
+    Raises
+    ------
+    RuntimeError
+       The pdbs do not all have the same number of CA atoms
+    """
+    if nproc > 1:
+        pool = multiprocessing.Pool(nproc)
+        try:
+            atoms = pool.map(ca_atoms, pdbins, chunksize=max(1, len(pdbins) // (nproc * 4)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        atoms = [ca_atoms(pdbin) for pdbin in pdbins]
+    lengths = set(len(a) for a in atoms)
+    if len(lengths) != 1:
+        raise RuntimeError("Models need the same number of CA atoms but have: {0}".format(sorted(lengths)))
+    return numpy.array([a['xyz'] for a in atoms], dtype=numpy.float64)
+
 def xyz_coordinates(pdbin):
     ''' Extract xyz for all atoms '''
     pdb_input = iotbx.pdb.pdb_input(file_name=pdbin)
@@ -1913,6 +2268,30 @@ def xyz_cb_coordinates(pdbin):
 
     return cb_lst
 
+def cb_coordinates(pdbin):
+    """Return the residue numbers and CB coordinates (CA for glycine) of the first chain of the first model.
+
+    Only the CA and CB records are parsed, from their fixed columns, so this is much quicker than
+    xyz_cb_coordinates when the coordinates of large numbers of decoys are needed.
+
+    Returns
+    -------
+    resseq : :obj:`numpy.ndarray`
+       The residue sequence numbers of the residues with a CA or CB atom
+    xyz : :obj:`numpy.ndarray`
+       An (len(resseq), 3) array of the CB, or CA if there is no CB, coordinates of each residue
+    """
+    atoms = pdb_model.atom_array(_first_chain_atom_lines(pdbin, ('CA', 'CB')))
+    starts = numpy.ones(len(atoms), dtype=bool)
+    starts[1:] = (atoms['resSeq'][1:] != atoms['resSeq'][:-1]) | (atoms['iCode'][1:] != atoms['iCode'][:-1])
+    residue = numpy.cumsum(starts) - 1
+    xyz = numpy.empty((numpy.count_nonzero(starts), 3), dtype=numpy.float64)
+    # Set the CA coordinates first so that they are overwritten by any CB
+    for name in ('CA', 'CB'):
+        mask = atoms['name'] == name
+        xyz[residue[mask]] = atoms['xyz'][mask]
+    return atoms['resSeq'][starts], xyz
+
 def _xyz_cb_coordinates(hierarchy):
     res_lst = []
 
@@ -2005,6 +2384,69 @@ class Test(unittest.TestCase):
         
         return
 
+    def testGetInfoArrays(self):
+        """Atoms are held as arrays indexed by chain and residue"""
+
+        pdbfile = os.path.join(self.testfiles_dir,"4DZN.pdb")
+
+        info = get_info( pdbfile )
+        m1 = info.models[0]
+        self.assertEqual( m1.chains, ['A', 'B', 'C'] )
+        self.assertEqual( len(m1.atom_data), info.numAtoms( modelIdx=0 ) )
+        self.assertEqual( m1.chain_index[-1], len(m1.atom_data) )
+        self.assertEqual( [ len(a) for a in m1.atoms ], list(numpy.diff(m1.chain_index)) )
+
+        residues = m1.chainResidues( 1 )
+        self.assertEqual( residues[0], m1.chain_index[1] )
+        self.assertEqual( residues[-1], m1.chain_index[2] )
+        self.assertEqual( list(m1.atom_data['resSeq'][ residues[:-1] ]), m1.resSeqs[1] )
+        self.assertTrue( all( m1.atom_data['chainID'][ residues[0]:residues[-1] ] == 'B' ) )
+
+        import cPickle
+        info2 = cPickle.loads( cPickle.dumps( info, 2 ) )
+        self.assertTrue( numpy.array_equal( info2.models[0].atom_data, m1.atom_data ) )
+        self.assertEqual( info2.models[0].sequences, m1.sequences )
+        return
+
+    def testStructureCache(self):
+        """Parsed files are cached until they change or are evicted"""
+        import shutil, tempfile, time
+        wdir = tempfile.mkdtemp()
+        pdbs = []
+        for name in [ "1GU8.pdb", "2UUI.pdb", "4DZN.pdb" ]:
+            pdbs.append( os.path.join( wdir, name ) )
+            shutil.copy( os.path.join( self.testfiles_dir, name ), pdbs[-1] )
+
+        cache = structure_cache()
+        maxsize = cache.maxsize
+        try:
+            cache.clear()
+            cache.maxsize = 2
+            info = get_info( pdbs[0] )
+            self.assertTrue( get_info( pdbs[0] ) is info )
+            self.assertEqual( ( cache.hits, cache.misses ), ( 1, 1 ) )
+
+            # Changing the file invalidates the entry
+            with open( pdbs[0], 'a' ) as f: f.write( "\n" )
+            os.utime( pdbs[0], ( time.time() + 10, time.time() + 10 ) )
+            self.assertFalse( get_info( pdbs[0] ) is info )
+
+            # Least recently used entry is evicted
+            get_info( pdbs[1] )
+            get_info( pdbs[0] )
+            get_info( pdbs[2] )
+            self.assertEqual( len( cache ), 2 )
+            hits = cache.hits
+            get_info( pdbs[0] )
+            self.assertEqual( cache.hits, hits + 1 )
+            get_info( pdbs[1] )
+            self.assertEqual( cache.stats()['misses'], 5 )
+        finally:
+            cache.maxsize = maxsize
+            cache.clear()
+            shutil.rmtree( wdir )
+        return
+
     def testCheckPdbs(self):
         logging.basicConfig()
         logging.getLogger().setLevel(logging.DEBUG)
@@ -2016,9 +2458,25 @@ class Test(unittest.TestCase):
         
         pdbs += [ os.path.join(self.testfiles_dir,"1GU8.pdb") ]
         self.assertFalse(check_pdbs(pdbs,single=True,sequence="AABBCC"))
-        
+
         return
-    
+
+    def testCheckPdbsParallel(self):
+        pdbs=sorted(glob.glob(os.path.join(self.testfiles_dir,"models","*.pdb")))
+        nmodels, chains, sequence = _scan_pdb(pdbs[0])
+        self.assertEqual((nmodels, chains), (1, ['A']))
+        self.assertTrue(len(sequence) > 0)
+
+        self.assertTrue(check_pdbs(pdbs, nproc=2))
+        self.assertTrue(check_pdbs(pdbs, sequence=sequence, nproc=2))
+
+        checker = PdbChecker(sequence="AABBCC", nproc=1, fail_fast=True)
+        self.assertFalse(checker.add(pdbs[0]))
+        self.assertFalse(checker.add(pdbs[1]))
+        self.assertEqual(len(checker._results), 1)
+        self.assertFalse(checker.finish())
+        return
+
     def testSelectResidues(self):
         pdbin = os.path.join(self.testfiles_dir,"4DZN.pdb")
         pdbout = "testSelectResidues1.pdb"
@@ -2053,6 +2511,23 @@ class Test(unittest.TestCase):
         
         return
     
+    def testSelectResiduesMultiple(self):
+        pdbin = os.path.join(self.testfiles_dir,"4DZN.pdb")
+        selections = [ ("testSelectResiduesMultiple1.pdb", [0,5,10,15,20]),
+                       ("testSelectResiduesMultiple2.pdb", range(10)) ]
+        
+        select_residues_multiple(pdbin, selections)
+        
+        for pdbout, tokeep_idx in selections:
+            ref = "testSelectResiduesMultipleRef.pdb"
+            select_residues(pdbin=pdbin, pdbout=ref, tokeep_idx=tokeep_idx)
+            self.assertEqual(resseq(pdbout), resseq(ref))
+            self.assertEqual(num_atoms_and_residues(pdbout, first=True), num_atoms_and_residues(ref, first=True))
+            os.unlink(pdbout)
+            os.unlink(ref)
+        
+        return
+    
     def testSequence1(self):
         pdbin=os.path.join(self.testfiles_dir,"4DZN.pdb")
         ref={ 'A' :'GEIAALKQEIAALKKEIAALKEIAALKQGYY',
@@ -2184,6 +2659,24 @@ class Test(unittest.TestCase):
         
         return
     
+    def testSideChainVariants(self):
+        pdbin=os.path.join(self.testfiles_dir,"1GU8.pdb")
+        variants = [("all.pdb", 'all'), ("reliable.pdb", 'reliable'), ("backbone.pdb", 'backbone')]
+        counts = side_chain_variants(pdbin, variants)
+        for (pdbout, _), (natoms, nresidues) in zip(variants, counts):
+            self.assertEqual((natoms, nresidues), num_atoms_and_residues(pdbout, first=True))
+        
+        with open(pdbin) as f1, open("all.pdb") as f2: self.assertEqual(f1.read(), f2.read())
+        
+        reliable_sidechains(pdbin, "reliable_ref.pdb")
+        with open("reliable_ref.pdb") as f1, open("reliable.pdb") as f2: self.assertEqual(f1.read(), f2.read())
+        
+        pdb_obj = iotbx.pdb.hierarchy.input(file_name="backbone.pdb")
+        names = set([a.name.strip() for a in pdb_obj.hierarchy.atoms()])
+        self.assertTrue(names.issubset(set(['N', 'CA', 'C', 'O', 'CB'])))
+        for f in ["all.pdb", "reliable.pdb", "backbone.pdb", "reliable_ref.pdb"]: os.unlink(f)
+        return
+    
     def testXyzCoordinates(self):
         pdbin=os.path.join(self.testfiles_dir,"4DZN.pdb")
         test_hierarchy = iotbx.pdb.pdb_input( file_name=pdbin ).construct_hierarchy()
@@ -2228,6 +2721,26 @@ class Test(unittest.TestCase):
         self.assertSequenceEqual(ref_data_start[1], xyz_cb_lst[1][:6])
         self.assertEqual(35, len(xyz_cb_lst))
 
+    def testCbCoordinates(self):
+        pdbin=os.path.join(self.testfiles_dir,"4DZN.pdb")
+        resseq, xyz = cb_coordinates(pdbin)
+        # Only the ATOM records of chain A are used so the HETATM residues 0 and 22 are missing
+        self.assertEqual(range(1, 22) + range(23, 33), resseq.tolist())
+        ref_data_start = [(22.806, 12.124, -9.698),
+                          (19.625,  8.485, -9.531),
+                          (24.783,  6.398, -9.051),
+                          (25.599, 10.846, -6.036),
+                          (20.430, 10.143, -4.644)]
+        self.assertTrue(numpy.allclose(ref_data_start, xyz[:5], atol=1e-3))
+
+    def testCaAtoms(self):
+        pdbin=os.path.join(self.testfiles_dir,"4DZN.pdb")
+        atoms = ca_atoms(pdbin)
+        # The same chain A residues as cb_coordinates
+        self.assertEqual(range(1, 22) + range(23, 33), atoms['resSeq'].tolist())
+        self.assertEqual(set(['A']), set(atoms['chainID']))
+        self.assertTrue(numpy.allclose([(22.806, 12.124, -9.698), (20.675, 9.156, -8.637)], atoms['xyz'][:2], atol=1e-3))
+
 
 if __name__ == "__main__":
     #unittest.TextTestRunner(verbosity=2).run(testSuite())
@@ -7,9 +7,18 @@ Classes for holding data from PDB files
 '''
 
 import copy
+import numpy
 import os
 import types
 
+# Columnar storage for the ATOM records of a PdbModel - one row per atom
+ATOM_DTYPE = numpy.dtype([('name', 'S4'),
+                          ('resName', 'S3'),
+                          ('chainID', 'S1'),
+                          ('resSeq', numpy.int32),
+                          ('iCode', 'S1'),
+                          ('xyz', numpy.float32, (3,))])
+
 
 class OriginInfo( object ):
     
@@ -493,18 +502,14 @@ class PdbInfo(object):
         
         assert len(self.models) >= 1,"Need at least one model!"
         assert len(self.models[0].chains) >= 1,"Need at least one chain!"
-        return self.sequences[0]
+        return self.models[0].sequences[0]
     
     def numAtoms(self, modelIdx=0):
         """Return the total number of ATOM atoms in the model"""
         assert len(self.models) >= 1,"Need at least one model!"
         assert len(self.models[modelIdx].chains) >= 1,"Need at least one chain!"
         
-        natoms = 0
-        for chainAtoms in self.models[ modelIdx ].atoms:
-            natoms += len( chainAtoms )
-            
-        return natoms
+        return len(self.models[ modelIdx ].atom_data)
     
     def numChains(self, modelIdx=0):
         """Return the total number of chains in the model"""
@@ -517,23 +522,25 @@ class PdbInfo(object):
         assert len(self.models) >= 1,"Need at least one model!"
         assert len(self.models[modelIdx].chains) >= 1,"Need at least one chain!"
         
-        ncalpha = 0
-        for chainAtoms in self.models[ modelIdx ].atoms:
-            for atom in chainAtoms:
-                if atom.name.strip() == 'CA':
-                    ncalpha += 1
-            
-        return ncalpha
+        return int(numpy.count_nonzero(self.models[ modelIdx ].atom_data['name'] == 'CA'))
     
 class PdbModel(object):
-    """A class to hold information on a single model in a PDB file"""
+    """A class to hold information on a single model in a PDB file
+
+    The ATOM records are held in a single numpy structured array (atom_data) rather than as PdbAtom objects,
+    with the chain and residue boundaries stored as arrays of indices into it, so that large structures and
+    multi-model NMR ensembles are cheap to parse, hold and pickle.
+    """
     
     def __init__(self ):
         
         self.pdb = None
         self.serial = None
         self.chains = [] # Ordered list of chain IDs
-        self.atoms = [] # List of atoms in each chain
+        
+        self.atom_data = numpy.empty(0, dtype=ATOM_DTYPE) # Array of all the ATOM records in the model
+        self.chain_index = numpy.zeros(1, dtype=numpy.intp) # Index of the first atom of each chain, with the number of atoms appended
+        self.residue_index = numpy.zeros(1, dtype=numpy.intp) # Index of the first atom of each residue, with the number of atoms appended
         
         self.resSeqs = [] # Ordered list of list of resSeqs for each chain - matches order in self.chains
         self.sequences = [] # Ordered list of list of sequences for each chain - matches order in self.chains
@@ -541,6 +548,59 @@ class PdbModel(object):
         self.bbMask = [] # Ordered list of list of boleans of residues with no backbone atoms - matches order in self.chains
         
         return
+    
+    @property
+    def atoms(self):
+        """List of the atom_data records for each chain - matches order in self.chains"""
+        return [ self.atom_data[start:end] for start, end in zip(self.chain_index[:-1], self.chain_index[1:]) ]
+    
+    def chainResidues(self, chainIdx):
+        """Return the residue_index entries (including the end of the last residue) for the chain"""
+        start, end = self.chain_index[chainIdx], self.chain_index[chainIdx + 1]
+        lo, hi = numpy.searchsorted(self.residue_index, [start, end])
+        return self.residue_index[lo:hi + 1]
+    
+    def setAtoms(self, lines):
+        """Set the atom_data, chains and chain/residue boundaries from a list of ATOM record lines"""
+        natoms = len(lines)
+        self.atom_data = atom_array(lines)
+        if not natoms:
+            self.chains = []
+            self.chain_index = numpy.zeros(1, dtype=numpy.intp)
+            self.residue_index = numpy.zeros(1, dtype=numpy.intp)
+            return
+        
+        # A new chain starts whenever the chainID changes and a new residue whenever the chain or resSeq does
+        chainID = self.atom_data['chainID']
+        newChain = numpy.concatenate(([True], chainID[1:] != chainID[:-1]))
+        resSeq = self.atom_data['resSeq']
+        newResidue = newChain.copy()
+        newResidue[1:] |= resSeq[1:] != resSeq[:-1]
+        
+        chainStarts = numpy.flatnonzero(newChain)
+        self.chain_index = numpy.append(chainStarts, natoms)
+        self.residue_index = numpy.append(numpy.flatnonzero(newResidue), natoms)
+        self.chains = [ c if c.strip() else None for c in chainID[chainStarts] ]
+        return
+
+
+def atom_array(lines):
+    """Return an ATOM_DTYPE array of the ATOM/HETATM record lines, read from their fixed columns"""
+    natoms = len(lines)
+    atoms = numpy.empty(natoms, dtype=ATOM_DTYPE)
+    if not natoms: return atoms
+    # View the first 54 columns of all the lines as a 2D array of characters and cut out the fields
+    cols = numpy.array([ l[:54] for l in lines ], dtype='S54').view('S1').reshape(natoms, 54)
+    field = lambda start, end: numpy.ascontiguousarray(cols[:, start:end]).view('S{0}'.format(end - start)).ravel()
+    atoms['name'] = numpy.char.strip(field(12, 16))
+    atoms['resName'] = numpy.char.strip(field(17, 20))
+    atoms['chainID'] = field(21, 22)
+    resSeq = field(22, 26)
+    resSeq[numpy.char.strip(resSeq) == ''] = '0'
+    atoms['resSeq'] = resSeq.astype(numpy.int32)
+    atoms['iCode'] = field(26, 27)
+    atoms['xyz'] = field(30, 54).view('S8').reshape(natoms, 3).astype(numpy.float32)
+    return atoms
 
 class PdbAtom(object):
     """
@@ -90,12 +90,26 @@ class AmpleOutput(object):
                "SXRAP_final_Rfree" : "Rfree score for ARPWARP rebuild of the SHELXE C-alpha trace",
                }
     
+    # The programs whose outputs are shown for each result and the titles of their sections
+    _program_outputs = [("PHASER", "PHASER Outputs"),
+                        ("REFMAC", "REFMAC Outputs"),
+                        ("BUCC", "BUCCANEER Outputs"),
+                        ("ARP", "ARPWARP Outputs"),
+                        ("SHELXE", "SHELXE Outputs"),
+                        ("SXRBUCC", "BUCCANEER SHELXE Trace Rebuild Outputs"),
+                        ("SXRARP", "ARPWARP SHELXE Trace Redbuild Outputs"),
+                        ]
+    
     def __init__(self, amopt, own_gui=False):
         self.header = False
         self.log_tab_id = None
         self.old_mrbump_results = None
         self.results_tab_id = None
         self.results_tab_sections = []
+        self.summary_tab_results_table_data = None
+        self._ensembles_data = None
+        self._ensembles_by_name = {}
+        self._results_sections = {} # section title -> data on the section and the panels it contains
         self.summary_tab_id = None
         self.summary_tab_ensemble_sec_id = None
         self.summary_tab_results_sec_id = None
@@ -185,31 +199,25 @@ class AmpleOutput(object):
         
         mrb_results = ample_dict['mrbump_results']
         if mrb_results == self.old_mrbump_results: return
-        self.old_mrbump_results = mrb_results
+        self.old_mrbump_results = list(mrb_results)
         
         if not self.results_tab_id:
             self.results_tab_id = "results_tab"
             # Insert results tab before summary tab
             pyrvapi.rvapi_insert_tab(self.results_tab_id, "Results", self.summary_tab_id, False)  # Last arg is "open" - i.e. show or hide
         
-        # Delete old sections:
-        pyrvapi.rvapi_flush()
-        for section_id in self.results_tab_sections:
-            pyrvapi.rvapi_remove_widget(section_id)
-        pyrvapi.rvapi_flush()
-        self.results_tab_sections = []
-        
-        ensemble_results = ample_dict['ensembles_data'] if 'ensembles_data' in ample_dict['ensembles_data'] else None
+        # The sections are updated in place, only changing the panels of the results that differ
+        ensemble_index = self.ensemble_index(ample_dict.get('ensembles_data'))
         mrbsum = mrbump_util.ResultsSummary(results=mrb_results[0:min(len(mrb_results),mrbump_util.TOP_KEEP)])
         mrbsum.sortResults(prioritise="SHELXE_CC")
         self.results_section(self.results_tab_id,
                              mrbsum.results,
-                             ensemble_results,
+                             ensemble_index,
                              "Top {0} SHELXE Results".format(mrbump_util.TOP_KEEP))
         mrbsum.sortResults(prioritise="PHASER_TFZ")
         self.results_section(self.results_tab_id,
                              mrbsum.results,
-                             ensemble_results,
+                             ensemble_index,
                              "Top {0} PHASER Results".format(mrbump_util.TOP_KEEP))
         
         return self.results_tab_id
@@ -290,12 +298,13 @@ class AmpleOutput(object):
             self.summary_tab_results_sec_table_id = "mrbump_table"
             pyrvapi.rvapi_add_table1(self.summary_tab_results_sec_id + "/" + self.summary_tab_results_sec_table_id, "MRBUMP Results", 1, 0, 1, 1, True)
         
-        mrb_results = ample_dict['mrbump_results']
-        if not mrb_results == self.old_mrbump_results:
-            # We set old_mrbump_results when we create the results_tab
-            self.fill_table(self.summary_tab_results_sec_table_id,
-                             mrbump_util.ResultsSummary().results_table(mrb_results),
-                             tooltips=self._mrbump_tooltips)
+        # Only the cells that have changed since the last update are written
+        tdata = mrbump_util.ResultsSummary().results_table(ample_dict['mrbump_results'])
+        self.fill_table(self.summary_tab_results_sec_table_id,
+                        tdata,
+                        tooltips=self._mrbump_tooltips,
+                        old_tdata=self.summary_tab_results_table_data)
+        self.summary_tab_results_table_data = tdata
             
         #
         # Survey section
@@ -319,15 +328,24 @@ class AmpleOutput(object):
         pyrvapi.rvapi_flush()
         return True
 
-    def ensemble_pdb(self, mrbump_result, ensembles_data):
+    def ensemble_index(self, ensembles_data):
+        """Return a dictionary mapping the names of the ensembles to their data.
+        
+        The dictionary is only rebuilt when we are given a different list of ensembles_data.
+        """
+        if not ensembles_data: return {}
+        if ensembles_data is not self._ensembles_data:
+            self._ensembles_data = ensembles_data
+            self._ensembles_by_name = dict((e['name'], e) for e in ensembles_data)
+        return self._ensembles_by_name
+    
+    def ensemble_pdb(self, mrbump_result, ensemble_index):
         try:
-            ensemble_dict = None
-            for e in ensembles_data:
-                if e['name'] == mrbump_result['ensemble_name']:
-                    ensemble_dict = e
-                    break
-            if os.path.isfile(ensemble_dict['ensemble_pdb']):
-                return ensemble_dict['ensemble_pdb']
+            ensemble_dict = ensemble_index[mrbump_result['ensemble_name']]
+            # Imported ensembles have an ensemble_pdb, those we create just a pdb
+            epdb = ensemble_dict.get('ensemble_pdb') or ensemble_dict['pdb']
+            if os.path.isfile(epdb):
+                return epdb
             else:
                 return False
         except:
@@ -339,19 +357,32 @@ class AmpleOutput(object):
             return urlparse.urljoin(self.webserver_uri, path[self._webserver_start:])
         else: return path
         
-    def fill_table(self, table_id, tdata, tooltips={}):
-        # Make column headers
-        for i in range(len(tdata[0])):  # Skip name as it's the row header
-            h = tdata[0][i]
-            tt = tooltips[h] if h in tooltips else ""
-            pyrvapi.rvapi_put_horz_theader(table_id, h.encode('utf-8'), tt, i)  # Add table data
+    def fill_table(self, table_id, tdata, tooltips={}, old_tdata=None):
+        """Fill a table with the rows of tdata, the first of which holds the column headers.
+        
+        If old_tdata, the data the table was last filled with, is given and has the same headers, only
+        the cells that differ from it are written.
+        """
+        if old_tdata and old_tdata[0] == tdata[0]:
+            start = len(old_tdata) - 1
+        else:
+            old_tdata = None
+            start = 0
+            # Make column headers
+            for i in range(len(tdata[0])):  # Skip name as it's the row header
+                h = tdata[0][i]
+                tt = tooltips[h] if h in tooltips else ""
+                pyrvapi.rvapi_put_horz_theader(table_id, h.encode('utf-8'), tt, i)  # Add table data
         
         for i in range(1, len(tdata)):
+            old_row = old_tdata[i] if old_tdata and i < len(old_tdata) else None
+            if tdata[i] == old_row: continue
             for j in range(len(tdata[i])):
+                if old_row and tdata[i][j] == old_row[j]: continue
                 pyrvapi.rvapi_put_table_string(table_id, str(tdata[i][j]), i - 1, j)
         
-        # Now colour the ensemble name cells
-        for i in range(len(tdata) - 1):
+        # Now colour the ensemble name cells of any new rows
+        for i in range(start, len(tdata) - 1):
             pyrvapi.rvapi_shape_table_cell(table_id,  # tableId
                 i,  # row
                 0,  # column
@@ -366,206 +397,125 @@ class AmpleOutput(object):
     def _got_mrbump_results(self, ample_dict):
         return 'mrbump_results' in ample_dict and ample_dict['mrbump_results'] and len(ample_dict['mrbump_results'])
 
-    def results_section(self, results_tab_id, mrb_results, ensemble_results, section_title):
+    def results_section(self, results_tab_id, mrb_results, ensemble_index, section_title):
+        """Display a list of results in a section of the results tab.
+        
+        The section is only recreated if the ensembles it lists or their order have changed. Otherwise only the
+        panels of the results that have changed since the last call are updated.
+        """
         #
         # Results Tab
         #
         if not mrb_results: return
-    
-        # Create unique identifier for this section by using the id
-        # All ids will have this appended to avoid clashes
-        uid = str(uuid.uuid4())
         
-        section_id = section_title.replace(" ","_") + uid
-        self.results_tab_sections.append(section_id) # Add to list so we can remove if we update
+        names = [r['ensemble_name'] for r in mrb_results]
+        section = self._results_sections.get(section_title)
+        if section and section['names'] != names:
+            pyrvapi.rvapi_flush()
+            pyrvapi.rvapi_remove_widget(section['id'])
+            pyrvapi.rvapi_flush()
+            self.results_tab_sections.remove(section['id'])
+            section = None
         
-        pyrvapi.rvapi_add_panel(section_id, results_tab_id, 0, 0, 1, 1)
-        pyrvapi.rvapi_add_text("<h3>{0}</h3>".format(section_title), section_id, 0, 0, 1, 1)
-    
-        results_tree = "results_tree" + section_id
-        pyrvapi.rvapi_add_tree_widget(results_tree, section_title, section_id, 0, 0, 1, 1)
+        if section is None:
+            # Create unique identifier for this section by using the id
+            # All ids will have this appended to avoid clashes
+            uid = str(uuid.uuid4())
+            section_id = section_title.replace(" ","_") + uid
+            self.results_tab_sections.append(section_id) # Add to list so we can remove if we update
+            
+            pyrvapi.rvapi_add_panel(section_id, results_tab_id, 0, 0, 1, 1)
+            pyrvapi.rvapi_add_text("<h3>{0}</h3>".format(section_title), section_id, 0, 0, 1, 1)
+            
+            results_tree = "results_tree" + section_id
+            pyrvapi.rvapi_add_tree_widget(results_tree, section_title, section_id, 0, 0, 1, 1)
+            section = { 'id' : section_id, 'uid' : uid, 'tree' : results_tree, 'names' : names, 'panels' : {} }
+            self._results_sections[section_title] = section
         
         for r in mrb_results:
-            name = r['ensemble_name']
+            panel = section['panels'].get(r['ensemble_name'])
+            if panel and panel['result'] == r: continue
+            self.result_panel(section, r, ensemble_index)
+        return
+    
+    def result_panel(self, section, r, ensemble_index):
+        """Create or update the panel for a single result in a section of the results tab.
+        
+        The table of results is rewritten and the sections for any outputs that have appeared since the
+        panel was last updated are added.
+        """
+        name = r['ensemble_name']
+        uid = section['uid']
+        container_id = "sec_{0}".format(name) + uid
+        panel = section['panels'].get(name)
+        if panel is None:
             # container_id="sec_{0}".format(name)
             # pyrvapi.rvapi_add_section(container_id,"Results for: {0}".format(name),results_tree,0,0,1,1,True)
-            container_id = "sec_{0}".format(name) + uid
-            pyrvapi.rvapi_add_panel(container_id, results_tree, 0, 0, 1, 1)
+            pyrvapi.rvapi_add_panel(container_id, section['tree'], 0, 0, 1, 1)
             
             header = "<h3>Results for ensemble: {0}</h3>".format(name)
             pyrvapi.rvapi_add_text(header, container_id, 0, 0, 1, 1)
             
             sec_table = "sec_table_{0}".format(name) + uid
-            title = "Results table: {0}".format(name)
             title = "Summary"
             pyrvapi.rvapi_add_section(sec_table, title, container_id, 0, 0, 1, 1, True)
-            table_id = "table_{0}".format(name) + uid
-            pyrvapi.rvapi_add_table(table_id, "", sec_table, 1, 0, 1, 1, False)
-            tdata = mrbump_util.ResultsSummary().results_table([r])
-            self.fill_table(table_id, tdata, tooltips=self._mrbump_tooltips)
-            
-            # Ensemble
-            if ensemble_results:
-                epdb = self.ensemble_pdb(r, ensemble_results)
-                if epdb:
-                    sec_ensemble = "sec_ensemble_{0}".format(name) + uid
-                    pyrvapi.rvapi_add_section(sec_ensemble, "Ensemble Search Model", container_id, 0, 0, 1, 1, False)
-                    data_ensemble = "data_ensemble_{0}".format(name) + uid
-                    pyrvapi.rvapi_add_data(data_ensemble,
-                                            "Ensemble PDB",
-                                            self.fix_path(epdb),
-                                            "XYZOUT",
-                                            sec_ensemble,
-                                            2, 0, 1, 1, True)
-            # PHASER
-            if os.path.isfile(str(r['PHASER_logfile'])) or (os.path.isfile(str(r['PHASER_pdbout'])) and os.path.isfile(str(r['PHASER_mtzout']))):
-                sec_phaser = "sec_phaser_{0}".format(name) + uid
-                pyrvapi.rvapi_add_section(sec_phaser, "PHASER Outputs", container_id, 0, 0, 1, 1, False)
-                if os.path.isfile(str(r['PHASER_pdbout'])) and os.path.isfile(str(r['PHASER_mtzout'])):
-                    data_phaser = "data_phaser_out_{0}".format(name) + uid
-                    pyrvapi.rvapi_add_data(data_phaser,
-                                            "PHASER PDB",
-                                            os.path.splitext(self.fix_path(r['PHASER_pdbout']))[0],
-                                            "xyz:map",
-                                            sec_phaser,
-                                            2, 0, 1, 1, True)
-                    pyrvapi.rvapi_append_to_data(data_phaser, self.fix_path(r['PHASER_mtzout']), "xyz:map")
-                if os.path.isfile(str(r['PHASER_logfile'])):
-                    pyrvapi.rvapi_add_data("data_phaser_logfile_{0}".format(name),
-                                            "PHASER Logfile",
-                                            self.fix_path(r['PHASER_logfile']),
-                                            "text",
-                                            sec_phaser,
-                                            2, 0, 1, 1, True)
-                    
-            # REFMAC
-            if os.path.isfile(str(r['REFMAC_logfile'])) or (os.path.isfile(str(r['REFMAC_pdbout'])) and os.path.isfile(str(r['REFMAC_mtzout']))):
-                sec_refmac = "sec_refmac_{0}".format(name) + uid
-                pyrvapi.rvapi_add_section(sec_refmac, "REFMAC Outputs", container_id, 0, 0, 1, 1, False)
-                if os.path.isfile(str(r['REFMAC_pdbout'])) and os.path.isfile(str(r['REFMAC_mtzout'])):
-                    data_refmac = "data_refmac_out_{0}".format(name) + uid
-                    pyrvapi.rvapi_add_data(data_refmac,
-                                            "REFMAC PDB",
-                                            os.path.splitext(self.fix_path(r['REFMAC_pdbout']))[0],
-                                            "xyz:map",
-                                            sec_refmac,
-                                            2, 0, 1, 1, True)
-                    pyrvapi.rvapi_append_to_data(data_refmac, self.fix_path(r['REFMAC_mtzout']), "xyz:map")
-                if os.path.isfile(str(r['REFMAC_logfile'])):
-                    pyrvapi.rvapi_add_data("data_refmac_logfile_{0}".format(name),
-                                            "REFMAC Logfile",
-                                            self.fix_path(r['REFMAC_logfile']),
-                                            "text",
-                                            sec_refmac,
-                                            2, 0, 1, 1, True)
-    
-            # Buccaner
-            if os.path.isfile(str(r['BUCC_logfile'])) or (os.path.isfile(str(r['BUCC_pdbout'])) and os.path.isfile(str(r['BUCC_mtzout']))):
-                sec_bucc = "sec_bucc_{0}".format(name) + uid
-                pyrvapi.rvapi_add_section(sec_bucc, "BUCCANEER Outputs", container_id, 0, 0, 1, 1, False)
-                if os.path.isfile(str(r['BUCC_pdbout'])) and os.path.isfile(str(r['BUCC_mtzout'])):
-                    data_bucc = "data_bucc_out_{0}".format(name) + uid
-                    pyrvapi.rvapi_add_data(data_bucc,
-                                            "BUCC PDB",
-                                            os.path.splitext(self.fix_path(r['BUCC_pdbout']))[0],
-                                            "xyz:map",
-                                            sec_bucc,
-                                            2, 0, 1, 1, True)
-                    pyrvapi.rvapi_append_to_data(data_bucc, self.fix_path(r['BUCC_mtzout']), "xyz:map")
-                if os.path.isfile(str(r['BUCC_logfile'])):
-                    pyrvapi.rvapi_add_data("data_bucc_logfile_{0}".format(name),
-                                            "BUCC Logfile",
-                                            self.fix_path(r['BUCC_logfile']),
-                                            "text",
-                                            sec_bucc,
-                                            2, 0, 1, 1, True)
-                    
-            # Arpwarp
-            if os.path.isfile(str(r['ARP_logfile'])) or (os.path.isfile(str(r['ARP_pdbout'])) and os.path.isfile(str(r['ARP_mtzout']))):
-                sec_arp = "sec_arp_{0}".format(name) + uid
-                pyrvapi.rvapi_add_section(sec_arp, "ARPWARP Outputs", container_id, 0, 0, 1, 1, False)
-                if os.path.isfile(str(r['ARP_pdbout'])) and os.path.isfile(str(r['ARP_mtzout'])):
-                    data_arp = "data_arp_out_{0}".format(name) + uid
-                    pyrvapi.rvapi_add_data(data_arp,
-                                            "ARP PDB",
-                                            os.path.splitext(self.fix_path(r['ARP_pdbout']))[0],
-                                            "xyz:map",
-                                            sec_arp,
-                                            2, 0, 1, 1, True)
-                    pyrvapi.rvapi_append_to_data(data_arp, self.fix_path(r['ARP_mtzout']), "xyz:map")
-                if os.path.isfile(str(r['ARP_logfile'])):
-                    pyrvapi.rvapi_add_data("data_arp_logfile_{0}".format(name),
-                                            "ARP Logfile",
-                                            self.fix_path(r['ARP_logfile']),
-                                            "text",
-                                            sec_arp,
-                                            2, 0, 1, 1, True)
-    
-          
-            # SHELXE
-            if os.path.isfile(str(r['SHELXE_logfile'])) or (os.path.isfile(str(r['SHELXE_pdbout'])) and os.path.isfile(str(r['SHELXE_mtzout']))):
-                sec_shelxe = "sec_shelxe_{0}".format(name) + uid
-                pyrvapi.rvapi_add_section(sec_shelxe, "SHELXE Outputs", container_id, 0, 0, 1, 1, False)
-                if os.path.isfile(str(r['SHELXE_pdbout'])) and os.path.isfile(str(r['SHELXE_mtzout'])):
-                    data_shelxe = "data_shelxe_out_{0}".format(name) + uid
-                    pyrvapi.rvapi_add_data(data_shelxe,
-                                            "SHELXE PDB",
-                                            os.path.splitext(self.fix_path(r['SHELXE_pdbout']))[0],
-                                            "xyz:map",
-                                            sec_shelxe,
-                                            2, 0, 1, 1, True)
-                    pyrvapi.rvapi_append_to_data(data_shelxe, self.fix_path(r['SHELXE_mtzout']), "xyz:map")
-                if os.path.isfile(str(r['SHELXE_logfile'])):
-                    pyrvapi.rvapi_add_data("data_shelxe_logfile_{0}".format(name),
-                                            "SHELXE Logfile",
-                                            self.fix_path(r['SHELXE_logfile']),
-                                            "text",
-                                            sec_shelxe,
-                                            2, 0, 1, 1, True)
-            
-            # Buccaner Rebuild
-            if os.path.isfile(str(r['SXRBUCC_logfile'])) or (os.path.isfile(str(r['SXRBUCC_pdbout'])) and os.path.isfile(str(r['SXRBUCC_mtzout']))):
-                sec_sxrbucc = "sec_sxrbucc_{0}".format(name) + uid
-                pyrvapi.rvapi_add_section(sec_sxrbucc, "BUCCANEER SHELXE Trace Rebuild Outputs", container_id, 0, 0, 1, 1, False)
-                if os.path.isfile(str(r['SXRBUCC_pdbout'])) and os.path.isfile(str(r['SXRBUCC_mtzout'])):
-                    data_sxrbucc = "data_sxrbucc_out_{0}".format(name) + uid
-                    pyrvapi.rvapi_add_data(data_sxrbucc,
-                                            "SXRBUCC PDB",
-                                            os.path.splitext(self.fix_path(r['SXRBUCC_pdbout']))[0],
-                                            "xyz:map",
-                                            sec_sxrbucc,
-                                            2, 0, 1, 1, True)
-                    pyrvapi.rvapi_append_to_data(data_sxrbucc, self.fix_path(r['SXRBUCC_mtzout']), "xyz:map")
-                if os.path.isfile(str(r['SXRBUCC_logfile'])):
-                    pyrvapi.rvapi_add_data("data_sxrbucc_logfile_{0}".format(name),
-                                            "SXRBUCC Logfile",
-                                            self.fix_path(r['SXRBUCC_logfile']),
-                                            "text",
-                                            sec_sxrbucc,
-                                            2, 0, 1, 1, True)
-                    
-            # Arpwarp Rebuild
-            if os.path.isfile(str(r['SXRARP_logfile'])) or (os.path.isfile(str(r['SXRARP_pdbout'])) and os.path.isfile(str(r['SXRARP_mtzout']))):
-                sec_sxrarp = "sec_sxrarp_{0}".format(name) + uid
-                pyrvapi.rvapi_add_section(sec_sxrarp, "ARPWARP SHELXE Trace Redbuild Outputs", container_id, 0, 0, 1, 1, False)
-                if os.path.isfile(str(r['SXRARP_pdbout'])) and os.path.isfile(str(r['SXRARP_mtzout'])):
-                    data_sxrarp = "data_sxrarp_out_{0}".format(name) + uid
-                    pyrvapi.rvapi_add_data(data_sxrarp,
-                                            "SXRARP PDB",
-                                            os.path.splitext(self.fix_path(r['SXRARP_pdbout']))[0],
-                                            "xyz:map",
-                                            sec_sxrarp,
-                                            2, 0, 1, 1, True)
-                    pyrvapi.rvapi_append_to_data(data_sxrarp, self.fix_path(r['SXRARP_mtzout']), "xyz:map")
-                if os.path.isfile(str(r['SXRARP_logfile'])):
-                    pyrvapi.rvapi_add_data("data_sxrarp_logfile_{0}".format(name),
-                                            "SXRARP Logfile",
-                                            self.fix_path(r['SXRARP_logfile']),
-                                            "text",
-                                            sec_sxrarp,
-                                            2, 0, 1, 1, True)
-            
-            pyrvapi.rvapi_set_tree_node(results_tree, container_id, "{0}".format(name), "auto", "")
+            pyrvapi.rvapi_add_table("table_{0}".format(name) + uid, "", sec_table, 1, 0, 1, 1, False)
+            panel = { 'result' : None, 'widgets' : set() }
+            section['panels'][name] = panel
+        
+        tdata = mrbump_util.ResultsSummary().results_table([r])
+        self.fill_table("table_{0}".format(name) + uid, tdata, tooltips=self._mrbump_tooltips)
+        
+        # Ensemble
+        widgets = panel['widgets']
+        if ensemble_index and 'ensemble' not in widgets:
+            epdb = self.ensemble_pdb(r, ensemble_index)
+            if epdb:
+                sec_ensemble = "sec_ensemble_{0}".format(name) + uid
+                pyrvapi.rvapi_add_section(sec_ensemble, "Ensemble Search Model", container_id, 0, 0, 1, 1, False)
+                data_ensemble = "data_ensemble_{0}".format(name) + uid
+                pyrvapi.rvapi_add_data(data_ensemble,
+                                        "Ensemble PDB",
+                                        self.fix_path(epdb),
+                                        "XYZOUT",
+                                        sec_ensemble,
+                                        2, 0, 1, 1, True)
+                widgets.add('ensemble')
+        
+        # Outputs of the programs
+        for program, title in self._program_outputs:
+            logfile = str(r[program + '_logfile'])
+            pdbout = str(r[program + '_pdbout'])
+            mtzout = str(r[program + '_mtzout'])
+            have_log = os.path.isfile(logfile)
+            have_out = os.path.isfile(pdbout) and os.path.isfile(mtzout)
+            if not (have_log or have_out): continue
+            sec_program = "sec_{0}_{1}".format(program.lower(), name) + uid
+            if program not in widgets:
+                pyrvapi.rvapi_add_section(sec_program, title, container_id, 0, 0, 1, 1, False)
+                widgets.add(program)
+            if have_out and program + '_out' not in widgets:
+                data_out = "data_{0}_out_{1}".format(program.lower(), name) + uid
+                pyrvapi.rvapi_add_data(data_out,
+                                        "{0} PDB".format(program),
+                                        os.path.splitext(self.fix_path(pdbout))[0],
+                                        "xyz:map",
+                                        sec_program,
+                                        2, 0, 1, 1, True)
+                pyrvapi.rvapi_append_to_data(data_out, self.fix_path(mtzout), "xyz:map")
+                widgets.add(program + '_out')
+            if have_log and program + '_log' not in widgets:
+                pyrvapi.rvapi_add_data("data_{0}_logfile_{1}".format(program.lower(), name) + uid,
+                                        "{0} Logfile".format(program),
+                                        self.fix_path(logfile),
+                                        "text",
+                                        sec_program,
+                                        2, 0, 1, 1, True)
+                widgets.add(program + '_log')
+        
+        if panel['result'] is None:
+            pyrvapi.rvapi_set_tree_node(section['tree'], container_id, "{0}".format(name), "auto", "")
+        panel['result'] = r
         return
 
     def rm_pending_section(self):
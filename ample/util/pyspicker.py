@@ -0,0 +1,236 @@
+"""In-process clustering of decoys in the style of SPICKER
+
+The CA traces of the decoys are read into numpy arrays, the RMSD between every pair of decoys after optimal
+superposition is calculated in vectorised blocks (optionally across a pool of processes) and the decoys are then
+clustered as SPICKER does:
+
+* an RMSD cutoff is chosen, between RCUT_MIN and RCUT_MAX, as the smallest for which the densest decoy has at
+  least MIN_CLUSTER_FRACTION of all the decoys within the cutoff
+* the decoy with the most neighbours within the cutoff seeds a cluster containing all its neighbours. These are
+  removed and the process repeated for the remaining decoys to create the subsequent clusters.
+* the centroid of a cluster is the average of its superposed members and the models of a cluster are ordered by
+  their RMSD to the centroid, so that the first model is the one closest to it
+
+This does not reproduce the SPICKER results exactly but avoids running an external program (and the stack size and
+OpenMP settings needed by spicker_omp).
+"""
+
+import copy
+import logging
+import multiprocessing
+import numpy
+import os
+
+from ample.util import pdb_edit
+from ample.util.distance_matrix import DistanceMatrix
+from ample.ensembler._ensembler import Cluster
+
+logger = logging.getLogger(__name__)
+
+# Range and step of the RMSD cutoffs that are tried
+RCUT_MIN = 3.5
+RCUT_MAX = 12.0
+RCUT_STEP = 0.1
+# The fraction of the decoys that the first cluster should contain
+MIN_CLUSTER_FRACTION = 0.15
+
+
+def superpose(reference, coords):
+    """Superpose a stack of coordinates onto a reference with the Kabsch algorithm.
+
+    Parameters
+    ----------
+    reference : :obj:`numpy.ndarray`
+       An (L, 3) array of coordinates
+    coords : :obj:`numpy.ndarray`
+       An (N, L, 3) array of the coordinates of N structures
+
+    Returns
+    -------
+    rmsd : :obj:`numpy.ndarray`
+       The N RMSDs to the reference after superposition
+    superposed : :obj:`numpy.ndarray`
+       The superposed (N, L, 3) coordinates
+    """
+    ref_centre = reference.mean(axis=0)
+    ref = reference - ref_centre
+    mobile = coords - coords.mean(axis=1)[:, numpy.newaxis, :]
+    covariance = numpy.einsum('nlj,lk->njk', mobile, ref)
+    u, s, vt = numpy.linalg.svd(covariance)
+    # Make sure we have a proper rotation rather than a reflection
+    d = numpy.sign(numpy.linalg.det(u) * numpy.linalg.det(vt))
+    u[:, :, 2] *= d[:, numpy.newaxis]
+    rotation = numpy.einsum('nij,njk->nik', u, vt)
+    superposed = numpy.einsum('nlj,njk->nlk', mobile, rotation)
+    rmsd = numpy.sqrt(((superposed - ref) ** 2).sum(axis=(1, 2)) / len(reference))
+    return rmsd, superposed + ref_centre
+
+
+def pair_rmsds(coords, rows):
+    """Return a list of the RMSDs of each decoy in rows to all the decoys after it.
+
+    This uses the RMSD after optimal superposition calculated from the singular values of the covariance
+    matrices of each pair without rotating the coordinates.
+    """
+    length = coords.shape[1]
+    centred = coords - coords.mean(axis=1)[:, numpy.newaxis, :]
+    sumsq = (centred ** 2).sum(axis=(1, 2))
+    results = []
+    for i in rows:
+        others = centred[i + 1:]
+        covariance = numpy.einsum('lj,nlk->njk', centred[i], others)
+        s = numpy.linalg.svd(covariance, compute_uv=False)
+        s[:, 2] *= numpy.sign(numpy.linalg.det(covariance))
+        msd = (sumsq[i] + sumsq[i + 1:] - 2.0 * s.sum(axis=1)) / length
+        results.append(numpy.sqrt(numpy.maximum(msd, 0.0)))
+    return results
+
+
+# Coordinates shared with the processes of the pool used to calculate the rmsd matrix
+_pool_coords = None
+
+def _init_pool(coords):
+    global _pool_coords
+    _pool_coords = coords
+
+def _pool_pair_rmsds(rows):
+    return rows, pair_rmsds(_pool_coords, rows)
+
+
+def rmsd_matrix(coords, nproc=1):
+    """Return a :obj:`DistanceMatrix` of the RMSDs between all pairs of decoys"""
+    num_models = len(coords)
+    dmatrix = DistanceMatrix(num_models)
+    # Interleave the rows so that each block has a similar amount of work
+    nblocks = max(1, min(num_models - 1, nproc * 4))
+    blocks = [range(b, num_models - 1, nblocks) for b in range(nblocks)]
+    if nproc > 1 and num_models > nproc:
+        pool = multiprocessing.Pool(nproc, initializer=_init_pool, initargs=(coords,))
+        try:
+            for rows, rmsds in pool.imap_unordered(_pool_pair_rmsds, blocks):
+                for i, values in zip(rows, rmsds): dmatrix.set_row(i, values)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for rows in blocks:
+            for i, values in zip(rows, pair_rmsds(coords, rows)): dmatrix.set_row(i, values)
+    return dmatrix
+
+
+def rmsd_cutoff(matrix):
+    """Return the smallest cutoff between RCUT_MIN and RCUT_MAX for which the densest decoy has at least
+    MIN_CLUSTER_FRACTION of the decoys (including itself) within the cutoff"""
+    num_models = len(matrix)
+    k = max(1, int(numpy.ceil(MIN_CLUSTER_FRACTION * num_models)))
+    # The distance to the k'th closest decoy (including itself) for each decoy
+    kth = numpy.partition(matrix, k - 1, axis=1)[:, k - 1].min()
+    # A decoy is within the cutoff if its distance is less than it
+    rcut = RCUT_MIN + numpy.floor((kth - RCUT_MIN) / RCUT_STEP + 1) * RCUT_STEP
+    return float(numpy.clip(rcut, RCUT_MIN, RCUT_MAX))
+
+
+class PySpicker(object):
+    """Cluster decoys with a SPICKER-like algorithm without running an external program"""
+
+    def __init__(self, run_dir=None):
+        self.run_dir = run_dir
+        self.results = None
+        self.rmsd_cutoff = None
+        self.cluster_method = 'pyspicker'
+        self.score_type = 'rmsd'
+
+    def cluster(self, models, num_clusters=10, max_cluster_size=200, run_dir=None, nproc=1):
+        """Cluster the models
+
+        Parameters
+        ----------
+        models : list
+           A list of the pdb files of the decoys, all with the same number of CA atoms
+        num_clusters : int
+           The number of clusters to return
+        max_cluster_size : int
+           The maximum number of models in each cluster
+        run_dir : str, optional
+           Directory to write the list of models in each cluster to
+        nproc : int
+           The number of processors to use
+
+        Returns
+        -------
+        list
+           A list of :obj:`Cluster` objects
+
+        Raises
+        ------
+        RuntimeError
+           No clusters were found
+        """
+        if run_dir: self.run_dir = os.path.abspath(run_dir)
+        if not len(models): raise RuntimeError("no models provided!")
+        logger.debug("Clustering %d models with pyspicker on %d processors", len(models), nproc)
+
+        coords = pdb_edit.ca_coordinates(models, nproc=nproc)
+        matrix = rmsd_matrix(coords, nproc=nproc).to_square(dtype=numpy.float32)
+        self.results = self._cluster(models, coords, matrix)
+
+        ns_clusters = len(self.results)
+        if ns_clusters == 0: raise RuntimeError('No clusters returned by pyspicker')
+        if ns_clusters < int(num_clusters):
+            logger.critical('Requested {0} clusters but pyspicker only found {1} so using {1} clusters'.format(num_clusters, ns_clusters))
+            num_clusters = ns_clusters
+
+        clusters = []
+        for result in self.results[0:num_clusters]:
+            # Keep the full clusters in the results
+            cluster = copy.copy(result)
+            cluster.models = cluster.models[0:max_cluster_size]
+            cluster.r_cen = cluster.r_cen[0:max_cluster_size]
+            clusters.append(cluster)
+        return clusters
+
+    def _cluster(self, models, coords, matrix):
+        """Return a list of all the clusters of the models"""
+        self.rmsd_cutoff = rmsd_cutoff(matrix)
+        logger.debug("pyspicker using RMSD cutoff: %.1f", self.rmsd_cutoff)
+        neighbours = matrix < self.rmsd_cutoff
+        remaining = numpy.ones(len(models), dtype=bool)
+        results = []
+        while remaining.any():
+            # Count the neighbours of each remaining decoy amongst the remaining decoys
+            density = numpy.where(remaining, neighbours[:, remaining].sum(axis=1), -1)
+            seed = int(numpy.argmax(density))
+            members = numpy.flatnonzero(neighbours[seed] & remaining)
+            remaining[members] = False
+
+            # Average the members superposed on the seed and order them by their distance from the average
+            _, superposed = superpose(coords[seed], coords[members])
+            r_cen, _ = superpose(superposed.mean(axis=0), coords[members])
+            order = numpy.argsort(r_cen, kind='mergesort')
+
+            result = Cluster()
+            result.cluster_method = self.cluster_method
+            result.score_type = self.score_type
+            result.index = len(results) + 1
+            result.models = [models[i] for i in members[order]]
+            result.r_cen = [float(r) for r in r_cen[order]]
+            results.append(result)
+
+        for result in results:
+            result.num_clusters = len(results)
+            if self.run_dir:
+                with open(os.path.join(self.run_dir, "pyspicker_cluster_{0}.list".format(result.index)), "w") as f:
+                    f.write("".join(pdb + "\n" for pdb in result.models))
+        return results
+
+    def results_summary(self):
+        """Summarise the clustering results"""
+        if not self.results: raise RuntimeError("Could not find any results!")
+        rstr = "---- pyspicker Results ----\n\n"
+        rstr += "RMSD cutoff: {0:.1f}\n\n".format(self.rmsd_cutoff)
+        for i, r in enumerate(self.results):
+            rstr += "Cluster: {0}\n".format(i + 1)
+            rstr += "* number of models: {0}\n".format(r.size)
+            rstr += "* centroid model is: {0}\n".format(r.centroid)
+            rstr += "\n"
+        return rstr
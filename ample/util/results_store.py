@@ -0,0 +1,310 @@
+"""Incrementally saved AMPLE results dictionary
+
+The results file (e.g. ``resultsd.pkl``) always holds a single pickled dictionary, so it can be read with
+``cPickle.load``. Rather than re-pickling the whole of the AMPLE dictionary every time the state is saved,
+each save appends a record for every key whose value has changed to a journal alongside it
+(``resultsd.pkl.journal``). The results file on its own therefore only holds the state as of the last time it was
+written in full (the first save of a run or :meth:`ResultsStore.compact`, which AMPLE calls when it finishes), and the
+current state of a run that is still going, or that died, has to be read with :func:`ample_util.read_amoptd` or
+:meth:`ResultsStore.read`. A record is a pickled tuple::
+
+   (op, key, arg, blob)
+
+where blob is the pickled value, so the journal can be scanned without unpickling the values that aren't required:
+
+* ``('set', key, None, blob)`` sets the value of key
+* ``('del', key, None, None)`` removes key
+* ``('row', key, field, blob)`` updates a single row of a list of dictionaries (e.g. ``mrbump_results``), replacing
+  the row with the same value of field or appending it if there is no such row
+
+The complete dictionary is the results file with the journal applied to it. :meth:`ResultsStore.compact` folds the
+journal back into the results file.
+
+Each value in the results file is pickled separately within the dictionary, and the offsets of the values are
+appended to the file after the dictionary (where ``cPickle.load`` doesn't see them), so that a single value can be
+read without unpickling the rest of the dictionary.
+"""
+
+import cPickle
+import hashlib
+import logging
+import os
+import pickle
+import struct
+
+try:
+    import fcntl
+except ImportError:
+    # Windows - we have no way of serialising writes from different processes
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SET = 'set'
+DELETE = 'del'
+ROW = 'row'
+JOURNAL_SUFFIX = '.journal'
+# Marks the index of the value offsets at the end of the results file
+INDEX_TAG = 'ample_results_index'
+# The offset of the index is stored in the last bytes of the results file
+INDEX_OFFSET = struct.Struct('<Q')
+
+# Keep one store for each results file so that we remember what has already been written
+_stores = {}
+
+
+def results_store(path):
+    """Return the :obj:`ResultsStore` for the results file at path"""
+    path = os.path.abspath(path)
+    if path not in _stores: _stores[path] = ResultsStore(path)
+    return _stores[path]
+
+
+def _dumps(value):
+    return cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+
+
+def _digest(blob):
+    return hashlib.sha1(blob).hexdigest()
+
+
+def _body(blob):
+    """Return the opcodes of a pickle between the protocol header and the STOP"""
+    assert blob[0] == pickle.PROTO and blob[-1] == pickle.STOP
+    return blob[2:-1]
+
+
+def _apply_row(rows, field, row):
+    if rows is None: rows = []
+    for i, r in enumerate(rows):
+        if r.get(field) == row.get(field):
+            rows[i] = row
+            return rows
+    rows.append(row)
+    return rows
+
+
+def _signature(path):
+    """Return something that changes whenever the file at path is written"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime
+
+
+class ResultsStore(object):
+    """Read and incrementally update the AMPLE results dictionary"""
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.journal = self.path + JOURNAL_SUFFIX
+        # Digest of the value of each key in the files - None if it has been changed by row updates
+        self._digests = {}
+        # Signatures of the files when we last read or wrote them
+        self._signatures = None
+        # Whether this object has saved anything yet
+        self._saved = False
+
+    def exists(self):
+        return os.path.isfile(self.path) or os.path.isfile(self.journal)
+
+    def _records(self, fname):
+        """Yield the records in a journal"""
+        with open(fname, 'rb') as f:
+            while True:
+                try:
+                    record = cPickle.load(f)
+                except EOFError:
+                    break
+                except Exception as e:
+                    # A record that was only partly written when a job was killed
+                    logger.warning("Ignoring unreadable record at end of results file %s: %s", fname, e)
+                    break
+                yield record
+
+    def _index(self, f):
+        """Return the index of the values in the open results file or None if it doesn't have one"""
+        try:
+            f.seek(-INDEX_OFFSET.size, os.SEEK_END)
+            offset = INDEX_OFFSET.unpack(f.read(INDEX_OFFSET.size))[0]
+            f.seek(offset)
+            tag, index = cPickle.load(f)
+        except Exception:
+            # e.g. a plain pickle written by another program
+            return None
+        return index if tag == INDEX_TAG else None
+
+    def _read_base(self, keys=None):
+        """Return the values in the results file, restricted to keys if given, and the digests of all its values"""
+        with open(self.path, 'rb') as f:
+            index = self._index(f)
+            if index is None:
+                f.seek(0)
+                d = cPickle.load(f)
+                digests = dict((k, _digest(_dumps(v))) for k, v in d.iteritems())
+            elif keys is None:
+                f.seek(0)
+                d = cPickle.load(f)
+                digests = dict((k, digest) for k, (_, _, digest) in index.iteritems())
+            else:
+                d = {}
+                for key in keys:
+                    if key not in index: continue
+                    offset, length, _ = index[key]
+                    f.seek(offset)
+                    d[key] = cPickle.loads(pickle.PROTO + chr(cPickle.HIGHEST_PROTOCOL) + f.read(length) + pickle.STOP)
+                digests = dict((k, digest) for k, (_, _, digest) in index.iteritems())
+        if keys is not None: d = dict((k, v) for k, v in d.iteritems() if k in keys)
+        return d, digests
+
+    def _scan(self, keys=None):
+        """Return a dictionary of the values in the files, restricted to keys if given"""
+        d = {}
+        digests = {}
+        signatures = self._current_signatures()
+        if os.path.isfile(self.path): d, digests = self._read_base(keys)
+        if os.path.isfile(self.journal):
+            for op, key, arg, blob in self._records(self.journal):
+                if op == SET:
+                    digests[key] = _digest(blob)
+                    if keys is None or key in keys: d[key] = cPickle.loads(blob)
+                elif op == DELETE:
+                    digests.pop(key, None)
+                    d.pop(key, None)
+                elif op == ROW:
+                    digests[key] = None
+                    if keys is None or key in keys: d[key] = _apply_row(d.get(key), arg, cPickle.loads(blob))
+        self._digests = digests
+        self._signatures = signatures
+        return d
+
+    def _current_signatures(self):
+        return _signature(self.path), _signature(self.journal)
+
+    def read(self):
+        """Return the complete dictionary"""
+        if not self.exists(): raise RuntimeError("Cannot access AMPLE results file: {0}".format(self.path))
+        return self._scan()
+
+    def get(self, key, default=None):
+        """Return the value of a single key, only unpickling the value and journal records for that key"""
+        if not self.exists(): return default
+        return self._scan(keys=[key]).get(key, default)
+
+    def _sync(self):
+        """Make sure our digests reflect the files in case another process has written to them"""
+        if self._current_signatures() != self._signatures: self._scan(keys=[])
+
+    def _locked(self, write):
+        """Call write with the journal locked against other processes and append the records it returns"""
+        with open(self.journal, 'ab') as f:
+            if fcntl: fcntl.lockf(f, fcntl.LOCK_EX)
+            try:
+                self._sync()
+                records = write(f)
+                for record in records: cPickle.dump(record, f, cPickle.HIGHEST_PROTOCOL)
+                f.flush()
+            finally:
+                if fcntl: fcntl.lockf(f, fcntl.LOCK_UN)
+        self._signatures = self._current_signatures()
+        return len(records)
+
+    def save(self, amoptd, keys=None):
+        """Append records for the keys of amoptd that have changed since they were last saved.
+
+        If there is no results file the whole of amoptd is written to it. Otherwise only the values of keys are
+        pickled to check whether they have changed, so each step of a run should pass the keys it sets. The first
+        save by this object checks all the keys of amoptd, so that nothing set before then is missed.
+
+        Parameters
+        ----------
+        amoptd : dict
+           The AMPLE dictionary
+        keys : list, optional
+           Only check these keys. By default all keys are checked and any keys that have been removed from amoptd
+           are deleted.
+
+        Returns
+        -------
+        int
+           The number of records written
+        """
+        if not self.exists():
+            self._saved = True
+            self._digests = self._write_dict(amoptd)
+            self._signatures = self._current_signatures()
+            return len(amoptd)
+
+        check = amoptd.keys() if keys is None or not self._saved else keys
+        self._saved = True
+
+        def write(f):
+            records = []
+            for key in check:
+                if key not in amoptd: continue
+                blob = _dumps(amoptd[key])
+                digest = _digest(blob)
+                if self._digests.get(key, False) != digest:
+                    records.append((SET, key, None, blob))
+                    self._digests[key] = digest
+            if keys is None:
+                for key in [k for k in self._digests if k not in amoptd]:
+                    records.append((DELETE, key, None, None))
+                    del self._digests[key]
+            return records
+        return self._locked(write)
+
+    def update_rows(self, key, field, rows):
+        """Append records updating single rows of the list of dictionaries stored under key
+
+        Parameters
+        ----------
+        key : str
+           The key of the list of dictionaries, e.g. mrbump_results
+        field : str
+           The field that identifies a row, e.g. ensemble_name
+        rows : list
+           The rows that have changed
+        """
+        def write(f):
+            self._digests[key] = None
+            return [(ROW, key, field, _dumps(row)) for row in rows]
+        return self._locked(write)
+
+    def _write_dict(self, d):
+        """Write d to the results file, followed by the index of its values, and return the digests of the values"""
+        index = {}
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            # Build the pickle of the dictionary from the separate pickles of its keys and values
+            f.write(pickle.PROTO + chr(cPickle.HIGHEST_PROTOCOL) + pickle.EMPTY_DICT)
+            for key, value in d.iteritems():
+                f.write(_body(_dumps(key)))
+                blob = _dumps(value)
+                body = _body(blob)
+                index[key] = (f.tell(), len(body), _digest(blob))
+                f.write(body)
+                f.write(pickle.SETITEM)
+            f.write(pickle.STOP)
+            offset = f.tell()
+            cPickle.dump((INDEX_TAG, index), f, cPickle.HIGHEST_PROTOCOL)
+            f.write(INDEX_OFFSET.pack(offset))
+        os.rename(tmp, self.path)
+        return dict((k, digest) for k, (_, _, digest) in index.iteritems())
+
+    def compact(self, amoptd=None):
+        """Fold the journal into the results file, leaving a single pickled dictionary and an empty journal
+
+        Parameters
+        ----------
+        amoptd : dict, optional
+           Write this as the complete dictionary rather than the current contents of the files
+        """
+        def write(f):
+            self._digests = self._write_dict(self.read() if amoptd is None else amoptd)
+            # Truncate rather than remove the journal so that processes waiting on the lock append to the same file
+            f.truncate(0)
+            return []
+        self._locked(write)
+        return
@@ -8,17 +8,192 @@ concatenate the native and reformatted csymmatch pdb
 run ncont to generate contacts
 parse ncont file to generate map & analyse whether placed bits match and what type of structure they are
 
+scoreOrigin does the same without any files or programs: the contacts between the native and the symmetry copies
+of the placed structure are found from the coordinates in memory with a cell list (find_contacts).
+
 """
 
+from fractions import Fraction
+import itertools
 from operator import itemgetter
+import numpy
 import os
 import types
 
+from cctbx import sgtbx
+
 from ample.parsers import dssp_parser
 from ample.util import ample_util
 from ample.util import csymmatch
 from ample.util import pdb_edit
 
+# Distances for CA-CA (RIO) and all-atom contacts, as used with ncont
+RIO_MAX_DIST = 1.5
+AA_MAX_DIST = 0.5
+# Number of unit cells either side of the origin to generate symmetry copies in, as with the ncont CELLS keyword
+NCONT_CELLS = 2
+
+
+def orthogonalisation_matrix(crystalInfo):
+    """Return the matrix converting fractional to orthogonal coordinates for the cell in crystalInfo
+
+    This uses the PDB convention of a along x and b in the xy plane.
+    """
+    a, b, c = crystalInfo.a, crystalInfo.b, crystalInfo.c
+    ca, cb, cg = [numpy.cos(numpy.radians(x)) for x in (crystalInfo.alpha, crystalInfo.beta, crystalInfo.gamma)]
+    sg = numpy.sin(numpy.radians(crystalInfo.gamma))
+    volume = a * b * c * numpy.sqrt(1.0 - ca ** 2 - cb ** 2 - cg ** 2 + 2.0 * ca * cb * cg)
+    return numpy.array([[a, b * cg, c * cb],
+                        [0.0, b * sg, c * (ca - cb * cg) / sg],
+                        [0.0, 0.0, volume / (a * b * sg)]])
+
+
+def symmetry_operators(crystalInfo):
+    """Return a list of the (rotation, translation) fractional symmetry operators of the space group in crystalInfo"""
+    group = sgtbx.space_group_info(symbol=crystalInfo.spaceGroup).group()
+    return [(numpy.array(op.r().as_double()).reshape(3, 3), numpy.array(op.t().as_double()))
+            for op in group.all_ops()]
+
+
+def operator_xyz(rotation, translation):
+    """Return a fractional symmetry operator as a string in the form ncont reports it, e.g. -X+Y,-X+1,Z+1/3
+
+    Any lattice translation is included in the translation, as ncont does.
+    """
+    rows = []
+    for row, t in zip(rotation, translation):
+        terms = ''
+        for r, axis in zip(row, 'XYZ'):
+            r = int(round(r))
+            if r == 0: continue
+            terms += ('-' if r < 0 else '+') + (str(abs(r)) if abs(r) != 1 else '') + axis
+        t = Fraction(t).limit_denominator(12)
+        if t: terms += ('-' if t < 0 else '+') + str(abs(t))
+        rows.append(terms.lstrip('+'))
+    return ','.join(rows)
+
+
+def close_pairs(source, target, max_dist):
+    """Return the indices of the pairs of source and target points within max_dist of each other and their distances
+
+    The target points are sorted into a grid of cells with sides of max_dist so that only the targets in the 27
+    cells around each source point need to be checked.
+
+    Parameters
+    ----------
+    source : :obj:`numpy.ndarray`
+       (N, 3) array of coordinates
+    target : :obj:`numpy.ndarray`
+       (M, 3) array of coordinates
+    max_dist : float
+       The maximum distance between the points of a pair
+
+    Returns
+    -------
+    i : :obj:`numpy.ndarray`
+       The indices of the source points
+    j : :obj:`numpy.ndarray`
+       The indices of the target points
+    dist : :obj:`numpy.ndarray`
+       The distances between the points
+    """
+    empty = (numpy.empty(0, dtype=numpy.intp), numpy.empty(0, dtype=numpy.intp), numpy.empty(0))
+    if not len(source) or not len(target): return empty
+    lower = numpy.minimum(source.min(axis=0), target.min(axis=0))
+    # Offset by one so that all the neighbouring cells have non-negative indices
+    source_cells = numpy.floor((source - lower) / max_dist).astype(numpy.int64) + 1
+    target_cells = numpy.floor((target - lower) / max_dist).astype(numpy.int64) + 1
+    dims = numpy.maximum(source_cells.max(axis=0), target_cells.max(axis=0)) + 2
+    key = lambda cells: (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+    order = numpy.argsort(key(target_cells), kind='mergesort')
+    target_keys = key(target_cells)[order]
+
+    pairs_i, pairs_j = [], []
+    for offset in itertools.product((-1, 0, 1), repeat=3):
+        keys = key(source_cells + offset)
+        first = numpy.searchsorted(target_keys, keys, side='left')
+        counts = numpy.searchsorted(target_keys, keys, side='right') - first
+        total = counts.sum()
+        if not total: continue
+        # The index into the sorted targets of every target in the cell of each source point
+        within = numpy.arange(total) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        pairs_i.append(numpy.repeat(numpy.arange(len(source)), counts))
+        pairs_j.append(order[numpy.repeat(first, counts) + within])
+    if not pairs_i: return empty
+    i, j = numpy.concatenate(pairs_i), numpy.concatenate(pairs_j)
+    dist = numpy.sqrt(((source[i] - target[j]) ** 2).sum(axis=1))
+    close = dist <= max_dist
+    return i[close], j[close], dist[close]
+
+
+def find_contacts(source, target, max_dist, crystalInfo=None):
+    """Find the contacts between the source atoms and the target atoms and all of their symmetry copies
+
+    This finds the same contacts as ncont with the CELLS 2 and SORT TARGET INC keywords: the target atoms are
+    copied by all the symmetry operators of the crystal and translated by up to NCONT_CELLS unit cells along each
+    axis and the contacts are sorted by target atom. As in the ncont log, 'cell' is the lattice translation coded
+    with 3 for no translation in each digit (343 is one cell along b) and 'symmetry' is the operator with that
+    translation included (-X+Y,-X+1,Z+1/3).
+
+    Parameters
+    ----------
+    source : :obj:`numpy.ndarray`
+       A pdb_model.ATOM_DTYPE array of the source atoms
+    target : :obj:`numpy.ndarray`
+       A pdb_model.ATOM_DTYPE array of the target atoms
+    max_dist : float
+       The maximum distance between atoms in contact
+    crystalInfo : :obj:`CrystalInfo`, optional
+       The crystal used to generate the symmetry copies of the target - only the target itself is used if this is None
+
+    Returns
+    -------
+    list
+       A list of the contacts as dictionaries with the same keys as those from :meth:`Rio.parseNcontLog`
+    """
+    source_xyz = source['xyz'].astype(numpy.float64)
+    target_xyz = target['xyz'].astype(numpy.float64)
+    if crystalInfo is None:
+        images = [(target_xyz, 333, 'X,Y,Z')]
+    else:
+        orth = orthogonalisation_matrix(crystalInfo)
+        frac = numpy.linalg.inv(orth)
+        lower = source_xyz.min(axis=0) - max_dist
+        upper = source_xyz.max(axis=0) + max_dist
+        images = []
+        for rotation, translation in symmetry_operators(crystalInfo):
+            # Apply the operator in fractional coordinates
+            moved = numpy.dot(target_xyz, numpy.dot(orth, numpy.dot(rotation, frac)).T) + numpy.dot(orth, translation)
+            mlower, mupper = moved.min(axis=0), moved.max(axis=0)
+            for shift in itertools.product(range(-NCONT_CELLS, NCONT_CELLS + 1), repeat=3):
+                translate = numpy.dot(orth, shift)
+                # Skip the copies that can't be close to the source
+                if (mlower + translate > upper).any() or (mupper + translate < lower).any(): continue
+                cell = 100 * (shift[0] + NCONT_CELLS + 1) + 10 * (shift[1] + NCONT_CELLS + 1) + shift[2] + NCONT_CELLS + 1
+                images.append((moved + translate, cell, operator_xyz(rotation, translation + shift)))
+
+    found = []
+    for image, (xyz, cell, symmetry) in enumerate(images):
+        i, j, dist = close_pairs(source_xyz, xyz, max_dist)
+        found.extend((jj, ii, image, d) for ii, jj, d in zip(i, j, dist))
+    # Sort by target atom as with SORT TARGET INC
+    found.sort(key=itemgetter(0, 1, 2))
+
+    contacts = []
+    for j, i, image, dist in found:
+        d = {}
+        d['chainId1'] = source['chainID'][i]
+        d['resSeq1']  = int(source['resSeq'][i])
+        d['aa1']      = pdb_edit.three2one.get(source['resName'][i], 'X')
+        d['chainId2'] = target['chainID'][j]
+        d['resSeq2']  = int(target['resSeq'][j])
+        d['aa2']      = pdb_edit.three2one.get(target['resName'][j], 'X')
+        d['dist']     = round(float(dist), 2)
+        d['cell']     = images[image][1]
+        d['symmetry'] = images[image][2]
+        contacts.append(d)
+    return contacts
+
 class RioData(object):
     def __init__(self):
 
@@ -605,8 +780,66 @@ class Rio(object):
                     mrPdbInfo=None,
                     nativePdbInfo=None,
                     resSeqMap=None,
-                    workdir=os.getcwd()
+                    workdir=os.getcwd(),
+                    ncont=False
                      ):
+        """Calculate the all-atom and RIO contacts of the placed structure moved by origin with the native
+
+        The coordinates are renumbered, moved and copied by the crystal symmetry in memory and the contacts
+        found with find_contacts. If ncont is True the modified placed structure is written out and ncont used
+        instead.
+        """
+        if ncont:
+            return self.scoreOriginNcont(origin, mrPdbInfo, nativePdbInfo, resSeqMap, workdir)
+
+        self.workdir = workdir
+        native = nativePdbInfo.models[0].atom_data
+        placed = mrPdbInfo.models[0].atom_data.copy()
+        if not resSeqMap.resSeqMatch():
+            # Number the placed residues to match the native
+            placed['resSeq'] = [ resSeqMap.ref2target( r ) for r in placed['resSeq'] ]
+
+        # Rename the chains of the placed structure to lower case
+        ucChains = mrPdbInfo.models[0].chains
+        toChains = [ c.lower() for c in ucChains ]
+        placed['chainID'] = numpy.char.lower( placed['chainID'] )
+
+        if origin != [ 0.0, 0.0, 0.0 ]:
+            # Move the placed structure to the new origin
+            crystalInfo = mrPdbInfo.crystalInfo or nativePdbInfo.crystalInfo
+            if crystalInfo is None:
+                raise RuntimeError("Cannot move {0} to origin {1} without a unit cell".format( mrPdbInfo.pdb, origin ))
+            placed['xyz'] += numpy.dot( orthogonalisation_matrix( crystalInfo ), origin )
+
+        data = RioData()
+        data.origin = origin
+        data.fromChains = nativePdbInfo.models[0].chains
+        data.toChains = toChains
+
+        # First get AllAtom score
+        data.contacts = find_contacts( native, placed, AA_MAX_DIST, crystalInfo=nativePdbInfo.crystalInfo )
+        data.numContacts = len( data.contacts )
+        data.aaNumContacts = data.numContacts
+
+        # Then score RIO
+        data.contacts = find_contacts( native[ native['name'] == 'CA' ],
+                                       placed[ placed['name'] == 'CA' ],
+                                       RIO_MAX_DIST,
+                                       crystalInfo=nativePdbInfo.crystalInfo )
+        data.numContacts = len( data.contacts )
+        self.analyseRio( data )
+        data.rioNumContacts = data.numContacts
+
+        return data
+
+    def scoreOriginNcont(self,
+                         origin=None,
+                         mrPdbInfo=None,
+                         nativePdbInfo=None,
+                         resSeqMap=None,
+                         workdir=os.getcwd()
+                          ):
+        """Calculate the all-atom and RIO contacts by writing out the placed structure and running ncont"""
         
         self.workdir = workdir
         if not resSeqMap.resSeqMatch():
@@ -4,6 +4,7 @@ Created on 2 Feb 2015
 
 @author: jmht
 '''
+import copy
 import logging
 import os
 import shutil
@@ -80,6 +81,23 @@ class MRinfo(object):
         shutil.copyfile(native_pdb, os.path.join(self.work_dir, self.stem + ".ent"))
         return
 
+    def copy(self, work_dir):
+        """Return a new :obj:`MRinfo` that works in work_dir with its own copy of the native files
+
+        This allows several MR pdbs to be analysed at once without running mtz2various again for each.
+
+        Parameters
+        ----------
+        work_dir : str
+          Path to the working directory of the new object
+
+        """
+        mrinfo = copy.copy(self)
+        mrinfo.work_dir = work_dir
+        for ext in ['.hkl', '.ent']:
+            shutil.copyfile(os.path.join(self.work_dir, self.stem + ext), os.path.join(work_dir, self.stem + ext))
+        return mrinfo
+
     def analyse(self, mr_pdb):
         """Use SHELXE to analyse an MR pdb file to determine the origin shift and phase error
         
@@ -92,25 +110,30 @@ class MRinfo(object):
         
         """
         
+        # Run in the working directory, returning to the current one afterwards
+        cwd = os.getcwd()
         os.chdir(self.work_dir)
-        input_pdb = self.stem + ".pda"
-        shutil.copyfile(mr_pdb, os.path.join(self.work_dir, input_pdb))
+        try:
+            input_pdb = self.stem + ".pda"
+            shutil.copyfile(mr_pdb, os.path.join(self.work_dir, input_pdb))
  
-        cmd = [self.shelxe_exe, input_pdb, '-a0', '-q', '-s0.5', '-o', '-n', '-t0', '-m0', '-x']
-        logfile = os.path.abspath('shelxe.log')
-        ret = ample_util.run_command(cmd=cmd, logfile=logfile, directory=None, dolog=False, stdin=None)
-        if ret != 0: raise RuntimeError,"Error running shelxe - see log: {0}".format(logfile)
+            cmd = [self.shelxe_exe, input_pdb, '-a0', '-q', '-s0.5', '-o', '-n', '-t0', '-m0', '-x']
+            logfile = os.path.abspath('shelxe.log')
+            ret = ample_util.run_command(cmd=cmd, logfile=logfile, directory=None, dolog=False, stdin=None)
+            if ret != 0: raise RuntimeError,"Error running shelxe - see log: {0}".format(logfile)
          
-        sp = parse_shelxe.ShelxeLogParser(logfile)
-        if hasattr(sp, 'MPE'): self.MPE = sp.MPE # Only added in later version of MRBUMP shelxe parser
-        self.wMPE = sp.wMPE
-        self.originShift = [ o*-1 for o in sp.originShift ]
+            sp = parse_shelxe.ShelxeLogParser(logfile)
+            if hasattr(sp, 'MPE'): self.MPE = sp.MPE # Only added in later version of MRBUMP shelxe parser
+            self.wMPE = sp.wMPE
+            self.originShift = [ o*-1 for o in sp.originShift ]
         
-        # Clean up
-        for ext in ['.pda','.pdo','.phs','.lst','_trace.ps']:
-            try: os.unlink(self.stem + ext)
-            except: pass
-        os.unlink(logfile)
+            # Clean up
+            for ext in ['.pda','.pdo','.phs','.lst','_trace.ps']:
+                try: os.unlink(self.stem + ext)
+                except: pass
+            os.unlink(logfile)
+        finally:
+            os.chdir(cwd)
         return
 
 if __name__ == "__main__":
@@ -2,18 +2,25 @@
 
 # python imports
 import glob
+import itertools
 import logging
+import multiprocessing
+import numpy
 import os
-import re
 import shutil
 import sys
 
 # our imports
 from ample.util import ample_util
+from ample.util import pdb_edit
+from ample.util.distance_matrix import DistanceMatrix
 from ample.ensembler._ensembler import Cluster
     
 logger = logging.getLogger(__name__)
 
+# Minimum number of models for which the CA atoms are read with a pool of processes
+POOL_MIN_MODELS = 500
+
 class Spickerer(object):
 
     def __init__(self, spicker_exe=None, run_dir=None):
@@ -31,19 +38,7 @@ class Spickerer(object):
         self.score_type = 'rmsd'
         return
         
-    def get_length(self, pdb):
-        pdb = open(pdb)
-        counter = 0
-        for line in pdb:
-            pdb_pattern = re.compile('^ATOM')
-            pdb_result = pdb_pattern.match(line)
-            if pdb_result:
-                atom = line[13:16]
-                if re.search('CA', atom):
-                    counter += 1
-        return str(counter)
-
-    def create_input_files(self, models, score_type='rmsd', score_matrix=None):
+    def create_input_files(self, models, score_type='rmsd', score_matrix=None, nproc=1):
         """
         jmht
         Create the input files required to run spicker
@@ -63,7 +58,11 @@ class Spickerer(object):
                 logger.critical(msg)
                 raise RuntimeError, msg
             logger.debug("Using score_matrix: {0}".format(score_matrix))
-            shutil.copy(score_matrix, os.path.join(self.run_dir,'score.matrix'))
+            if score_matrix.endswith('.npy'):
+                # Condensed matrix saved by a subclusterer
+                DistanceMatrix.load(score_matrix).write_spicker(os.path.join(self.run_dir,'score.matrix'))
+            else:
+                shutil.copy(score_matrix, os.path.join(self.run_dir,'score.matrix'))
 #         elif score_type == 'tm':
 #             # Create file so spicker knows to calculate TM scores
 #             with open('TM.score','w') as f: f.write('\n')
@@ -77,26 +76,29 @@ class Spickerer(object):
         # file_list - a list of the full path of all PDBs - used so we can loop through it and copy the selected
         # ones to the relevant directory after we have run spicker - the order of these must match the order
         # of the structures in the rep1.tra1 file 
-        list_string = ''
-        counter = 0
-        with open('rep1.tra1', "w") as read_out, open('file_list', "w") as file_list:
-            for infile in models:
-                pdbname = os.path.basename(infile)
-                file_list.write(infile + '\n')
-                list_string = list_string + pdbname + '\n'
-                counter += 1
-                length = self.get_length(infile)
-                # 1st field is length, 2nd energy, 3rd & 4th don't seem to be used for anything
-                read_out.write('\t' + length + '\t926.917       ' + str(counter) + '       ' + str(counter) + '\n')
-                with open(infile) as read:
-                    # Write out the coordinates of the CA atoms 
-                    for line in read:
-                        pattern = re.compile('^ATOM\s*(\d*)\s*(\w*)\s*(\w*)\s*(\w)\s*(\d*)\s*(.\d*.\d*)\s*(.\d*.\d*)\s*(.\d*.\d*)\s*(.\d*.\d*)')
-                        result = re.match(pattern, line)
-                        if result:
-                            split = re.split(pattern, line)
-                            if split[2] == 'CA':
-                                read_out.write('     ' + split[6] + '     ' + split[7] + '     ' + split[8] + '\n')
+        with open('file_list', "w") as file_list:
+            file_list.write("".join(infile + '\n' for infile in models))
+        
+        # Each model is read once for its CA atoms, in parallel if we have more than one processor
+        pool = None
+        if nproc > 1 and len(models) >= POOL_MIN_MODELS:
+            pool = multiprocessing.Pool(nproc)
+            ca_models = pool.imap(pdb_edit.ca_atoms, models, chunksize=max(1, len(models) // (nproc * 4)))
+        else:
+            ca_models = itertools.imap(pdb_edit.ca_atoms, models)
+        try:
+            with open('rep1.tra1', "w") as read_out:
+                for counter, atoms in enumerate(ca_models, 1):
+                    if counter == 1: first_atoms = atoms
+                    length = str(len(atoms))
+                    # 1st field is length, 2nd energy, 3rd & 4th don't seem to be used for anything
+                    read_out.write('\t' + length + '\t926.917       ' + str(counter) + '       ' + str(counter) + '\n')
+                    # Write out the coordinates of the CA atoms
+                    numpy.savetxt(read_out, atoms['xyz'], fmt='     %.3f     %.3f     %.3f')
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
     
         # from spicker.f
         # *       'rmsinp'---Mandatory, length of protein & piece for RMSD calculation;
@@ -124,14 +126,9 @@ class Spickerer(object):
         # Create the file with the sequence of the PDB structures
         # from spicker.f
         # *       'seq.dat'--Mandatory, sequence file, for output of PDB models.
-        with open('seq.dat', "w") as seq, open(models[0], 'r') as a_pdb:
-            for line in a_pdb:
-                pattern = re.compile('^ATOM\s*(\d*)\s*(\w*)\s*(\w*)\s*(\w)\s*(\d*)\s*(\d*)\s')
-                result = re.match(pattern, line)
-                if result:
-                    split = re.split(pattern, line)
-                    if split[2] == 'CA':
-                        seq.write('\t' + split[5] + '\t' + split[3] + '\n')
+        with open('seq.dat', "w") as seq:
+            seq.write("".join('\t{0}\t{1}\n'.format(resSeq, resName) for resSeq, resName in
+                              zip(first_atoms['resSeq'], first_atoms['resName'])))
         return
     
     def cluster(self, models, num_clusters=10, max_cluster_size=200, run_dir=None, score_type='rmsd', score_matrix=None, nproc=1):
@@ -209,7 +206,7 @@ class Spickerer(object):
         logger.debug("Using executable: {0} on {1} processors".format(self.spicker_exe, nproc))
         
         self.score_type = score_type
-        self.create_input_files(models, score_type=score_type, score_matrix=score_matrix)
+        self.create_input_files(models, score_type=score_type, score_matrix=score_matrix, nproc=nproc)
         
         # We need special care if we are running with tm scores as we will be using the OPENMP
         # version of spicker which requires increasing the stack size on linux and setting the 
@@ -0,0 +1,177 @@
+"""Content-addressed cache of the results of the expensive ensembling steps
+
+Each entry is keyed by the SHA1 hash of the name of the step, the contents of its input files and the options that
+affect its result, so an entry is only reused if the step would recreate exactly the same data. This allows AMPLE
+to be rerun with e.g. different subcluster_radius_thresholds or side_chain_treatments and only recalculate the
+steps that are affected by the change.
+
+An entry is a directory::
+
+   <cache_dir>/<stage>/<key>/result.pkl
+   <cache_dir>/<stage>/<key>/files/...
+
+The result of a step is pickled with any paths within the output directory of the step recorded relative to it.
+The files those paths refer to are copied into the entry, and are copied back into the output directory of the step
+that requests the entry, which need not be the directory they were created in.
+"""
+
+import cPickle
+import copy
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+RESULT_FILE = 'result.pkl'
+FILES_DIR = 'files'
+# Size of the chunks read when hashing files
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def map_paths(obj, func, _memo=None):
+    """Return a copy of obj with func applied to every string within it.
+
+    Lists, tuples (including namedtuples), dicts and the attributes of objects are searched recursively.
+    Objects are shallow-copied so the original is not changed.
+    """
+    if _memo is None: _memo = {}
+    if id(obj) in _memo: return _memo[id(obj)]
+    if isinstance(obj, basestring):
+        return func(obj)
+    elif isinstance(obj, list):
+        mapped = [map_paths(o, func, _memo) for o in obj]
+    elif isinstance(obj, tuple):
+        values = [map_paths(o, func, _memo) for o in obj]
+        mapped = type(obj)(*values) if hasattr(obj, '_fields') else tuple(values)
+    elif isinstance(obj, dict):
+        mapped = dict((k, map_paths(v, func, _memo)) for k, v in obj.iteritems())
+    elif hasattr(obj, '__dict__') and not isinstance(obj, type):
+        mapped = copy.copy(obj)
+        _memo[id(obj)] = mapped
+        mapped.__dict__.update((k, map_paths(v, func, _memo)) for k, v in obj.__dict__.iteritems())
+    else:
+        return obj
+    _memo[id(obj)] = mapped
+    return mapped
+
+
+class StageCache(object):
+    """Cache of the results of the ensembling steps, keyed by their inputs"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.abspath(cache_dir)
+        if not os.path.isdir(self.cache_dir): os.makedirs(self.cache_dir)
+        # The hashes of the files we have seen, keyed by (path, size, mtime)
+        self._file_hashes = {}
+
+    def file_hash(self, path):
+        """Return the SHA1 hash of the contents of a file"""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        tag = (path, st.st_size, st.st_mtime)
+        if tag not in self._file_hashes:
+            sha = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(HASH_BLOCK_SIZE), ''):
+                    sha.update(block)
+            self._file_hashes[tag] = sha.hexdigest()
+        return self._file_hashes[tag]
+
+    def key(self, stage, files=None, **options):
+        """Return the key for a step from its name, the contents of its input files and its options
+
+        Parameters
+        ----------
+        stage : str
+           The name of the step
+        files : list, optional
+           The input files of the step. The order of the files is part of the key.
+        **options
+           The options that affect the result of the step. These must have a repr that is stable between runs.
+        """
+        sha = hashlib.sha1(stage)
+        for fname in files or []:
+            sha.update(self.file_hash(fname))
+        for k in sorted(options):
+            sha.update("{0}={1!r}\n".format(k, options[k]))
+        return sha.hexdigest()
+
+    def _entry_dir(self, stage, key):
+        return os.path.join(self.cache_dir, stage, key)
+
+    def has(self, stage, key):
+        """Return True if there is an entry for a step"""
+        return os.path.isfile(os.path.join(self._entry_dir(stage, key), RESULT_FILE))
+
+    def get(self, stage, key, out_dir=None):
+        """Return the cached result for a step or None if there is no entry.
+
+        Any files stored with the entry are copied into out_dir and the paths in the result updated to match.
+        """
+        entry_dir = self._entry_dir(stage, key)
+        result_file = os.path.join(entry_dir, RESULT_FILE)
+        if not os.path.isfile(result_file): return None
+        try:
+            with open(result_file, 'rb') as f:
+                old_dir, files, dirs, result = cPickle.load(f)
+        except Exception as e:
+            logger.warning("Ignoring unreadable stage cache entry %s: %s", entry_dir, e)
+            return None
+        if old_dir is None: return result
+        out_dir = os.path.abspath(out_dir)
+        for d in dirs:
+            d = os.path.join(out_dir, d)
+            if not os.path.isdir(d): os.makedirs(d)
+        for rel in files:
+            dest = os.path.join(out_dir, rel)
+            if not os.path.isdir(os.path.dirname(dest)): os.makedirs(os.path.dirname(dest))
+            shutil.copy2(os.path.join(entry_dir, FILES_DIR, rel), dest)
+        logger.debug("Reusing %s results from stage cache entry: %s", stage, entry_dir)
+        prefix = old_dir + os.sep
+        return map_paths(result, lambda s: os.path.join(out_dir, s[len(prefix):]) if s.startswith(prefix) else s)
+
+    def put(self, stage, key, result, out_dir=None):
+        """Store the result of a step, together with any files in out_dir that it refers to, and return it"""
+        entry_dir = self._entry_dir(stage, key)
+        if os.path.isdir(entry_dir): return result
+        stage_dir = os.path.dirname(entry_dir)
+        if not os.path.isdir(stage_dir):
+            try:
+                os.makedirs(stage_dir)
+            except OSError:
+                # Another process may have created it
+                if not os.path.isdir(stage_dir): raise
+        # Build the entry under a temporary name so that a partial entry is never seen
+        tmp_dir = tempfile.mkdtemp(prefix='.' + key, dir=stage_dir)
+        try:
+            files = []
+            dirs = []
+            if out_dir is not None:
+                out_dir = os.path.abspath(out_dir)
+                prefix = out_dir + os.sep
+
+                def record(s):
+                    if s.startswith(prefix):
+                        rel = s[len(prefix):]
+                        if os.path.isfile(s):
+                            if rel not in files:
+                                dest = os.path.join(tmp_dir, FILES_DIR, rel)
+                                if not os.path.isdir(os.path.dirname(dest)): os.makedirs(os.path.dirname(dest))
+                                shutil.copy2(s, dest)
+                                files.append(rel)
+                        elif os.path.isdir(s) and rel not in dirs:
+                            dirs.append(rel)
+                    return s
+                map_paths(result, record)
+            with open(os.path.join(tmp_dir, RESULT_FILE), 'wb') as f:
+                cPickle.dump((out_dir, files, dirs, result), f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another process stored the same entry first
+            if not os.path.isdir(entry_dir): raise
+        finally:
+            if os.path.isdir(tmp_dir): shutil.rmtree(tmp_dir)
+        return result
@@ -1,5 +1,8 @@
 
 import os
+import shutil
+import subprocess
+import tempfile
 import unittest
 
 from ample.util import ample_util
@@ -34,6 +37,40 @@ echo "I am script {0}"
         c.submitArrayJob(jobScripts,submit_qtype=qtype)
         c.monitorQueue()
         c.cleanUpArrayJob()
-        
+
+    def test_sentinels(self):
+        wdir = tempfile.mkdtemp()
+        scripts = []
+        for i in range(3):
+            script = os.path.join(wdir, "job_{0}.sh".format(i))
+            with open(script, 'w') as f:
+                f.write("#!/bin/sh\n" + clusterize.sentinel_command(script) + "exit {0}\n".format(i))
+            os.chmod(script, 0o777)
+            scripts.append(script)
+        c = clusterize.ClusterRun()
+        # Stale sentinels from an earlier run are removed
+        with open(clusterize.sentinel_file(scripts[0]), 'w') as f: f.write("0\n")
+        c.trackScripts(scripts)
+        self.assertFalse(os.path.isfile(clusterize.sentinel_file(scripts[0])))
+        self.assertEqual(c._pollSentinels(), 0)
+        for script in scripts[:2]: subprocess.call([script])
+        self.assertEqual(c._pollSentinels(), 2)
+        with open(clusterize.sentinel_file(scripts[1])) as f: self.assertEqual(f.read().strip(), "1")
+
+        # The monitor returns once all the sentinels are written and the job has left the queue
+        subprocess.call([scripts[2]])
+        c.qList = [1]
+        c.getRunningJobList = lambda user="": None
+        poll_min = clusterize.POLL_MIN
+        clusterize.POLL_MIN = 0.01
+        calls = []
+        try:
+            c.monitorQueue(monitor=lambda: calls.append(1))
+        finally:
+            clusterize.POLL_MIN = poll_min
+        self.assertEqual(c._remaining, set())
+        self.assertTrue(calls)
+        shutil.rmtree(wdir)
+
 if __name__ == "__main__":
     unittest.main()
@@ -3,10 +3,15 @@
 __author__ = "Felix Simkovic"
 __date__ = "06 Dec 2016"
 
+import glob
+import numpy
+import os
 import tempfile
 import unittest
 
+from ample import constants
 from ample.util import contact_util
+from ample.util import pdb_edit
 
 
 class TestSubselectionAlgorithm(unittest.TestCase):
@@ -161,5 +166,40 @@ class TestContactUtil(unittest.TestCase):
             contact_util.ContactUtil.check_options(x)
 
 
+class TestDecoyPrecisions(unittest.TestCase):
+
+    def test_decoy_precisions(self):
+        decoys = sorted(glob.glob(os.path.join(constants.SHARE_DIR, 'testfiles', 'models', '*.pdb')))[:5]
+        resseq, xyz = pdb_edit.cb_coordinates(decoys[0])
+        i, j = numpy.triu_indices(len(resseq), 24)
+        distances = numpy.linalg.norm(xyz[i] - xyz[j], axis=1)
+        # Four of the seven scored contacts are present in the first decoy. The last is for a residue no decoy has
+        # so, as with remove_unmatched in conkit-precision, it is not scored.
+        close, far = numpy.flatnonzero(distances < 8.0)[:4], numpy.flatnonzero(distances >= 8.0)[:3]
+        contacts = [(resseq[i[k]], resseq[j[k]]) for k in numpy.concatenate((close, far))] + [(1, 1000)]
+        precisions = contact_util.decoy_precisions(decoys, contacts)
+        self.assertEqual(len(precisions), 5)
+        self.assertAlmostEqual(precisions[0], 4.0 / 7.0)
+        ref = []
+        for decoy in decoys:
+            resseq, xyz = pdb_edit.cb_coordinates(decoy)
+            index = dict((r, k) for k, r in enumerate(resseq))
+            ref.append(sum(1 for r1, r2 in contacts[:-1]
+                           if numpy.linalg.norm(xyz[index[r1]] - xyz[index[r2]]) < 8.0) / 7.0)
+        self.assertTrue(numpy.allclose(precisions, ref))
+        self.assertTrue(numpy.allclose(contact_util.decoy_precisions(decoys, contacts, nproc=2), ref))
+        self.assertTrue(numpy.array_equal(contact_util.decoy_precisions(decoys, []), numpy.zeros(5)))
+        # No contacts can be scored
+        self.assertTrue(numpy.array_equal(contact_util.decoy_precisions(decoys, [(1, 1000)]), numpy.zeros(5)))
+
+    def test_select_contacts(self):
+        contacts = [(1, 30, 0.2), (1, 10, 0.9), (2, 40, 0.5), (5, 60, 0.2), (3, 50, 0.7), (4, 29, 0.1)]
+        # Neighbours are removed before the top seq_len contacts are taken, and ties keep their order
+        self.assertEqual(contact_util.select_contacts(contacts, 4, 24), [(3, 50), (2, 40), (1, 30), (5, 60)])
+        self.assertEqual(contact_util.select_contacts(contacts, 4, 24, factor=0.5), [(3, 50), (2, 40)])
+        self.assertEqual(contact_util.select_contacts(contacts, 10, 5), [(1, 10), (3, 50), (2, 40), (1, 30),
+                                                                         (5, 60), (4, 29)])
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)
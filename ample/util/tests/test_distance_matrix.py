@@ -0,0 +1,60 @@
+"""Test functions for util.distance_matrix"""
+
+import numpy
+import os
+import shutil
+import tempfile
+import unittest
+
+from ample.util.distance_matrix import DistanceMatrix
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.wdir = tempfile.mkdtemp()
+        numpy.random.seed(1)
+        matrix = numpy.triu(numpy.random.rand(7, 7) * 10.0, 1)
+        self.matrix = matrix + matrix.T
+
+    def tearDown(self):
+        shutil.rmtree(self.wdir)
+
+    def test_square(self):
+        dmatrix = DistanceMatrix.from_square(self.matrix)
+        self.assertEqual(len(dmatrix.data), 21)
+        self.assertTrue(numpy.allclose(dmatrix.to_square(), self.matrix, atol=1e-5))
+        self.assertTrue(numpy.allclose(dmatrix.row(3), self.matrix[3], atol=1e-5))
+        self.assertAlmostEqual(dmatrix[5, 2], self.matrix[2, 5], 5)
+        self.assertEqual(dmatrix[4, 4], 0.0)
+
+    def test_set(self):
+        dmatrix = DistanceMatrix(7)
+        i, j = numpy.nonzero(self.matrix)
+        dmatrix.set_pairs(j, i, self.matrix[j, i])
+        self.assertTrue(numpy.allclose(dmatrix.to_square(), self.matrix, atol=1e-5))
+        dmatrix = DistanceMatrix(7)
+        for i in range(6): dmatrix.set_row(i, self.matrix[i, i + 1:])
+        self.assertTrue(numpy.allclose(dmatrix.to_square(), self.matrix, atol=1e-5))
+
+    def test_save_load(self):
+        fname = os.path.join(self.wdir, 'matrix.npy')
+        dmatrix = DistanceMatrix(7, diagonal=1.0, file_name=fname)
+        for i in range(6): dmatrix.set_row(i, self.matrix[i, i + 1:])
+        self.assertEqual(dmatrix.save(fname), fname)
+        loaded = DistanceMatrix.load(fname)
+        self.assertEqual(loaded.num_models, 7)
+        self.assertEqual(loaded.diagonal, 1.0)
+        self.assertTrue(numpy.array_equal(loaded.data, dmatrix.data))
+
+    def test_write_spicker(self):
+        dmatrix = DistanceMatrix.from_square(self.matrix)
+        fname = dmatrix.write_spicker(os.path.join(self.wdir, 'score.matrix'))
+        with open(fname) as f: lines = f.readlines()
+        self.assertEqual(len(lines), 28 + 1)
+        self.assertEqual(lines[0], "   0    0    0.000\n")
+        i, j, d = lines[8].split()
+        self.assertEqual((int(i), int(j)), (1, 2))
+        self.assertAlmostEqual(float(d), self.matrix[1, 2], 3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,6 +2,8 @@
 
 import cPickle
 import os
+import shutil
+import tempfile
 import unittest
 
 from ample.constants import AMPLE_PKL, SHARE_DIR
@@ -27,5 +29,101 @@ class Test(unittest.TestCase):
         self.assertEqual(len(topf),3)
         self.assertIn('info',topf[2])
 
+    def test_results_collector(self):
+        mrbump_dir = tempfile.mkdtemp()
+        
+        def add_job(name, finished=False):
+            with open(os.path.join(mrbump_dir, name + '.sh'), 'w') as f: f.write('\n')
+            results_dir = os.path.join(mrbump_dir, 'search_{0}_mrbump'.format(name), 'results')
+            if not os.path.isdir(results_dir): os.makedirs(results_dir)
+            if finished:
+                rd = { 'loc0_ALL_{0}_UNMOD'.format(name) : { 'PHASER' : { 'SearchModel_filename' : None,
+                                                                          'Search_directory' : os.path.dirname(results_dir),
+                                                                          'Solution_Type' : 'GOOD',
+                                                                          'PHASER_TFZ' : 10.0,
+                                                                          'SHELXE_CC' : 30.0 } } }
+                with open(os.path.join(results_dir, 'resultsTable.pkl'), 'w') as f: cPickle.dump(rd, f)
+                with open(os.path.join(results_dir, 'finished.txt'), 'w') as f: f.write('\n')
+        
+        add_job('c1_t100_r1_polyAla', finished=True)
+        add_job('c1_t50_r1_polyAla')
+        collector = mrbump_util.ResultsCollector(mrbump_dir)
+        self.assertEqual(sorted(collector.poll()), ['c1_t100_r1_polyAla', 'c1_t50_r1_polyAla'])
+        self.assertEqual(len(collector.results), 2)
+        self.assertEqual(collector.results[0]['ensemble_name'], 'c1_t100_r1_polyAla')
+        self.assertEqual(collector.results[1]['Solution_Type'], 'unfinished')
+        self.assertEqual(collector.poll(), [])
+        
+        add_job('c1_t50_r1_polyAla', finished=True)
+        add_job('c1_t25_r1_polyAla')
+        self.assertEqual(sorted(collector.poll()), ['c1_t25_r1_polyAla', 'c1_t50_r1_polyAla'])
+        self.assertEqual(len(collector.results), 3)
+        self.assertEqual(len([ r for r in collector.results if r['Solution_Type'] == 'GOOD' ]), 2)
+        
+        # A results file rewritten after the job finished is read again
+        rfile = os.path.join(mrbump_dir, 'search_c1_t100_r1_polyAla_mrbump', 'results', 'resultsTable.pkl')
+        with open(rfile) as f: rd = cPickle.load(f)
+        rd['loc0_ALL_c1_t100_r1_polyAla_UNMOD']['PHASER']['Solution_Type'] = 'MARGINAL'
+        with open(rfile, 'w') as f: cPickle.dump(rd, f)
+        os.utime(rfile, (0, 0))
+        self.assertEqual(collector.poll(), ['c1_t100_r1_polyAla'])
+        self.assertEqual(len([ r for r in collector.results if r['Solution_Type'] == 'GOOD' ]), 1)
+        shutil.rmtree(mrbump_dir)
+    
+    def test_results_collector_purge(self):
+        mrbump_dir = tempfile.mkdtemp()
+        for i, name in enumerate(['c1_t100_r1_polyAla', 'c1_t50_r1_polyAla', 'c1_t25_r1_polyAla', 'c1_t10_r1_polyAla']):
+            with open(os.path.join(mrbump_dir, name + '.sh'), 'w') as f: f.write('\n')
+            results_dir = os.path.join(mrbump_dir, 'search_{0}_mrbump'.format(name), 'results')
+            os.makedirs(results_dir)
+            # The last job finishes without writing a results file
+            if i < 3:
+                rd = { 'loc0_ALL_{0}_UNMOD'.format(name) : { 'PHASER' : { 'SearchModel_filename' : None,
+                                                                          'Search_directory' : os.path.dirname(results_dir),
+                                                                          'Solution_Type' : 'GOOD',
+                                                                          'PHASER_TFZ' : 10.0,
+                                                                          'SHELXE_CC' : 30.0 } } }
+                with open(os.path.join(results_dir, 'resultsTable.pkl'), 'w') as f: cPickle.dump(rd, f)
+            with open(os.path.join(results_dir, 'finished.txt'), 'w') as f: f.write('\n')
+        collector = mrbump_util.ResultsCollector(mrbump_dir, purge=True)
+        self.assertEqual(len(collector.poll()), 4)
+        self.assertEqual(collector.results[-1]['Solution_Type'], 'missing-results-file')
+        # The job without results is archived and its directory removed
+        self.assertTrue(os.path.isfile(os.path.join(collector.pdir, 'c1_t10_r1_polyAla.pkl')))
+        self.assertFalse(os.path.isdir(os.path.join(mrbump_dir, 'search_c1_t10_r1_polyAla_mrbump')))
+        self.assertEqual(collector.poll(), [])
+        self.assertEqual(len(collector.results), 4)
+        shutil.rmtree(mrbump_dir)
+    
+    def test_job_prioritiser(self):
+        mrbump_dir = tempfile.mkdtemp()
+        ensembles_data = []
+        scripts = []
+        for cnum in [1, 2]:
+            for tlevel in [100, 50, 25]:
+                for radius in [1, 2]:
+                    name = 'c{0}_t{1}_r{2}_polyAla'.format(cnum, tlevel, radius)
+                    ensembles_data.append({'name' : name, 'cluster_num' : cnum, 'truncation_level' : tlevel})
+                    scripts.append(os.path.join(mrbump_dir, name + '.sh'))
+        priority = mrbump_util.JobPrioritiser(scripts, ensembles_data)
+        self.assertEqual(sorted(scripts, key=priority.key), scripts)
+        
+        # A failed job demotes the rest of its cluster/truncation family
+        priority.job_done(scripts[0], 1)
+        self.assertEqual(sorted(scripts, key=priority.key)[-2:], scripts[0:2])
+        
+        # A promising job promotes its family and neighbouring truncation levels
+        results_dir = os.path.join(mrbump_dir, 'search_c2_t25_r1_polyAla_mrbump', 'results')
+        os.makedirs(results_dir)
+        rd = { 'loc0_ALL_c2_t25_r1_polyAla_UNMOD' : { 'PHASER' : { 'SearchModel_filename' : None,
+                                                                  'Search_directory' : os.path.dirname(results_dir),
+                                                                  'Solution_Type' : 'GOOD',
+                                                                  'PHASER_TFZ' : 7.5,
+                                                                  'SHELXE_CC' : 12.0 } } }
+        with open(os.path.join(results_dir, 'resultsTable.pkl'), 'w') as f: cPickle.dump(rd, f)
+        priority.job_done(scripts[10], 0)
+        self.assertEqual(sorted(scripts, key=priority.key)[:4], scripts[8:12])
+        shutil.rmtree(mrbump_dir)
+
 if __name__ == "__main__":
     unittest.main()
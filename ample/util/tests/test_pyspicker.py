@@ -0,0 +1,68 @@
+"""Test functions for util.pyspicker"""
+
+import glob
+import numpy
+import os
+import shutil
+import tempfile
+import unittest
+
+from ample import constants
+from ample.util import pdb_edit
+from ample.util import pyspicker
+
+class Test(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.testfiles_dir = os.path.join(constants.SHARE_DIR, 'testfiles')
+        cls.models = sorted(glob.glob(os.path.join(cls.testfiles_dir, "models", "*.pdb")))
+
+    def test_superpose(self):
+        numpy.random.seed(1)
+        ref = numpy.random.rand(20, 3) * 10.0
+        # Rotate and translate the reference
+        theta = 0.7
+        rotation = numpy.array([[numpy.cos(theta), -numpy.sin(theta), 0.0],
+                                [numpy.sin(theta), numpy.cos(theta), 0.0],
+                                [0.0, 0.0, 1.0]])
+        coords = numpy.array([ref.dot(rotation) + 5.0, ref + numpy.random.rand(20, 3)])
+        rmsd, superposed = pyspicker.superpose(ref, coords)
+        self.assertAlmostEqual(rmsd[0], 0.0, 5)
+        self.assertTrue(numpy.allclose(superposed[0], ref, atol=1e-5))
+        self.assertTrue(rmsd[1] > 0.0)
+        pairs = pyspicker.pair_rmsds(numpy.array([ref, coords[0], coords[1]]), [0])[0]
+        self.assertTrue(numpy.allclose(pairs, rmsd, atol=1e-5))
+
+    def test_rmsd_matrix(self):
+        coords = pdb_edit.ca_coordinates(self.models[:6])
+        self.assertEqual(coords.shape, (6, 59, 3))
+        matrix = pyspicker.rmsd_matrix(coords).to_square()
+        rmsd, _ = pyspicker.superpose(coords[2], coords)
+        self.assertTrue(numpy.allclose(matrix[2], rmsd, atol=1e-4))
+        self.assertTrue(numpy.allclose(pyspicker.rmsd_matrix(coords, nproc=2).to_square(), matrix))
+
+    def test_cluster(self):
+        run_dir = tempfile.mkdtemp()
+        try:
+            clusterer = pyspicker.PySpicker()
+            clusters = clusterer.cluster(self.models, num_clusters=2, max_cluster_size=10, run_dir=run_dir)
+            self.assertEqual(len(clusters), 2)
+            self.assertEqual(clusterer.rmsd_cutoff, 3.5)
+            # SPICKER puts the same models in the first cluster
+            ref = ['5_S_00000005.pdb', '4_S_00000005.pdb', '5_S_00000004.pdb', '4_S_00000002.pdb',
+                   '4_S_00000003.pdb', '3_S_00000006.pdb', '3_S_00000004.pdb', '2_S_00000005.pdb',
+                   '2_S_00000001.pdb', '3_S_00000003.pdb', '1_S_00000005.pdb', '1_S_00000002.pdb',
+                   '1_S_00000004.pdb']
+            names = sorted([os.path.basename(m) for m in clusterer.results[0].models])
+            self.assertEqual(names, sorted(ref))
+            self.assertEqual(len(clusters[0].models), 10)
+            self.assertEqual(clusters[0].centroid, clusters[0].models[0])
+            self.assertEqual(clusters[0].r_cen, sorted(clusters[0].r_cen))
+            self.assertEqual(clusters[0].num_clusters, len(clusterer.results))
+            self.assertTrue(os.path.isfile(os.path.join(run_dir, "pyspicker_cluster_1.list")))
+        finally:
+            shutil.rmtree(run_dir)
+
+if __name__ == "__main__":
+    unittest.main()
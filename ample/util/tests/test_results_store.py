@@ -0,0 +1,114 @@
+"""Test functions for util.results_store"""
+
+import cPickle
+import os
+import shutil
+import tempfile
+import unittest
+
+from ample.constants import AMPLE_PKL, SHARE_DIR
+from ample.util import results_store
+
+class Unloadable(object):
+    pass
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.wdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.wdir, AMPLE_PKL)
+
+    def tearDown(self):
+        shutil.rmtree(self.wdir)
+
+    def test_save(self):
+        store = results_store.ResultsStore(self.path)
+        d = {'results_path' : self.path, 'ensembles' : ['e1.pdb'], 'nproc' : 1}
+        self.assertEqual(store.save(d), 3)
+        # Nothing has changed
+        self.assertEqual(store.save(d), 0)
+        d['ensembles'].append('e2.pdb')
+        del d['nproc']
+        self.assertEqual(store.save(d), 2)
+        d['AMPLE_finished'] = True
+        d['ensembles'] = []
+        self.assertEqual(store.save(d, keys=['AMPLE_finished']), 1)
+
+        # A new store has to read the journal
+        d2 = results_store.ResultsStore(self.path).read()
+        self.assertEqual(d2, {'results_path' : self.path, 'ensembles' : ['e1.pdb', 'e2.pdb'], 'AMPLE_finished' : True})
+        self.assertEqual(results_store.ResultsStore(self.path).get('ensembles'), ['e1.pdb', 'e2.pdb'])
+
+    def test_save_keys(self):
+        store = results_store.ResultsStore(self.path)
+        d = {'fasta' : 'a.fasta', 'models' : ['m1.pdb'], 'nproc' : 1}
+        store.save(d)
+        d['fasta'] = 'b.fasta'
+        d['nproc'] = 2
+        # Only the given keys are checked
+        self.assertEqual(store.save(d, keys=['fasta']), 1)
+        self.assertEqual(store.read()['nproc'], 1)
+        # The first save by another store checks all the keys
+        d['models'].append('m2.pdb')
+        self.assertEqual(results_store.ResultsStore(self.path).save(d, keys=['fasta']), 2)
+        self.assertEqual(store.read(), d)
+
+    def test_get(self):
+        global Unloadable
+        store = results_store.ResultsStore(self.path)
+        store.save({'fasta' : 'a.fasta', 'info' : Unloadable(), 'models' : ['m1.pdb']})
+        store.save({'fasta' : 'b.fasta', 'info' : Unloadable(), 'models' : ['m1.pdb']}, keys=['fasta'])
+        # A value that cannot be unpickled doesn't stop us reading the others from the results file and journal
+        cls = Unloadable
+        del Unloadable
+        try:
+            store = results_store.ResultsStore(self.path)
+            self.assertEqual(store.get('models'), ['m1.pdb'])
+            self.assertEqual(store.get('fasta'), 'b.fasta')
+            self.assertRaises(AttributeError, store.read)
+        finally:
+            Unloadable = cls
+
+    def test_update_rows(self):
+        store = results_store.ResultsStore(self.path)
+        results = [{'ensemble_name' : 'e1', 'PHASER_TFZ' : None}, {'ensemble_name' : 'e2', 'PHASER_TFZ' : None}]
+        store.save({'mrbump_results' : results})
+        store.update_rows('mrbump_results', 'ensemble_name', [{'ensemble_name' : 'e2', 'PHASER_TFZ' : 8.1},
+                                                              {'ensemble_name' : 'e3', 'PHASER_TFZ' : 5.0}])
+        self.assertEqual(store.get('mrbump_results'), [{'ensemble_name' : 'e1', 'PHASER_TFZ' : None},
+                                                       {'ensemble_name' : 'e2', 'PHASER_TFZ' : 8.1},
+                                                       {'ensemble_name' : 'e3', 'PHASER_TFZ' : 5.0}])
+        # The next save rewrites the whole list
+        self.assertEqual(store.save({'mrbump_results' : results}), 1)
+        store.compact()
+        self.assertEqual(os.path.getsize(store.journal), 0)
+        self.assertEqual(store.read(), {'mrbump_results' : results})
+        # The results file can be read without the store
+        with open(self.path) as f: self.assertEqual(cPickle.load(f), {'mrbump_results' : results})
+
+    def test_other_writer(self):
+        store1 = results_store.ResultsStore(self.path)
+        store2 = results_store.ResultsStore(self.path)
+        d = {'fasta' : 'a.fasta', 'nproc' : 1}
+        store1.save(d)
+        store2.save({'fasta' : 'b.fasta'}, keys=['fasta'])
+        # store1 must notice that the value in the file is no longer the one it wrote
+        self.assertEqual(store1.save(d), 1)
+        self.assertEqual(store2.get('fasta'), 'a.fasta')
+        # A plain pickle written over the results file by another program
+        with open(self.path, 'wb') as f: cPickle.dump({'fasta' : 'c.fasta'}, f)
+        open(store1.journal, 'w').close()
+        self.assertEqual(store1.save(d), 2)
+        self.assertEqual(store2.read(), d)
+
+    def test_legacy(self):
+        with open(os.path.join(SHARE_DIR, 'testfiles', AMPLE_PKL)) as f: optd = cPickle.load(f)
+        shutil.copy(os.path.join(SHARE_DIR, 'testfiles', AMPLE_PKL), self.path)
+        store = results_store.ResultsStore(self.path)
+        self.assertEqual(store.get('fasta'), optd['fasta'])
+        optd['fasta'] = 'foo.fasta'
+        self.assertTrue(store.save(optd) >= 1)
+        self.assertEqual(store.read()['fasta'], 'foo.fasta')
+
+if __name__ == "__main__":
+    unittest.main()
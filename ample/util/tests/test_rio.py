@@ -1,7 +1,10 @@
 
+import numpy
 import os
 import unittest
 from ample import constants
+from ample.util import pdb_edit
+from ample.util import pdb_model
 from ample.util import rio
 
 class TestContacts( unittest.TestCase ):
@@ -99,5 +102,62 @@ class TestContacts( unittest.TestCase ):
         sequence = c.helixFromContacts( contactData.contacts, dssplog )
         self.assertEqual( "NARLKQEIAALEYEIAAL", sequence )
 
+class SameNumbering(object):
+    """Residue map for structures that are numbered the same"""
+    def resSeqMatch(self):
+        return True
+
+
+class TestFindContacts( unittest.TestCase ):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.testfiles_dir = os.path.join(constants.SHARE_DIR,'testfiles')
+        cls.model = os.path.join(cls.testfiles_dir, 'models', '1_S_00000001.pdb')
+
+    def test_close_pairs(self):
+        numpy.random.seed(1)
+        source = numpy.random.rand(200, 3) * 20.0
+        target = numpy.random.rand(300, 3) * 20.0
+        i, j, dist = rio.close_pairs(source, target, 1.5)
+        distances = numpy.sqrt(((source[:, numpy.newaxis, :] - target[numpy.newaxis, :, :]) ** 2).sum(axis=2))
+        ref = sorted(zip(*numpy.nonzero(distances <= 1.5)))
+        self.assertTrue(len(ref) > 0)
+        self.assertEqual(ref, sorted(zip(i, j)))
+        self.assertTrue(numpy.allclose(dist, distances[i, j]))
+
+    def test_operator_xyz(self):
+        # -x+y,-x,z+1/3 moved one cell along b, as in ncont5.log
+        rotation = numpy.array([[-1.0, 1.0, 0.0], [-1.0, 0.0, 0.0], [0.0, 0.0, 1.0]])
+        translation = numpy.array([0.0, 0.0, 1.0 / 3.0])
+        self.assertEqual(rio.operator_xyz(rotation, translation + (0, 1, 0)), '-X+Y,-X+1,Z+1/3')
+        self.assertEqual(rio.operator_xyz(numpy.identity(3), numpy.zeros(3)), 'X,Y,Z')
+
+    def test_symmetry(self):
+        crystalInfo = pdb_model.CrystalInfo()
+        crystalInfo.a, crystalInfo.b, crystalInfo.c = 30.0, 40.0, 50.0
+        crystalInfo.alpha, crystalInfo.beta, crystalInfo.gamma = 90.0, 90.0, 90.0
+        crystalInfo.spaceGroup = 'P 1'
+        atoms = pdb_edit.ca_atoms(self.model)
+        moved = atoms.copy()
+        moved['xyz'] += numpy.array([30.0, -40.0, 0.0])
+        self.assertEqual(rio.find_contacts(atoms, moved, 1.5), [])
+        contacts = rio.find_contacts(atoms, moved, 1.5, crystalInfo=crystalInfo)
+        self.assertEqual(len(contacts), len(atoms))
+        self.assertEqual(contacts[0]['cell'], 243)
+        self.assertEqual(contacts[0]['symmetry'], 'X-1,Y+1,Z')
+        self.assertEqual(contacts[0]['dist'], 0.0)
+
+    def test_score_origin(self):
+        info = pdb_edit.get_info(self.model)
+        data = rio.Rio().scoreOrigin([ 0.0, 0.0, 0.0 ], mrPdbInfo=info, nativePdbInfo=info, resSeqMap=SameNumbering())
+        self.assertEqual(data.aaNumContacts, info.numAtoms())
+        self.assertEqual(data.rioNumContacts, 59)
+        self.assertEqual(data.rioInRegister, 59)
+        self.assertEqual(data.rioOoRegister, 0)
+        self.assertEqual(data.toChains, ['a'])
+        self.assertEqual(data.contacts[0]['chainId2'], 'a')
+        self.assertEqual(data.contacts[0]['aa1'], 'Q')
+
 if __name__ == "__main__":
     unittest.main()
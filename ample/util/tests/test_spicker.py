@@ -2,6 +2,7 @@
 import glob
 import os
 import shutil
+import sys
 import tempfile
 import unittest
 
@@ -43,5 +44,36 @@ class Test(unittest.TestCase):
                          "WARNING: Spicker might run differently on different operating systems")
         shutil.rmtree(work_dir)
 
+class TestInputFiles(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.testfiles_dir = os.path.join(constants.SHARE_DIR, 'testfiles')
+
+    def setUp(self):
+        self.owd = os.getcwd()
+        self.work_dir = tempfile.mkdtemp()
+        os.chdir(self.work_dir)
+
+    def tearDown(self):
+        os.chdir(self.owd)
+        shutil.rmtree(self.work_dir)
+
+    def test_create_input_files(self):
+        models = sorted(glob.glob(os.path.join(self.testfiles_dir, "models", "*.pdb")))
+        # The executable isn't run so any will do
+        spickerer = spicker.Spickerer(spicker_exe=sys.executable)
+        spickerer.create_input_files(models)
+        with open('rep1.tra1') as f: lines = f.readlines()
+        self.assertEqual(lines[0], "\t59\t926.917       1       1\n")
+        self.assertEqual(lines[1], "     1.458     0.000     0.000\n")
+        self.assertEqual(len(lines), len(models) * 60)
+        self.assertEqual(lines[60 * 3], "\t59\t926.917       4       4\n")
+        with open('seq.dat') as f: lines = f.readlines()
+        self.assertEqual(len(lines), 59)
+        self.assertEqual(lines[0], "\t1\tGLN\n")
+        with open('rmsinp') as f: self.assertEqual(f.read(), "1  59\n\n59\n")
+        with open('file_list') as f: self.assertEqual(f.read().split(), models)
+
 if __name__ == "__main__":
     unittest.main()
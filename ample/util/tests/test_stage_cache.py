@@ -0,0 +1,86 @@
+"""Test functions for util.stage_cache"""
+
+import collections
+import os
+import shutil
+import tempfile
+import unittest
+
+from ample.util import stage_cache
+
+Variance = collections.namedtuple('Variance', ['idx', 'variance'])
+
+
+class Holder(object):
+    def __init__(self, directory=None, models=None):
+        self.directory = directory
+        self.models = models
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.wdir = tempfile.mkdtemp()
+        self.cache = stage_cache.StageCache(os.path.join(self.wdir, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.wdir)
+
+    def _write(self, fname, content):
+        if not os.path.isdir(os.path.dirname(fname)): os.makedirs(os.path.dirname(fname))
+        with open(fname, 'w') as f: f.write(content)
+        return fname
+
+    def test_key(self):
+        m1 = self._write(os.path.join(self.wdir, 'a', 'm1.pdb'), 'ATOM 1\n')
+        m2 = self._write(os.path.join(self.wdir, 'b', 'm2.pdb'), 'ATOM 1\n')
+        m3 = self._write(os.path.join(self.wdir, 'b', 'm3.pdb'), 'ATOM 2\n')
+        key = self.cache.key('truncate', [m1, m3], percent=5)
+        # Only the contents of the files matter
+        self.assertEqual(key, self.cache.key('truncate', [m2, m3], percent=5))
+        self.assertNotEqual(key, self.cache.key('truncate', [m3, m1], percent=5))
+        self.assertNotEqual(key, self.cache.key('truncate', [m1, m3], percent=10))
+        self.assertNotEqual(key, self.cache.key('variances', [m1, m3], percent=5))
+        self.assertEqual(self.cache.key('x', a=1, b=2), self.cache.key('x', b=2, a=1))
+
+    def test_map_paths(self):
+        obj = Holder('/a/b', ['/a/b/c.pdb', '/d/e.pdb'])
+        data = {'holder': obj, 'variances': [Variance(0, 1.5)], 'count': (3, '/a/b/x')}
+        mapped = stage_cache.map_paths(data, lambda s: s.replace('/a/b', '/z'))
+        self.assertEqual(mapped['holder'].directory, '/z')
+        self.assertEqual(mapped['holder'].models, ['/z/c.pdb', '/d/e.pdb'])
+        self.assertEqual(mapped['count'], (3, '/z/x'))
+        self.assertEqual(mapped['variances'][0].variance, 1.5)
+        self.assertTrue(isinstance(mapped['variances'][0], Variance))
+        # The original is unchanged
+        self.assertEqual(obj.directory, '/a/b')
+
+    def test_put_get(self):
+        run1 = os.path.join(self.wdir, 'run1')
+        models = [self._write(os.path.join(run1, 'tlevel_1', 'm{0}.pdb'.format(i)), 'ATOM {0}\n'.format(i))
+                  for i in range(3)]
+        result = [Holder(os.path.join(run1, 'tlevel_1'), models), Holder(os.path.join(run1, 'tlevel_2'))]
+        os.mkdir(os.path.join(run1, 'tlevel_2'))
+        self.assertIsNone(self.cache.get('truncate', 'abc', out_dir=run1))
+        self.assertFalse(self.cache.has('truncate', 'abc'))
+        self.assertIs(self.cache.put('truncate', 'abc', result, out_dir=run1), result)
+        # A second put is ignored
+        self.cache.put('truncate', 'abc', [], out_dir=run1)
+        self.assertTrue(self.cache.has('truncate', 'abc'))
+
+        # Restore into a different directory
+        run2 = os.path.join(self.wdir, 'run2')
+        cached = self.cache.get('truncate', 'abc', out_dir=run2)
+        self.assertEqual(cached[0].directory, os.path.join(run2, 'tlevel_1'))
+        self.assertTrue(os.path.isdir(os.path.join(run2, 'tlevel_2')))
+        for i, m in enumerate(cached[0].models):
+            self.assertEqual(m, os.path.join(run2, 'tlevel_1', 'm{0}.pdb'.format(i)))
+            with open(m) as f: self.assertEqual(f.read(), 'ATOM {0}\n'.format(i))
+
+        # Results without files
+        self.cache.put('variances', 'def', [Variance(0, 1.5)])
+        self.assertEqual(self.cache.get('variances', 'def'), [Variance(0, 1.5)])
+
+
+if __name__ == "__main__":
+    unittest.main()
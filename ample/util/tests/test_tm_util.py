@@ -1,5 +1,6 @@
 """Test functions for util.tm_util"""
 
+import numpy
 import unittest
 from ample.testing import test_funcs
 from ample.util import ample_util, tm_util
@@ -25,5 +26,59 @@ class TestTM(unittest.TestCase):
         ref_gaps = [True, False, False, False, True, True]
         self.assertEqual(ref_gaps, gaps)
 
+class TestScores(unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(1)
+        # A random walk of CA atoms 3.8A apart
+        steps = numpy.random.randn(60, 3)
+        steps *= 3.8 / numpy.linalg.norm(steps, axis=1)[:, numpy.newaxis]
+        self.structure = numpy.cumsum(steps, axis=0)
+
+    def test_identical(self):
+        theta = 1.1
+        rotation = numpy.array([[1.0, 0.0, 0.0],
+                                [0.0, numpy.cos(theta), -numpy.sin(theta)],
+                                [0.0, numpy.sin(theta), numpy.cos(theta)]])
+        model = self.structure.dot(rotation) - 7.0
+        scores = tm_util.tm_scores(model, self.structure)
+        self.assertAlmostEqual(scores['tmscore'], 1.0, 5)
+        self.assertAlmostEqual(scores['maxsub'], 1.0, 5)
+        self.assertAlmostEqual(scores['gdtts'], 1.0, 5)
+        self.assertAlmostEqual(scores['gdtha'], 1.0, 5)
+        self.assertAlmostEqual(scores['rmsd'], 0.0, 5)
+        self.assertEqual(scores['nr_residues_common'], 60)
+
+    def test_partial(self):
+        # Move the last 20 residues well away so only the first 40 superpose
+        model = self.structure.copy()
+        model[40:] += 20.0
+        scores = tm_util.tm_scores(model, self.structure)
+        self.assertTrue(0.6 < scores['tmscore'] < 0.75)
+        self.assertAlmostEqual(scores['gdtts'], 40.0 / 60.0, 5)
+        self.assertTrue(scores['rmsd'] > 5.0)
+        with self.assertRaises(RuntimeError):
+            tm_util.tm_scores(model[:10], self.structure)
+
+    def test_matched_coordinates(self):
+        model_residues = [(1, 'A', (1.0, 0.0, 0.0)), (2, 'C', (2.0, 0.0, 0.0)), (3, 'D', None), (4, 'E', (4.0, 0.0, 0.0))]
+        structure_residues = [(10, 'C', (0.0, 2.0, 0.0)), (11, 'D', (0.0, 3.0, 0.0)), (12, 'E', (0.0, 4.0, 0.0)),
+                              (13, 'F', (0.0, 5.0, 0.0))]
+        model_xyz, structure_xyz = tm_util.matched_coordinates(model_residues, structure_residues, "ACDE-", "-CDEF")
+        self.assertTrue(numpy.array_equal(model_xyz, [[2.0, 0.0, 0.0], [4.0, 0.0, 0.0]]))
+        self.assertTrue(numpy.array_equal(structure_xyz, [[0.0, 2.0, 0.0], [0.0, 4.0, 0.0]]))
+
+    def test_batch_failure(self):
+        # A pair with too few matching residues doesn't lose the scores of the others
+        residues = [(i + 1, 'A', tuple(xyz)) for i, xyz in enumerate(self.structure)]
+        jobs = [('m1.pdb', 's.pdb', residues, residues, 'A' * 60, 'A' * 60),
+                ('m2.pdb', 's.pdb', residues[:2], residues[:2], 'AA', 'AA')]
+        for nproc in (1, 2):
+            entries = tm_util.TMscore('TMscore', nproc=nproc).batch_comparison(jobs)
+            self.assertEqual([e['model_name'] for e in entries], ['m1', 'm2'])
+            self.assertAlmostEqual(entries[0]['tmscore'], 1.0, 5)
+            self.assertIsNone(entries[1]['tmscore'])
+            self.assertIsNone(entries[1]['gdtts'])
+
 if __name__ == "__main__":
     unittest.main()
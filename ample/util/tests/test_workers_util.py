@@ -45,6 +45,88 @@ sys.exit(0)
         for j in jobs: os.unlink(j)
         for l in glob.glob("job_*.log"): os.unlink(l)
         pass
-    
+
+
+class TestLocalExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.wdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.wdir)
+
+    def makeJob(self, name, rcode=0, sleep=0):
+        script = os.path.join(self.wdir, name + ".sh")
+        with open(script, 'w') as f:
+            f.write("#!/bin/sh\necho I am job: {0}\nsleep {1}\nexit {2}\n".format(name, sleep, rcode))
+        os.chmod(script, stat.S_IRWXU)
+        return script
+
+    def test_run(self):
+        jobs = [self.makeJob("job_{0}".format(i)) for i in range(6)]
+        executor = workers_util.LocalExecutor(nproc=2)
+        calls = []
+        self.assertTrue(executor.run(jobs, monitor=lambda: calls.append(1)))
+        for j in jobs:
+            self.assertTrue(os.path.isfile(os.path.splitext(j)[0] + ".log"))
+        self.assertEqual(len(calls), len(jobs) + 1)
+        # The same workers are reused for the next set of jobs
+        self.assertFalse(executor.run([self.makeJob("job_fail", rcode=1)]))
+        executor.shutdown()
+
+    def test_early_terminate(self):
+        jobs = [self.makeJob("job_{0}".format(i)) for i in range(10)]
+        executor = workers_util.LocalExecutor(nproc=1)
+        self.assertTrue(executor.run(jobs, early_terminate=True, check_success=workers_util._check_success_test))
+        logs = sorted(os.path.basename(l) for l in glob.glob(os.path.join(self.wdir, "*.log")))
+        # A job may have been started before the success of job_2 was registered
+        self.assertIn("job_2.log", logs)
+        self.assertLess(len(logs), len(jobs))
+        executor.shutdown()
+
+    def test_priority(self):
+        class Reverse(workers_util.JobPriority):
+            def __init__(self): self.done = []
+            def key(self, job): return -int(os.path.basename(job)[4:-3])
+            def job_done(self, job, returncode): self.done.append(os.path.basename(job))
+        jobs = [self.makeJob("job_{0}".format(i)) for i in range(5)]
+        priority = Reverse()
+        executor = workers_util.LocalExecutor(nproc=1)
+        # Keep the worker busy so that all the jobs are queued before any are run
+        blocker = executor.submit(self.makeJob("job_9", sleep=1))
+        self.assertTrue(executor.run(jobs, priority=priority))
+        self.assertEqual(blocker.result(), 0)
+        self.assertEqual(priority.done, ["job_{0}.sh".format(i) for i in [4, 3, 2, 1, 0]])
+        executor.shutdown()
+
+    def test_future(self):
+        executor = workers_util.LocalExecutor(nproc=1)
+        done = []
+        future = executor.submit(self.makeJob("job_0"), callback=done.append)
+        self.assertEqual(future.result(timeout=30), 0)
+        self.assertEqual(done, [future])
+        self.assertFalse(future.cancel())
+        executor.shutdown()
+
+    def test_pack(self):
+        jobs = [self.makeJob("job_{0}".format(i), rcode=1 if i == 3 else 0) for i in range(5)]
+        cwd = os.getcwd()
+        os.chdir(self.wdir)
+        try:
+            scripts = workers_util.pack_scripts(jobs, 2, job_name="test")
+        finally:
+            os.chdir(cwd)
+        # The packed scripts are kept out of the directory of the job scripts
+        pack_dir = os.path.join(self.wdir, "test_pack")
+        self.assertEqual(scripts, [os.path.join(pack_dir, "test_pack_{0}.sh".format(i)) for i in [1, 2, 3]])
+        self.assertEqual(glob.glob(os.path.join(self.wdir, "*_pack_*")), [])
+        with open(os.path.join(pack_dir, "test_pack_3.jobs")) as f: self.assertEqual(f.read(), jobs[4] + "\n")
+        self.assertTrue(workers_util.run_pack(os.path.join(pack_dir, "test_pack_1.jobs"), nproc=2))
+        self.assertFalse(workers_util.run_pack(os.path.join(pack_dir, "test_pack_2.jobs")))
+        for i, rcode in enumerate([0, 0, 0, 1]):
+            with open(os.path.join(self.wdir, "job_{0}.done".format(i))) as f: self.assertEqual(f.read(), "{0}\n".format(rcode))
+        self.assertFalse(os.path.isfile(os.path.join(self.wdir, "job_4.done")))
+
 if __name__ == "__main__":
     unittest.main()
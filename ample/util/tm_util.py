@@ -8,6 +8,8 @@ __version__ = 1.0
 
 import itertools
 import logging
+import multiprocessing
+import numpy
 import operator
 import os
 import random
@@ -32,6 +34,179 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# Distance cutoffs used for the GDT-TS and GDT-HA scores
+GDT_TS_CUTOFFS = (1.0, 2.0, 4.0, 8.0)
+GDT_HA_CUTOFFS = (0.5, 1.0, 2.0, 4.0)
+# d0 of the MaxSub score
+MAXSUB_D0 = 3.5
+# Number of iterations used to extend each initial superposition
+TM_ITERATIONS = 20
+
+
+def _superpose_weighted(model, structure, weights):
+    """Superpose the model on the structure for each set of weights and return the distances between the residues
+
+    Parameters
+    ----------
+    model : :obj:`numpy.ndarray`
+       (L, 3) CA coordinates of the model
+    structure : :obj:`numpy.ndarray`
+       (L, 3) CA coordinates of the matching residues of the structure
+    weights : :obj:`numpy.ndarray`
+       (S, L) boolean array of the residues used for each of S superpositions
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+       (S, L) array of the distances between the residues after each superposition
+    """
+    w = weights.astype(numpy.float64)
+    n = w.sum(axis=1)[:, numpy.newaxis]
+    model_centre = w.dot(model) / n
+    structure_centre = w.dot(structure) / n
+    mobile = model[numpy.newaxis, :, :] - model_centre[:, numpy.newaxis, :]
+    target = structure[numpy.newaxis, :, :] - structure_centre[:, numpy.newaxis, :]
+    covariance = numpy.einsum('slj,slk->sjk', mobile * w[:, :, numpy.newaxis], target)
+    u, _, vt = numpy.linalg.svd(covariance)
+    d = numpy.sign(numpy.linalg.det(u) * numpy.linalg.det(vt))
+    u[:, :, 2] *= d[:, numpy.newaxis]
+    rotation = numpy.einsum('sij,sjk->sik', u, vt)
+    superposed = numpy.einsum('slj,sjk->slk', mobile, rotation)
+    return numpy.sqrt(((superposed - target) ** 2).sum(axis=2))
+
+
+def tm_scores(model, structure):
+    """Calculate the TM, MaxSub, GDT-TS and GDT-HA scores and RMSD of a model against a structure
+
+    The residues of the model and structure must already be matched, so that residue i of the model corresponds
+    to residue i of the structure, and the scores are normalised by the number of residues, as TMscore does for
+    residue-matched files.
+
+    As in TMscore, the superposition that maximises each score is searched for by superposing fragments of the
+    model of decreasing length at regularly spaced positions along the chain and iteratively re-superposing on the residues
+    within the distance cutoff of the score. All of the starting fragments and cutoffs are handled as one batch of
+    superpositions, so the scores are close to, but not always identical to, those from TMscore.
+
+    Parameters
+    ----------
+    model : :obj:`numpy.ndarray`
+       (L, 3) CA coordinates of the model
+    structure : :obj:`numpy.ndarray`
+       (L, 3) CA coordinates of the matching residues of the structure
+
+    Returns
+    -------
+    dict
+       Dictionary with the tmscore, maxsub, gdtts, gdtha, rmsd and nr_residues_common
+    """
+    model = numpy.asarray(model, dtype=numpy.float64)
+    structure = numpy.asarray(structure, dtype=numpy.float64)
+    length = len(structure)
+    if length < 3 or len(model) != length:
+        raise RuntimeError("Need at least 3 matching residues to score a model but got {0} and {1}".format(len(model), length))
+    d0 = max(0.5, 1.24 * (length - 15) ** (1.0 / 3.0) - 1.8) if length > 15 else 0.5
+    d0_search = min(max(d0, 4.5), 8.0)
+
+    # Global RMSD
+    rmsd = float(numpy.sqrt((_superpose_weighted(model, structure, numpy.ones((1, length), dtype=bool)) ** 2).mean()))
+
+    # Starting fragments of length L, L/2, L/4... down to 4 residues at every position
+    seeds = []
+    fragment = length
+    while True:
+        for start in range(0, length - fragment + 1, max(1, fragment // 8)):
+            seed = numpy.zeros(length, dtype=bool)
+            seed[start:start + fragment] = True
+            seeds.append(seed)
+        if fragment <= 4: break
+        fragment = max(4, fragment // 2)
+    seeds = numpy.array(seeds)
+
+    # Each seed is extended with the cutoff of each score
+    cutoffs = numpy.array((d0_search, MAXSUB_D0) + tuple(sorted(set(GDT_TS_CUTOFFS + GDT_HA_CUTOFFS))))
+    weights = numpy.tile(seeds, (len(cutoffs), 1))
+    cutoff = numpy.repeat(cutoffs, len(seeds))
+
+    scores = dict((c, 0.0) for c in cutoffs[2:])
+    best_tm = 0.0
+    best_maxsub = 0.0
+    for _ in range(TM_ITERATIONS):
+        # Many superpositions converge on the same residues so only calculate each one once
+        _, unique = numpy.unique(numpy.column_stack((numpy.packbits(weights, axis=1), cutoff.view(numpy.uint8).reshape(len(cutoff), -1))),
+                                 axis=0, return_index=True)
+        weights, cutoff = weights[unique], cutoff[unique]
+        distances = _superpose_weighted(model, structure, weights)
+        best_tm = max(best_tm, (1.0 / (1.0 + (distances / d0) ** 2)).sum(axis=1).max() / length)
+        best_maxsub = max(best_maxsub, numpy.where(distances < MAXSUB_D0,
+                                                   1.0 / (1.0 + (distances / MAXSUB_D0) ** 2), 0.0).sum(axis=1).max() / length)
+        for c in scores:
+            scores[c] = max(scores[c], (distances <= c).sum(axis=1).max() / length)
+        new_weights = distances < cutoff[:, numpy.newaxis]
+        # Superpositions need at least 3 residues so use the closest 3 if too few are within the cutoff
+        few = new_weights.sum(axis=1) < 3
+        if few.any():
+            closest = numpy.argpartition(distances[few], 2, axis=1)[:, :3]
+            new_weights[few] = False
+            new_weights[numpy.flatnonzero(few)[:, numpy.newaxis], closest] = True
+        # Only carry on with the superpositions that are still changing
+        changed = (new_weights != weights).any(axis=1)
+        if not changed.any(): break
+        weights, cutoff = new_weights[changed], cutoff[changed]
+
+    return {'tmscore' : float(best_tm),
+            'maxsub' : float(best_maxsub),
+            'gdtts' : float(numpy.mean([scores[c] for c in GDT_TS_CUTOFFS])),
+            'gdtha' : float(numpy.mean([scores[c] for c in GDT_HA_CUTOFFS])),
+            'rmsd' : rmsd,
+            'nr_residues_common' : length}
+
+
+def _batch_score(args):
+    """Score a model against a structure from their residues and aligned sequences in a pool worker
+
+    Returns None if the pair can't be scored, so that one bad pair doesn't stop the rest of the batch.
+    """
+    model_pdb, structure_pdb, model_residues, structure_residues, model_aln, structure_aln = args
+    try:
+        model_xyz, structure_xyz = matched_coordinates(model_residues, structure_residues, model_aln, structure_aln)
+        return tm_scores(model_xyz, structure_xyz)
+    except Exception as e:
+        logger.critical("Error scoring {0} against {1}: {2}".format(model_pdb, structure_pdb, e))
+        return None
+
+
+def matched_coordinates(model_residues, structure_residues, model_aln, structure_aln):
+    """Return the CA coordinates of the model and structure residues that are aligned to each other
+
+    This selects the same residues as TMscore._mod_structures, which renumbers the residues of each file by the
+    alignment and removes those aligned to a gap in the other sequence.
+
+    Parameters
+    ----------
+    model_residues : list
+       List of (res_seq, resname, ca_coordinates) of the model residues, as returned by TMscore._pdb_residues
+    structure_residues : list
+       List of (res_seq, resname, ca_coordinates) of the structure residues
+    model_aln : str
+       The aligned sequence of the model
+    structure_aln : str
+       The aligned sequence of the structure
+    """
+    model_xyz, structure_xyz = [], []
+    model_idx, structure_idx = 0, 0
+    for model_res, structure_res in zip(model_aln, structure_aln):
+        if model_res != "-" and structure_res != "-":
+            model_ca = model_residues[model_idx][2]
+            structure_ca = structure_residues[structure_idx][2]
+            # Residues without a CA can't be compared
+            if model_ca is not None and structure_ca is not None:
+                model_xyz.append(model_ca)
+                structure_xyz.append(structure_ca)
+        if model_res != "-": model_idx += 1
+        if structure_res != "-": structure_idx += 1
+    return numpy.array(model_xyz), numpy.array(structure_xyz)
+
+
 class ModelData(object):
     """Class to store model data"""
     __slots__ = ('model_name', 'structure_name', 'model_fname', 'structure_fname', 
@@ -105,6 +280,7 @@ class TMapps(object):
         self._submit_queue = kwargs['submit_queue'] if 'submit_queue' in kwargs else None
         self._submit_array = kwargs['submit_array'] if 'submit_array' in kwargs else True
         self._submit_max_array = kwargs['submit_max_array'] if 'submit_max_array' in kwargs else None
+        self._submit_pack = kwargs['submit_pack'] if 'submit_pack' in kwargs else None
 
     def comparison(self, models, structures):
         """
@@ -202,7 +378,8 @@ class TMapps(object):
             submit_qtype=self._submit_qtype,
             submit_queue=self._submit_queue,
             submit_array=self._submit_array,
-            submit_max_array=self._submit_max_array
+            submit_max_array=self._submit_max_array,
+            submit_pack=self._submit_pack
         )
         logger.disabled = False
 
@@ -364,8 +541,21 @@ class TMscore(TMapps):
 
     """
 
-    def __init__(self, executable, wdir=None, **kwargs):
+    def __init__(self, executable, wdir=None, batch=True, **kwargs):
+        """
+        Parameters
+        ----------
+        executable : str
+           Path to the TMscore executable
+        wdir : str
+           Path to the working directory
+        batch : bool
+           Score the residue-matched models in this process with :func:`tm_scores` rather than running the
+           TMscore executable for each pair
+
+        """
         super(TMscore, self).__init__(executable, "TMscore", wdir=wdir, **kwargs)
+        self.batch = batch
 
     def compare_structures(self, models, structures, fastas=None, all_vs_all=False):
         """
@@ -392,6 +582,9 @@ class TMscore(TMapps):
         If a FASTA sequence is provided, a much more accurate comparison can be carried out. However, to by-pass this
         there is also an option to run the comparison without it. This might work just fine for larger models.
 
+        In batch mode each structure and FASTA file is only read once and the scores are calculated across a pool
+        of nproc processes, without writing any modified pdb files or running the TMscore executable.
+
         """
         if not BIOPYTHON_AVAILABLE:
             raise RuntimeError("Biopython is not available")
@@ -406,49 +599,49 @@ class TMscore(TMapps):
 
         # The models parsed forward to the comparison
         models_to_compare, structures_to_compare = [], []
+        batch_jobs = []
         combination_iterator = self._get_iterator(all_vs_all)
 
-        if fastas:
+        # The same structures and FASTA files are usually compared to every model so only read them once
+        residues_cache = {}
+        fasta_cache = {}
 
-            # Determine the iterator and create the combinations to be compared
-            for (model, structure, fasta) in combination_iterator(models, structures, fastas):
+        def residues(pdb):
+            if pdb not in residues_cache:
+                residues_cache[pdb] = list(self._pdb_residues(pdb))
+            return residues_cache[pdb]
 
-                # Extract the FASTA sequence
+        def fasta_sequence(fasta):
+            if fasta not in fasta_cache:
                 fasta_record = list(SeqIO.parse(open(fasta, 'r'), 'fasta'))[0]
-                fasta_data = [(i + 1, j) for i, j in enumerate(str(fasta_record.seq))]
-
-                # Extract some information from each PDB structure file
-                model_data = list(self._pdb_info(model))
-                structure_data = list(self._pdb_info(structure))
-
-                # Align the model sequence to the FASTA sequence
-                for fasta_pos in fasta_data:
-                    if fasta_pos not in model_data:
-                        model_data.append((fasta_pos[0], "-"))
-                model_data.sort(key=operator.itemgetter(0))
-
-                # Align the structure_sequence to the model sequence
-                aln_parser = alignment_parser.AlignmentParser()
-                fasta_structure_aln = aln_parser.align_sequences("".join(zip(*fasta_data)[1]),
-                                                                 "".join(zip(*structure_data)[1]))
-
-                # Remove parts of the alignment that are gaps in both sequences
-                to_remove = []
-                _alignment = zip("".join(zip(*model_data)[1]), fasta_structure_aln[1])
-                for i, (model_res, structure_res) in enumerate(_alignment):
-                    if model_res == "-" and structure_res == "-":
-                        to_remove.append(i)
-                for i in reversed(to_remove):
-                    _alignment.pop(i)
-
-                model_aln = "".join(zip(*_alignment)[0])
-                structure_aln = "".join(zip(*_alignment)[1])
-
-                if len(model_aln) != len(structure_aln):
-                    msg = "Unequal lengths of your model and structure sequences"
-                    logger.critical(msg)
-                    raise RuntimeError(msg)
+                fasta_cache[fasta] = [(i + 1, j) for i, j in enumerate(str(fasta_record.seq))]
+            return fasta_cache[fasta]
 
+        if fastas:
+            combinations = combination_iterator(models, structures, fastas)
+        else:
+            # No FASTA processing etc, pure comparisons of sequences
+            combinations = ((model, structure, None) for (model, structure) in combination_iterator(models, structures))
+
+        for (model, structure, fasta) in combinations:
+            if self.batch:
+                # There are no modified files for comparison to check so skip missing files here
+                if not os.path.isfile(model):
+                    logger.warning("Cannot find: {0}".format(model))
+                    continue
+                elif not os.path.isfile(structure):
+                    logger.warning("Cannot find: {0}".format(structure))
+                    continue
+            # Extract some information from each PDB structure file
+            model_residues = list(self._pdb_residues(model))
+            structure_residues = residues(structure)
+            fasta_data = fasta_sequence(fasta) if fasta else None
+
+            model_aln, structure_aln = self._align(model_residues, structure_residues, fasta_data)
+
+            if self.batch:
+                batch_jobs.append((model, structure, model_residues, structure_residues, model_aln, structure_aln))
+            else:
                 # Modify the structures based on the aligned sequences
                 pdb_combo = self._mod_structures(model_aln, structure_aln, model, structure)
 
@@ -456,36 +649,122 @@ class TMscore(TMapps):
                 models_to_compare.append(pdb_combo[0])
                 structures_to_compare.append(pdb_combo[1])
 
+        if self.batch:
+            return self.batch_comparison(batch_jobs)
+        return self.comparison(models_to_compare, structures_to_compare)
+
+    def batch_comparison(self, jobs):
+        """
+        Score residue-matched models against their structures in this process
+
+        Parameters
+        ----------
+        jobs : list
+           List of (model_pdb, structure_pdb, model_residues, structure_residues, model_aln, structure_aln)
+
+        Returns
+        -------
+        entries : list
+           List of TMscore data entries on a per-model basis
+
+        """
+        if len(jobs) < 1:
+            msg = 'No model structures provided'
+            logger.critical(msg)
+            raise RuntimeError(msg)
+
+        logger.info('Using algorithm: {0} (batch)'.format(self.method))
+        logger.info('------- Evaluating decoys -------')
+
+        if self._nproc > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(self._nproc)
+            try:
+                scores = pool.map(_batch_score, jobs, chunksize=max(1, len(jobs) // (self._nproc * 4)))
+            finally:
+                pool.close()
+                pool.join()
         else:
-            # No FASTA processing etc, pure comparisons of sequences
-            for (model, structure) in combination_iterator(models, structures):
+            scores = [_batch_score(job) for job in jobs]
 
-                # Extract some information from each PDB structure file
-                model_data = list(self._pdb_info(model))
-                structure_data = list(self._pdb_info(structure))
+        entries = []
+        for job, score in zip(jobs, scores):
+            model_pdb, structure_pdb = job[0], job[1]
+            model_name = os.path.splitext(os.path.basename(model_pdb))[0]
+            structure_name = os.path.splitext(os.path.basename(structure_pdb))[0]
+            if score is None:
+                # As for a log file that couldn't be parsed in comparison
+                model = ModelData(model_name, structure_name, model_pdb, structure_pdb, "None", None, None, None)
+                model.gdtts = model.gdtha = model.maxsub = None
+            else:
+                model = ModelData(model_name, structure_name, model_pdb, structure_pdb, None,
+                                  score['tmscore'], score['rmsd'], score['nr_residues_common'])
+                model.gdtts = score['gdtts']
+                model.gdtha = score['gdtha']
+                model.maxsub = score['maxsub']
+            entries.append(model._asdict())
 
-                # Align the sequences to see how much of the predicted decoys are in the xtal
-                alignment = alignment_parser.AlignmentParser().align_sequences("".join(zip(*model_data)[1]),
-                                                                               "".join(zip(*structure_data)[1]))
-                # Redundant but identical to if
-                alignment = zip(alignment[0], alignment[1])
+        self.entries = entries
+        return entries
 
-                model_aln = "".join(zip(*alignment)[0])
-                structure_aln = "".join(zip(*alignment)[1])
+    def _align(self, model_residues, structure_residues, fasta_data=None):
+        """
+        Align the sequences of the model and structure, optionally via the FASTA sequence
 
-                if len(model_aln) != len(structure_aln):
-                    msg = "Unequal lengths of your model and structure sequences"
-                    logger.critical(msg)
-                    raise RuntimeError(msg)
+        Parameters
+        ----------
+        model_residues : list
+           The model residues as returned by :meth:`_pdb_residues`
+        structure_residues : list
+           The structure residues as returned by :meth:`_pdb_residues`
+        fasta_data : list, optional
+           List of (position, residue) of the FASTA sequence
 
-                # Modify the structures based on the aligned sequences
-                pdb_combo = self._mod_structures(model_aln, structure_aln, model, structure)
+        Returns
+        -------
+        model_aln : str
+           The aligned sequence of the model
+        structure_aln : str
+           The aligned sequence of the structure
 
-                # Save the models9
-                models_to_compare.append(pdb_combo[0])
-                structures_to_compare.append(pdb_combo[1])
+        """
+        model_data = [r[:2] for r in model_residues]
+        structure_data = [r[:2] for r in structure_residues]
+
+        if fasta_data:
+            # Align the model sequence to the FASTA sequence
+            for fasta_pos in fasta_data:
+                if fasta_pos not in model_data:
+                    model_data.append((fasta_pos[0], "-"))
+            model_data.sort(key=operator.itemgetter(0))
+
+            # Align the structure_sequence to the model sequence
+            aln_parser = alignment_parser.AlignmentParser()
+            fasta_structure_aln = aln_parser.align_sequences("".join(zip(*fasta_data)[1]),
+                                                             "".join(zip(*structure_data)[1]))
+
+            # Remove parts of the alignment that are gaps in both sequences
+            to_remove = []
+            _alignment = zip("".join(zip(*model_data)[1]), fasta_structure_aln[1])
+            for i, (model_res, structure_res) in enumerate(_alignment):
+                if model_res == "-" and structure_res == "-":
+                    to_remove.append(i)
+            for i in reversed(to_remove):
+                _alignment.pop(i)
+        else:
+            # Align the sequences to see how much of the predicted decoys are in the xtal
+            alignment = alignment_parser.AlignmentParser().align_sequences("".join(zip(*model_data)[1]),
+                                                                           "".join(zip(*structure_data)[1]))
+            _alignment = zip(alignment[0], alignment[1])
 
-        return self.comparison(models_to_compare, structures_to_compare)
+        model_aln = "".join(zip(*_alignment)[0])
+        structure_aln = "".join(zip(*_alignment)[1])
+
+        if len(model_aln) != len(structure_aln):
+            msg = "Unequal lengths of your model and structure sequences"
+            logger.critical(msg)
+            raise RuntimeError(msg)
+
+        return model_aln, structure_aln
 
     def _mod_structures(self, model_aln, structure_aln, model_pdb, structure_pdb):
         """
@@ -618,6 +897,24 @@ class TMscore(TMapps):
         list
             A list containing per residue information
 
+        """
+        for res_seq, resname_one, _ in self._pdb_residues(pdb):
+            yield (res_seq, resname_one)
+
+    def _pdb_residues(self, pdb):
+        """
+        Obtain the pdb indeces, residue names and CA coordinates
+
+        Parameters
+        ----------
+        pdb : str
+           The path to a PDB file
+
+        Yields
+        ------
+        tuple
+            The residue sequence number, one-letter residue name and CA coordinates (None if the residue has no CA)
+
         """
         if not BIOPYTHON_AVAILABLE: raise RuntimeError("Biopython is not available")
         with warnings.catch_warnings():
@@ -642,8 +939,9 @@ class TMscore(TMapps):
                     if resname_three == "MSE":
                         resname_three = "MET"
                     resname_one = PDB.Polypeptide.three_to_one(resname_three)
+                    ca = tuple(float(x) for x in residue['CA'].get_coord()) if 'CA' in residue else None
 
-                    yield (res_seq, resname_one)
+                    yield (res_seq, resname_one, ca)
 
     def _residue_one(self, pdb):
         """
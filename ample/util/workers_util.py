@@ -5,106 +5,294 @@ Created on Feb 28, 2013
 '''
 
 import logging
-import multiprocessing
 import os
-import time
+import Queue
+import sys
+import threading
 
 from ample.util import ample_util
 from ample.util import clusterize
-from ample.util import worker
 
 # logger = logging.getLogger(__name__)
 logger = logging.getLogger()
 
-class JobServer(object):
-    def __init__(self):
-        self.inqueue = None
-        self.outqueue = None
-        logger.info("Running jobs on a local machine")
+# Maximum time to wait for a job to complete before running the monitor function
+MONITOR_INTERVAL = 60
+# Python used to run the job scripts packed into a single cluster job
+PACK_PYTHON = "ccp4-python"
+
+class JobFuture(object):
+    """A handle on a job script submitted to a :obj:`LocalExecutor`
+
+    The future is completed by the worker thread that ran the job and any callbacks
+    registered with :meth:`add_done_callback` are called in that thread.
+    """
+    def __init__(self, job):
+        self.job = job
+        self.returncode = None
+        self.cancelled = False
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
     
-    def setJobs(self, jobs):
-        """Add the list of jobs we are to run"""
-        if self.inqueue: raise RuntimeError,"NOT THOUGHT ABOUT MULTIPLE INVOCATIONS!"
-        
-        # Queue to hold the jobs we want to run
-        queue = multiprocessing.Queue()
-        
-        # Add jobs to the inqueue
-        #logger.info("Generating MRBUMP runscripts in: {0}".format( os.getcwd() ) )
-        for job in jobs:
-            if not os.path.isfile(job): raise RuntimeError,"JobServer cannot find job: {0}".format(job)
-            queue.put(job)
-            
-        self.inqueue = queue
-        #self.inqueue.close()
-        # We can't call inqueue.close() even though we've finished as it all goes horribly wrong
-        # We sleep to allow enough time for the objects to be picked and put on the queue
-        time.sleep(2)
-        
-        return
+    @property
+    def name(self):
+        return os.path.splitext(os.path.basename(self.job))[0]
     
-    def start(self, nproc=None, early_terminate=False, check_success=None, monitor=None):
-        
-        assert nproc != None
+    def add_done_callback(self, fn):
+        """Call fn(future) when the job completes (immediately if already done)"""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+    
+    def cancel(self):
+        """Cancel the job if it has not yet started. Returns True if it was cancelled."""
+        with self._lock:
+            if self._done.is_set() or self.returncode is not None: return False
+            self.cancelled = True
+        self._finish()
+        return True
+    
+    def done(self):
+        return self._done.is_set()
+    
+    def result(self, timeout=None):
+        """Wait for the job to complete and return its exit code (None if cancelled)"""
+        self._done.wait(timeout)
+        return self.returncode
+    
+    def _run(self):
+        with self._lock:
+            if self.cancelled: return
+            # Mark as started so that it can no longer be cancelled
+            self.returncode = -1
+        directory = os.path.dirname(self.job)
+        logfile = os.path.join(directory, self.name + ".log")
+        try:
+            self.returncode = ample_util.run_command([self.job], logfile=logfile, directory=directory,
+                                                     dolog=False, check=True)
+        except Exception as e:
+            logger.critical("Error running job {0}: {1}".format(self.job, e))
+            self.returncode = 1
+        self._finish()
+    
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                logger.critical("Error in completion callback for job {0}: {1}".format(self.job, e))
+
+
+class JobPriority(object):
+    """Decide the order in which queued jobs are run by a :obj:`LocalExecutor`
+    
+    The key is evaluated for all queued jobs whenever a worker becomes free, so a subclass
+    can re-rank the queue on the fly from the results of the jobs that have completed.
+    The default runs jobs in the order they were submitted.
+    """
+    def key(self, job):
+        """Return a sort key for job - the job with the lowest key is run next"""
+        return 0
+    
+    def job_done(self, job, returncode):
+        """Called in the worker thread when job completes, before the worker takes another job"""
+        pass
+
+
+class LocalExecutor(object):
+    """Run job scripts on the local machine with a persistent pool of workers
 
-        # Now start the jobs
-        processes = []
+    Jobs are started as soon as a worker is free and the caller is woken as soon as
+    any job completes, so there are no fixed sleeps or polling of individual workers.
+    The workers are threads that each wait on a single subprocess, so they cost nothing
+    while idle and the same executor can be reused for successive stages of a run
+    (see :func:`local_executor`).
+    """
+    def __init__(self, nproc=1):
+        assert nproc > 0
+        self.nproc = nproc
+        self._pending = [] # (submission number, future, priority)
+        self._nsubmitted = 0
+        self._shutdown = False
+        self._cond = threading.Condition()
+        self._threads = []
         for i in range(nproc):
-            process = multiprocessing.Process(target=worker.worker, args=(self.inqueue,
-                                                                          early_terminate,
-                                                                          check_success))
-            process.start()
-            processes.append(process)
+            t = threading.Thread(target=self._work, name="LocalExecutor-{0}".format(i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+    
+    def _next(self):
+        """Remove and return the next job to run, waiting until there is one"""
+        with self._cond:
+            while not self._pending and not self._shutdown:
+                self._cond.wait()
+            if self._shutdown: return None
+            idx = min(range(len(self._pending)), key=lambda i: self._sort_key(self._pending[i]))
+            return self._pending.pop(idx)[1]
+    
+    @staticmethod
+    def _sort_key(item):
+        n, future, priority = item
+        if priority is None: return (0, n)
+        return (priority.key(future.job), n)
+    
+    def _work(self):
+        while True:
+            future = self._next()
+            if future is None: break
+            future._run()
+    
+    def submit(self, job, callback=None, priority=None):
+        """Queue a job script and return its :obj:`JobFuture`
         
-        # Loop through the processes checking if any are done
-        timeout=1*60
+        Parameters
+        ----------
+        job : str
+           Path to the job script
+        callback : callable
+           Called with the future when the job completes or is cancelled
+        priority : :obj:`JobPriority`
+           Used to rank the job against the other queued jobs
+        """
+        if not os.path.isfile(job): raise RuntimeError("LocalExecutor cannot find job: {0}".format(job))
+        future = JobFuture(job)
+        if priority is not None:
+            def job_done(f):
+                if not f.cancelled: priority.job_done(f.job, f.returncode)
+            future.add_done_callback(job_done)
+        if callback: future.add_done_callback(callback)
+        with self._cond:
+            self._pending.append((self._nsubmitted, future, priority))
+            self._nsubmitted += 1
+            self._cond.notify()
+        return future
+    
+    def cancel_pending(self, futures=None):
+        """Cancel queued jobs (all of them if futures is None). Running jobs are left to complete.
         
-        # Broken on OSX 
-        #qsize=self.outqueue.qsize()
+        Returns
+        -------
+        ncancelled : int
+           The number of jobs that were removed from the queue
+        """
+        with self._cond:
+            if futures is None:
+                pending, self._pending = self._pending, []
+            else:
+                futures = set(futures)
+                pending = [p for p in self._pending if p[1] in futures]
+                self._pending = [p for p in self._pending if p[1] not in futures]
+        for _, f, _ in pending:
+            f.cancel()
+            logger.debug("Removed job [{0}] from queue".format(f.job))
+        return len(pending)
+    
+    def run(self, jobs, early_terminate=False, check_success=None, monitor=None, priority=None,
+            monitor_interval=MONITOR_INTERVAL):
+        """Run a list of job scripts and wait for them to complete
         
-        if monitor: monitor()
+        Parameters
+        ----------
+        jobs : list
+           Paths to the job scripts
+        early_terminate : bool
+           Cancel all queued jobs once check_success returns True for a completed job
+        check_success : callable
+           A callable taking the job script that returns True if the job succeeded
+        monitor : callable
+           Called whenever a job completes and at least every monitor_interval seconds
+        priority : :obj:`JobPriority`
+           Decides which queued job is run next [default: submission order]
+        monitor_interval : int
+           Maximum number of seconds between calls to monitor
         
-        success=True
-        while len(processes):
-            for i, process in enumerate(processes):
-                # Join process for timeout seconds and if we haven't finished by then move onto the next process
-                process.join(timeout)
-                if not process.is_alive():
-                    logger.debug("Checking completed process {0} with exitcode {1}".format(process,process.exitcode))
-                    
-                    # Set failed if any job failed
-                    if process.exitcode != 0:
-                        logger.critical("Process {0} failed with exitcode {1}".format(process,process.exitcode))
-                        success=False
-                    
-                    # Finished so see what happened
-                    if process.exitcode == 0 and early_terminate:
-                        if not self.inqueue.empty():
-                            print "Process {0} was successful so removing remaining jobs from inqueue".format(process.name) 
-                            logger.info( "Process {0} was successful so removing remaining jobs from inqueue".format(process.name) )
-                            # Remove all remaining processes from the inqueue. We do this rather than terminate the processes
-                            # as terminating leaves the MRBUMP processes running. This way we hang around until all our
-                            # running processes have finished
-                            while not self.inqueue.empty():
-                                job = self.inqueue.get()
-                                logger.debug( "Removed job [{0}] from inqueue".format(job))
-                        else:
-                            print "Got empty queue - all jobs done"
-                            
-                    # Remove from processes to check
-                    del processes[i]
-                    
-                # Run the monitor function
+        Returns
+        -------
+        success : bool
+           False if any job that was run exited with a non-zero exit code
+        """
+        if early_terminate: assert callable(check_success)
+        completed = Queue.Queue()
+        futures = [self.submit(job, callback=completed.put, priority=priority) for job in jobs]
+        if monitor: monitor()
+        success = True
+        remaining = len(futures)
+        while remaining:
+            try:
+                future = completed.get(timeout=monitor_interval)
+            except Queue.Empty:
                 if monitor: monitor()
-                            
-        # need to wait here as sometimes it takes a while for the results files to get written
-        time.sleep(3)        
+                continue
+            remaining -= 1
+            if future.cancelled: continue
+            logger.debug("Job {0} completed with exit code {1}".format(future.name, future.returncode))
+            if future.returncode != 0:
+                logger.critical("Job {0} failed with exit code {1}".format(future.job, future.returncode))
+                success = False
+            elif early_terminate and check_success(future.job):
+                # We wait for any running jobs rather than killing them as that can leave
+                # MRBUMP processes running
+                ncancelled = self.cancel_pending(futures)
+                if ncancelled:
+                    logger.info("Job {0} was successful so removed {1} remaining jobs from queue".format(future.name, ncancelled))
+            if monitor: monitor()
         return success
+    
+    def shutdown(self, wait=True):
+        """Cancel any queued jobs and stop the workers"""
+        self.cancel_pending()
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+        if wait:
+            for t in self._threads: t.join()
+        self._threads = []
+
+
+_EXECUTOR = None
+
+def local_executor(nproc=1):
+    """Return the shared :obj:`LocalExecutor`, creating it if it does not have nproc workers"""
+    global _EXECUTOR
+    if _EXECUTOR is None or _EXECUTOR.nproc != nproc:
+        if _EXECUTOR is not None: _EXECUTOR.shutdown(wait=False)
+        _EXECUTOR = LocalExecutor(nproc=nproc)
+    return _EXECUTOR
+
+
+class JobServer(object):
+    """Run a list of jobs on the local machine using the shared :obj:`LocalExecutor`"""
+    def __init__(self):
+        self.jobs = None
+        logger.info("Running jobs on a local machine")
+    
+    def setJobs(self, jobs):
+        """Add the list of jobs we are to run"""
+        if self.jobs: raise RuntimeError("NOT THOUGHT ABOUT MULTIPLE INVOCATIONS!")
+        for job in jobs:
+            if not os.path.isfile(job): raise RuntimeError("JobServer cannot find job: {0}".format(job))
+        self.jobs = list(jobs)
+    
+    def start(self, nproc=None, early_terminate=False, check_success=None, monitor=None, priority=None):
+        assert nproc != None
+        return local_executor(nproc).run(self.jobs,
+                                         early_terminate=early_terminate,
+                                         check_success=check_success,
+                                         monitor=monitor,
+                                         priority=priority)
 
 def run_scripts(job_scripts,
                 monitor=None,
                 check_success=None,
                 early_terminate=None,
+                priority=None,
                 nproc=None,
                 job_time=None,
                 job_name=None,
@@ -114,7 +302,8 @@ def run_scripts(job_scripts,
                 submit_pe_lsf=None,
                 submit_pe_sge=None,
                 submit_array=None,
-                submit_max_array=None):
+                submit_max_array=None,
+                submit_pack=None):
     if submit_cluster:
         return run_scripts_cluster(job_scripts,
                                    nproc=nproc,
@@ -127,7 +316,8 @@ def run_scripts(job_scripts,
                                    submit_pe_lsf=submit_pe_lsf,
                                    submit_pe_sge=submit_pe_sge,
                                    submit_array=submit_array,
-                                   submit_max_array=submit_max_array
+                                   submit_max_array=submit_max_array,
+                                   submit_pack=submit_pack
                                    )
     else:
         return run_scripts_serial(job_scripts,
@@ -135,6 +325,7 @@ def run_scripts(job_scripts,
                                   monitor=monitor,
                                   early_terminate=early_terminate,
                                   check_success=check_success,
+                                  priority=priority,
                                   )
 
 def run_scripts_cluster(job_scripts,
@@ -148,9 +339,16 @@ def run_scripts_cluster(job_scripts,
                         submit_pe_sge=None,
                         submit_array=None,
                         submit_max_array=None,
+                        submit_pack=None,
                         nproc=None):
     logger = logging.getLogger()
     logger.info("Running jobs on a cluster")
+    packed_scripts = None
+    if submit_pack and submit_pack > 1 and len(job_scripts) > 1:
+        # Run submit_pack scripts in each cluster job to cut the time spent waiting in the queue
+        packed_scripts = job_scripts
+        job_scripts = pack_scripts(job_scripts, submit_pack, job_name=job_name)
+        logger.info("Packed {0} jobs into {1} cluster jobs".format(len(packed_scripts), len(job_scripts)))
     cluster_run = clusterize.ClusterRun()
     cluster_run.QTYPE = submit_qtype
     if submit_array and len(job_scripts) > 1:
@@ -178,34 +376,125 @@ def run_scripts_cluster(job_scripts,
                                                              submit_pe_lsf=submit_pe_lsf,
                                                              submit_pe_sge=submit_pe_sge
                                                              )
-            # We add the queue directives after the first line of the script
-            with open(script,'w') as f: f.writelines("".join([lines[0]] + slines + lines[1:]))
+            # We add the queue directives and the command to write the sentinel file after the first line of the script
+            with open(script,'w') as f:
+                f.writelines("".join([lines[0]] + slines + [clusterize.sentinel_command(script)] + lines[1:]))
             os.chmod(script, 0o777)
-            cluster_run.submitJob(script)
+        cluster_run.submitJobs(job_scripts)
 
     # Monitor the cluster queue to see when all jobs have finished
     cluster_run.monitorQueue(monitor=monitor)
     
     # Rename scripts for array jobs
     if submit_array and len(job_scripts) > 1: cluster_run.cleanUpArrayJob()
+    
+    if packed_scripts:
+        # Report the scripts that failed or were never run because their cluster job was killed
+        for script in packed_scripts:
+            status = clusterize.sentinel_file(script)
+            if not os.path.isfile(status):
+                logger.critical("Job {0} did not complete".format(script))
+                continue
+            with open(status) as f: code = f.read().strip()
+            if code != "0": logger.critical("Job {0} failed with exit code {1}".format(script, code))
     return True
 
+def pack_scripts(job_scripts, submit_pack, job_name=None, pack_dir=None):
+    """Write scripts that each run submit_pack of the job scripts with :func:`run_pack`
+    
+    Parameters
+    ----------
+    job_scripts : list
+       Absolute paths to the job scripts
+    submit_pack : int
+       The number of job scripts run by each packed script
+    job_name : str
+       Used to name the packed scripts
+    pack_dir : str
+       The directory to write the packed scripts to [default: <job_name>_pack in the current directory]
+    
+    Returns
+    -------
+    scripts : list
+       The paths to the packed scripts
+    """
+    # Keep the packed scripts away from the job scripts as the directories may be searched for job scripts (*.sh)
+    if not pack_dir: pack_dir = "{0}_pack".format(job_name or "job")
+    pack_dir = os.path.abspath(pack_dir)
+    if not os.path.isdir(pack_dir): os.makedirs(pack_dir)
+    module = os.path.join(os.path.abspath(os.path.dirname(__file__)), "workers_util.py")
+    scripts = []
+    for i in range(0, len(job_scripts), submit_pack):
+        name = "{0}_pack_{1}".format(job_name or "job", i // submit_pack + 1)
+        jobs = os.path.join(pack_dir, name + ".jobs")
+        with open(jobs, 'w') as f: f.write("".join(s + "\n" for s in job_scripts[i:i + submit_pack]))
+        script = os.path.join(pack_dir, name + ".sh")
+        with open(script, 'w') as f:
+            f.write("#!/bin/sh\n{0} -u {1} {2}\n".format(PACK_PYTHON, module, jobs))
+        os.chmod(script, 0o777)
+        scripts.append(script)
+    # Remove any status files from an earlier run
+    for script in job_scripts:
+        status = clusterize.sentinel_file(script)
+        if os.path.isfile(status): os.unlink(status)
+    return scripts
+
+def run_pack(jobs, nproc=None):
+    """Run the job scripts listed in the file jobs with a :obj:`LocalExecutor`
+    
+    As each script completes a status file holding its exit code is written alongside it
+    (see :func:`clusterize.sentinel_file`).
+    
+    Parameters
+    ----------
+    jobs : str
+       File listing the paths to the job scripts, one per line
+    nproc : int
+       The number of scripts to run at once [default: the number of slots the queueing system allocated]
+    
+    Returns
+    -------
+    success : bool
+       False if any script exited with a non-zero exit code
+    """
+    with open(jobs) as f: job_scripts = [line.strip() for line in f if line.strip()]
+    if nproc is None: nproc = int(os.environ.get('NSLOTS', os.environ.get('LSB_DJOB_NUMPROC', 1)))
+    
+    def write_status(future):
+        if future.cancelled: return
+        status = clusterize.sentinel_file(future.job)
+        with open(status + ".tmp", 'w') as f: f.write("{0}\n".format(future.returncode))
+        os.rename(status + ".tmp", status)
+    
+    executor = LocalExecutor(nproc=nproc)
+    try:
+        futures = [executor.submit(job, callback=write_status) for job in job_scripts]
+        success = True
+        for future in futures:
+            if future.result() != 0:
+                logger.critical("Job {0} failed with exit code {1}".format(future.job, future.returncode))
+                success = False
+        return success
+    finally:
+        executor.shutdown()
+
 def run_scripts_serial(job_scripts,
                        nproc=None,
                        monitor=None,
                        early_terminate=None,
                        check_success=None,
+                       priority=None,
                        ):
     success=False
     if len(job_scripts) > 1:
-        # Don't need early terminate - check_success if it exists states what's happening
-        js = JobServer()
-        js.setJobs(job_scripts)
-        success = js.start(nproc=nproc,
-                           early_terminate=bool(early_terminate),
-                           check_success=check_success,
-                           monitor=monitor,
-                           )
+        logger.info("Running jobs on a local machine")
+        if not nproc: nproc = 1
+        success = local_executor(nproc).run(job_scripts,
+                                            early_terminate=bool(early_terminate),
+                                            check_success=check_success,
+                                            monitor=monitor,
+                                            priority=priority,
+                                            )
     else:
         script=job_scripts[0]
         name=os.path.splitext(os.path.basename(script))[0]
@@ -222,3 +511,8 @@ def _check_success_test( job ):
     if jobname == "job_2": return True
     return False
  
+
+if __name__ == "__main__":
+    # Run the job scripts packed into a cluster job - see pack_scripts
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(0 if run_pack(sys.argv[1]) else 1)
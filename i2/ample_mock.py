@@ -10,7 +10,7 @@ import sys
 import time
 
 #from ample.util import ample_util
-from ample.util.ample_util import I2DIR, amoptd_fix_path
+from ample.util.ample_util import I2DIR, amoptd_fix_path, read_amoptd
 from ample.util.pyrvapi_results import AmpleOutput
 from ample.constants import AMPLE_PKL
 
@@ -32,7 +32,7 @@ if opt.rvapi_document:
     ample_pkl =  os.path.join(mroot,'from_existing_models','resultsd.pkl')
 
 # Load AMPLE dictionary
-with open(ample_pkl) as f: od = cPickle.load(f)
+od = read_amoptd(ample_pkl)
 
 if opt.rvapi_document:
     amoptd_fix_path(od, newroot=mroot, i2mock=False)
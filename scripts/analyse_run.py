@@ -1420,8 +1420,7 @@ if __name__ == "__main__":
                 assert False
 
         # Hack - ampleDict is stored with first run
-        with open( pfile ) as f:
-            ampleDict = cPickle.load( f  )
+        ampleDict = ample_util.read_amoptd( pfile )
     
         # First process all stuff that's the same for each structure
         
@@ -1,4 +1,3 @@
-import cPickle
 import os
 import shutil
 import sys
@@ -21,7 +20,7 @@ for pdb in pdb_codes:
     if not os.path.isdir(ample_dir): ample_dir=os.path.join(root,pdb,"AMPLE_0")
     pkl=os.path.join(ample_dir,'resultsd.pkl')
     mrbumpd=os.path.join(ample_dir,'MRBUMP')
-    with open(pkl) as f: amoptd=cPickle.load(f)
+    amoptd=ample_util.read_amoptd(pkl)
     res_sum = mrbump_results.ResultsSummary()
     res_sum.extractResults(mrbumpd)
     amoptd['mrbump_results'] = res_sum.results
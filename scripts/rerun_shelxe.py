@@ -39,6 +39,7 @@ import parse_arpwarp
 import parse_buccaneer
 
 # Custom
+from ample.util import results_store
 from ample.util import workers_util
 
 sys.dont_write_bytecode = True
@@ -396,7 +397,10 @@ def rerun_shelxe(args):
 
     # Unpickle dictionary
     amopt_pkl = args.ample_pkl
-    with open(args.ample_pkl) as f: amoptd = cPickle.load(f)
+    store = results_store.results_store(amopt_pkl)
+    # Fold any journal into the results file so that the backup is complete
+    store.compact()
+    amoptd = store.read()
     assert 'mrbump_results' in amoptd, "No MRBUMP results in: %s" % amopt_pkl
     
     # Back up old AMPLE pkl file - preserve metadata
@@ -451,7 +455,8 @@ def rerun_shelxe(args):
         #break
     
     # Write out the updated amoptd
-    with open(amopt_pkl, 'w') as w: cPickle.dump(amoptd,w)
+    store.save(amoptd)
+    store.compact()
 
     return job_scripts
 ##End rerun_shelxe()